@@ -0,0 +1,31 @@
+from typing import Callable
+
+import analysis_functions.resampling as resampling
+import analysis_functions.indicators as indicators
+import analysis_functions.streaming as streaming
+
+RESAMPLE_INTERVALS: dict[str, int] = resampling.RESAMPLE_INTERVALS_
+ohlcv_from_rows: Callable = resampling.ohlcv_from_rows_
+resample_ohlcv: Callable = resampling.resample_ohlcv_
+Resampler: type = resampling.Resampler
+
+sma: Callable = indicators.sma_
+ema: Callable = indicators.ema_
+wilder_smoothing: Callable = indicators.wilder_smoothing_
+rsi: Callable = indicators.rsi_
+true_range: Callable = indicators.true_range_
+atr: Callable = indicators.atr_
+rolling_std: Callable = indicators.rolling_std_
+bollinger_bands: Callable = indicators.bollinger_bands_
+macd: Callable = indicators.macd_
+vwap: Callable = indicators.vwap_
+INDICATORS: dict[str, tuple] = indicators.INDICATORS_
+calculate_indicator: Callable = indicators.calculate_indicator_
+
+EMAState: type = streaming.EMAState
+WilderState: type = streaming.WilderState
+RSIState: type = streaming.RSIState
+ATRState: type = streaming.ATRState
+RollingWindowState: type = streaming.RollingWindowState
+STREAMING_INDICATORS: dict[str, type] = streaming.STREAMING_INDICATORS_
+indicator_state_from_dict: Callable = streaming.indicator_state_from_dict_
@@ -0,0 +1,214 @@
+import numpy as np
+
+# (1 - alpha) ** -k is kept below this bound inside a single block of exponential smoothing
+_MAX_BLOCK_GROWTH = 1e64
+
+
+def _exponential_smoothing(values: np.ndarray, alpha: float, initial: float) -> np.ndarray:
+    """
+    solve y[t] = alpha * x[t] + (1 - alpha) * y[t - 1], with y[-1] = initial, without a python loop over elements
+
+    the recursion has a closed form: y[t] = (1 - a) ** (t + 1) * (initial + sum(a * x[k] / (1 - a) ** (k + 1))).
+    Powers of (1 - a) under- or overflow quickly, so the closed form is applied to blocks short enough to stay
+    in range, and only the state between the blocks is carried in a loop (thousands of elements per iteration)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    decay = 1. - alpha
+    if n == 0:
+        return values.copy()
+    if decay == 0.:
+        return values.copy()
+    block = int(min(n, max(1, np.log(_MAX_BLOCK_GROWTH) // -np.log(decay))))
+    blocks = -(-n // block)
+    padded = np.zeros(blocks * block)
+    padded[:n] = values
+    padded = padded.reshape(blocks, block)
+
+    powers = decay ** np.arange(1, block + 1)  # (1 - a) ** (j + 1)
+    # response of every block to its own inputs, as if the state before it was 0
+    local = np.cumsum(padded * (alpha / powers), axis=1) * powers
+    result = np.empty_like(local)
+    state = initial
+    for i in range(blocks):
+        result[i] = local[i] + powers * state
+        state = result[i, -1]
+    return result.reshape(-1)[:n]
+
+
+def sma_(values: np.ndarray, period: int) -> np.ndarray:
+    """simple moving average. First "period - 1" elements are NaN"""
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(len(values), np.nan)
+    if len(values) < period:
+        return result
+    sums = np.cumsum(values)
+    result[period - 1] = sums[period - 1]
+    result[period:] = sums[period:] - sums[:-period]
+    return result / period
+
+
+def ema_(values: np.ndarray, period: int, alpha: float | None = None) -> np.ndarray:
+    """
+    exponential moving average with smoothing factor 2 / (period + 1) (unless given explicitly)
+
+    seeded with the simple average of the first "period" values, so first "period - 1" elements are NaN
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if alpha is None:
+        alpha = 2. / (period + 1)
+    result = np.full(len(values), np.nan)
+    if len(values) < period:
+        return result
+    result[period - 1] = values[:period].mean()
+    result[period:] = _exponential_smoothing(values[period:], alpha, result[period - 1])
+    return result
+
+
+def wilder_smoothing_(values: np.ndarray, period: int) -> np.ndarray:
+    """Wilder's moving average (used by RSI and ATR) - an EMA with smoothing factor 1 / period"""
+    return ema_(values, period, alpha=1. / period)
+
+
+def rsi_(close: np.ndarray, period: int = 14) -> np.ndarray:
+    """
+    relative strength index, with Wilder smoothing of gains and losses
+
+    first "period" elements are NaN (first price has no change to be measured)
+    """
+    close = np.asarray(close, dtype=np.float64)
+    result = np.full(len(close), np.nan)
+    if len(close) <= period:
+        return result
+    changes = np.diff(close)
+    average_gain = wilder_smoothing_(np.maximum(changes, 0.), period)[period - 1:]
+    average_loss = wilder_smoothing_(np.maximum(-changes, 0.), period)[period - 1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi = 100. - 100. / (1. + average_gain / average_loss)
+    # no losses at all - strength is at its maximum (or undefined, when the price did not move)
+    rsi[average_loss == 0.] = 100.
+    rsi[(average_loss == 0.) & (average_gain == 0.)] = 50.
+    result[period:] = rsi
+    return result
+
+
+def true_range_(high: np.ndarray, low: np.ndarray, close: np.ndarray) -> np.ndarray:
+    """range of the candle extended to the previous close. The first candle has no previous one - it is high - low"""
+    high, low, close = (np.asarray(a, dtype=np.float64) for a in (high, low, close))
+    result = high - low
+    if len(close) > 1:
+        previous_close = close[:-1]
+        result[1:] = np.maximum(result[1:], np.maximum(
+            np.abs(high[1:] - previous_close), np.abs(low[1:] - previous_close)))
+    return result
+
+
+def atr_(high: np.ndarray, low: np.ndarray, close: np.ndarray, period: int = 14) -> np.ndarray:
+    """average true range, with Wilder smoothing. First "period - 1" elements are NaN"""
+    return wilder_smoothing_(true_range_(high, low, close), period)
+
+
+def rolling_std_(values: np.ndarray, period: int) -> np.ndarray:
+    """population standard deviation over a sliding window. First "period - 1" elements are NaN"""
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(len(values), np.nan)
+    if len(values) < period:
+        return result
+    # shifting by the mean keeps sums of squares small, which limits the cancellation error
+    centered = values - values.mean()
+    sums = np.concatenate(([0.], np.cumsum(centered)))
+    squares = np.concatenate(([0.], np.cumsum(centered * centered)))
+    window_sum = sums[period:] - sums[:-period]
+    window_squares = squares[period:] - squares[:-period]
+    variance = window_squares / period - (window_sum / period) ** 2
+    result[period - 1:] = np.sqrt(np.maximum(variance, 0.))
+    return result
+
+
+def bollinger_bands_(
+        close: np.ndarray, period: int = 20, deviations: float = 2.) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :return: (middle, upper, lower) bands - SMA of the close, moved up/down by a multiple of standard deviation
+    """
+    middle = sma_(close, period)
+    width = deviations * rolling_std_(close, period)
+    return middle, middle + width, middle - width
+
+
+def macd_(
+        close: np.ndarray, fast_period: int = 12, slow_period: int = 26,
+        signal_period: int = 9) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :return: (macd, signal, histogram) - difference of fast and slow EMA, its EMA, and the difference of both
+    """
+    macd = ema_(close, fast_period) - ema_(close, slow_period)
+    signal = np.full(len(macd), np.nan)
+    signal[slow_period - 1:] = ema_(macd[slow_period - 1:], signal_period)
+    return macd, signal, macd - signal
+
+
+def vwap_(
+        high: np.ndarray, low: np.ndarray, close: np.ndarray, volume: np.ndarray,
+        datetime: np.ndarray | None = None) -> np.ndarray:
+    """
+    volume weighted average (typical) price, accumulated from the start of each day
+
+    without timestamps the average is accumulated over entire data. Periods without any volume yet are NaN
+    """
+    high, low, close, volume = (np.asarray(a, dtype=np.float64) for a in (high, low, close, volume))
+    typical_price = (high + low + close) / 3.
+    traded = np.cumsum(typical_price * volume)
+    total_volume = np.cumsum(volume)
+    if datetime is not None and len(datetime):
+        days = np.asarray(datetime).astype('datetime64[D]')
+        day_start = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1])))
+        # subtract everything accumulated before the start of the day the element belongs to
+        starts = np.repeat(day_start, np.diff(np.concatenate((day_start, [len(days)]))))
+        traded_before = np.concatenate(([0.], traded))[starts]
+        volume_before = np.concatenate(([0.], total_volume))[starts]
+        traded, total_volume = traded - traded_before, total_volume - volume_before
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total_volume > 0, traded / total_volume, np.nan)
+
+
+# name of the indicator -> function and the columns of time series it consumes
+INDICATORS_ = {
+    "sma": (sma_, ("close",)),
+    "ema": (ema_, ("close",)),
+    "rsi": (rsi_, ("close",)),
+    "atr": (atr_, ("high", "low", "close")),
+    "bollinger_bands": (bollinger_bands_, ("close",)),
+    "macd": (macd_, ("close",)),
+    "vwap": (vwap_, ("high", "low", "close", "volume", "datetime")),
+}
+
+
+def calculate_indicator_(data: dict[str, np.ndarray], indicator: str, **params) -> np.ndarray | tuple:
+    """calculate indicator by its name, picking the columns it needs out of the time series data"""
+    if indicator not in INDICATORS_:
+        raise ValueError(f"unknown indicator: {indicator}. Possible indicators: {tuple(INDICATORS_)}")
+    function, columns = INDICATORS_[indicator]
+    missing = [column for column in columns if column not in data]
+    if missing:
+        raise ValueError(f"{indicator} needs columns that are missing in the data: {missing}")
+    return function(*(data[column] for column in columns), **params)
+
+
+if __name__ == '__main__':
+    # throughput check of every indicator over a few million rows of a random walk
+    from time import perf_counter
+
+    rows = 5_000_000
+    close_ = 100 + np.cumsum(np.random.normal(0, 0.1, rows))
+    spread = np.abs(np.random.normal(0, 0.05, (2, rows)))
+    data_ = {
+        "close": close_, "high": close_ + spread[0], "low": close_ - spread[1],
+        "volume": np.random.randint(100, 10000, rows).astype(np.float64),
+        "datetime": np.datetime64('2020-01-01T00:00') + np.arange(rows).astype('timedelta64[m]'),
+    }
+    params_ = {"sma": {"period": 20}, "ema": {"period": 20}}
+    for name in INDICATORS_:
+        start = perf_counter()
+        calculate_indicator_(data_, name, **params_.get(name, {}))
+        elapsed = perf_counter() - start
+        print(f"{name:>16}: {rows} rows in {elapsed:.3f}s -> {rows / elapsed / 1e6:.1f}M rows/s")
@@ -0,0 +1,193 @@
+from typing import Literal
+
+import numpy as np
+
+# width of every interval that can be derived from the 1 minute data, in minutes
+RESAMPLE_INTERVALS_ = {"5min": 5, "15min": 15, "1h": 60, "4h": 240, "1day": 1440}
+# break in quotes, longer than this (in minutes), starts a new trading session of the equity
+SESSION_GAP_ = 240
+
+OHLCV_ = dict[Literal['datetime', 'open', 'high', 'low', 'close', 'volume'], np.ndarray]
+_PRICE_FIELDS = ('open', 'high', 'low', 'close')
+
+
+def ohlcv_from_rows_(rows: list[tuple], is_equity: bool) -> OHLCV_:
+    """
+    turn rows fetched from a time series table - ("ID", datetime, open, close, high, low, [volume]) -
+    into the columnar form consumed by resampling and indicator functions
+    """
+    if not rows:
+        data = {"datetime": np.array([], dtype='datetime64[m]')}
+        data.update({field: np.array([], dtype=np.float64) for field in _PRICE_FIELDS})
+        if is_equity:
+            data["volume"] = np.array([], dtype=np.int64)
+        return data
+    columns = list(zip(*rows))
+    data = {
+        "datetime": np.array(columns[1], dtype='datetime64[m]'),
+        "open": np.array(columns[2], dtype=np.float64),
+        "close": np.array(columns[3], dtype=np.float64),
+        "high": np.array(columns[4], dtype=np.float64),
+        "low": np.array(columns[5], dtype=np.float64),
+    }
+    if is_equity:
+        data["volume"] = np.array(columns[6], dtype=np.int64)
+    return data
+
+
+def _bucket_starts(
+        minutes: np.ndarray, width: int, is_forex: bool, session_gap: int,
+        previous_minute: int | None = None, session_anchor: int | None = None) -> tuple[np.ndarray, int | None]:
+    """
+    assign every minute to the start of its bucket (as minutes since epoch)
+
+    forex trades around the clock, so its buckets are aligned to the clock (and days to UTC midnight).
+    Equity buckets are anchored to the first minute of the session they belong to - hourly candles
+    of a session opening at 9:30 start at 9:30, 10:30... - and never cross into the next session.
+    Previous minute and anchor allow to continue the session that has been started in earlier chunk of data.
+
+    :return: bucket starts and the anchor of the last session in the chunk
+    """
+    if is_forex:
+        return minutes - minutes % width, None
+
+    new_session = np.empty(len(minutes), dtype=bool)
+    new_session[1:] = np.diff(minutes) > session_gap
+    new_session[0] = previous_minute is None or session_anchor is None or \
+        minutes[0] - previous_minute > session_gap
+    session_index = np.cumsum(new_session) - 1
+    anchors = minutes[new_session]
+    if not new_session[0]:
+        anchors = np.concatenate(([session_anchor], anchors))
+        session_index += 1
+    minute_anchors = anchors[session_index]
+    if width >= 1440:
+        # the day of the session is the day it opened at
+        starts = minute_anchors - minute_anchors % 1440
+    else:
+        starts = minute_anchors + (minutes - minute_anchors) // width * width
+    return starts, int(anchors[-1])
+
+
+def _aggregate(data: OHLCV_, starts: np.ndarray) -> OHLCV_:
+    """fold minutes sharing the same bucket start into single candles"""
+    first = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+    last = np.concatenate((first[1:], [len(starts)])) - 1
+    bars = {
+        "datetime": starts[first].astype('datetime64[m]'),
+        "open": data["open"][first],
+        "high": np.maximum.reduceat(data["high"], first),
+        "low": np.minimum.reduceat(data["low"], first),
+        "close": data["close"][last],
+    }
+    if "volume" in data:
+        bars["volume"] = np.add.reduceat(data["volume"], first)
+    return bars
+
+
+def _check_interval(target_interval: str) -> int:
+    if target_interval not in RESAMPLE_INTERVALS_:
+        raise ValueError(
+            f"Improper argument for resampling. Possible intervals: {tuple(RESAMPLE_INTERVALS_)}")
+    return RESAMPLE_INTERVALS_[target_interval]
+
+
+def resample_ohlcv_(
+        data: OHLCV_, target_interval: str, is_forex: bool = False, session_gap: int = SESSION_GAP_) -> OHLCV_:
+    """
+    build candles of higher timeframe out of 1 minute data, sorted from the oldest to the newest minute
+
+    all the calculation is vectorized - cost does not depend on the number of buckets, only on number of minutes
+    """
+    width = _check_interval(target_interval)
+    if len(data["datetime"]) == 0:
+        return {key: value[:0] for key, value in data.items()}
+    minutes = data["datetime"].astype('datetime64[m]').astype(np.int64)
+    starts, _ = _bucket_starts(minutes, width, is_forex, session_gap)
+    return _aggregate(data, starts)
+
+
+class Resampler:
+    """
+    resample 1 minute data incrementally - chunk after chunk, as new minutes arrive
+
+    the last bucket is kept open, as long as it can still receive minutes. Completed candles
+    are returned by ``update`` only once, so only freshly arrived minutes are ever processed.
+    State can be exported to plain python values and restored in another run.
+    """
+
+    def __init__(self, target_interval: str, is_forex: bool = False, session_gap: int = SESSION_GAP_):
+        self.target_interval = target_interval
+        self.width = _check_interval(target_interval)
+        self.is_forex = is_forex
+        self.session_gap = session_gap
+        self.open_bar: dict | None = None
+        self._last_minute: int | None = None
+        self._session_anchor: int | None = None
+
+    def update(self, data: OHLCV_) -> OHLCV_:
+        """fold new minutes into the open candle, returning the candles that got completed on the way"""
+        has_volume = "volume" in data
+        if len(data["datetime"]) == 0:
+            return self._as_bars([], has_volume)
+        minutes = data["datetime"].astype('datetime64[m]').astype(np.int64)
+        if self._last_minute is not None and minutes[0] <= self._last_minute:
+            raise ValueError("minutes have to be newer than the ones folded into resampler so far")
+        starts, self._session_anchor = _bucket_starts(
+            minutes, self.width, self.is_forex, self.session_gap, self._last_minute, self._session_anchor)
+        self._last_minute = int(minutes[-1])
+        bars = _aggregate(data, starts)
+
+        completed_open_bar = []
+        if self.open_bar is not None:
+            if self.open_bar["start"] == int(bars["datetime"][0].astype(np.int64)):
+                # minutes of the open candle arrived - it continues in the first candle of the chunk
+                bars["open"][0] = self.open_bar["open"]
+                bars["high"][0] = max(bars["high"][0], self.open_bar["high"])
+                bars["low"][0] = min(bars["low"][0], self.open_bar["low"])
+                if has_volume:
+                    bars["volume"][0] += self.open_bar["volume"]
+            else:
+                completed_open_bar.append(self.open_bar)
+        self.open_bar = {"start": int(bars["datetime"][-1].astype(np.int64))}
+        for field in bars:
+            if field != "datetime":
+                self.open_bar[field] = bars[field][-1].item()
+
+        completed = {field: values[:-1] for field, values in bars.items()}
+        if completed_open_bar:
+            previous = self._as_bars(completed_open_bar, has_volume)
+            completed = {field: np.concatenate((previous[field], completed[field])) for field in completed}
+        return completed
+
+    def flush(self) -> OHLCV_:
+        """close the open candle (for example at the end of the data) and return it"""
+        bars = self._as_bars([self.open_bar] if self.open_bar else [], self._has_volume())
+        self.open_bar = None
+        return bars
+
+    def get_state(self) -> dict:
+        return {
+            "target_interval": self.target_interval, "is_forex": self.is_forex, "session_gap": self.session_gap,
+            "open_bar": self.open_bar, "last_minute": self._last_minute, "session_anchor": self._session_anchor,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "Resampler":
+        resampler = cls(state["target_interval"], state["is_forex"], state["session_gap"])
+        resampler.open_bar = state["open_bar"]
+        resampler._last_minute = state["last_minute"]
+        resampler._session_anchor = state["session_anchor"]
+        return resampler
+
+    def _has_volume(self) -> bool:
+        return self.open_bar is not None and "volume" in self.open_bar
+
+    @staticmethod
+    def _as_bars(bars: list[dict], has_volume: bool) -> OHLCV_:
+        result = {"datetime": np.array([bar["start"] for bar in bars], dtype=np.int64).astype('datetime64[m]')}
+        for field in _PRICE_FIELDS:
+            result[field] = np.array([bar[field] for bar in bars], dtype=np.float64)
+        if has_volume:
+            result["volume"] = np.array([bar["volume"] for bar in bars], dtype=np.int64)
+        return result
@@ -0,0 +1,241 @@
+from collections import deque
+from math import nan, isnan, sqrt
+
+# running sums of rolling windows are recalculated from scratch every this many windows, so float error can't pile up
+_ROLLING_RECALCULATION = 64
+
+
+def _to_json_float(value: float) -> float | None:
+    """NaN is not a valid JSON value - it is kept as null in the serialized state"""
+    return None if isnan(value) else value
+
+
+def _from_json_float(value: float | None) -> float:
+    return nan if value is None else value
+
+
+class EMAState:
+    """
+    exponential moving average advanced one value at a time - the same numbers as ``ema`` gives for entire data
+
+    average is seeded with the simple average of the first "period" values, until then the value is NaN
+    """
+    indicator = "ema"
+
+    def __init__(self, period: int, alpha: float | None = None, field: str = "close"):
+        self.period = period
+        self.alpha = 2. / (period + 1) if alpha is None else alpha
+        self.field = field
+        self.count = 0
+        self.value = nan
+        self._seed_sum = 0.
+
+    def update_value(self, value: float) -> float:
+        if self.count < self.period:
+            self._seed_sum += value
+            if self.count == self.period - 1:
+                self.value = self._seed_sum / self.period
+        else:
+            self.value = self.alpha * value + (1. - self.alpha) * self.value
+        self.count += 1
+        return self.value
+
+    def update(self, bar: dict) -> float:
+        return self.update_value(float(bar[self.field]))
+
+    def params(self) -> dict:
+        return {"period": self.period, "alpha": self.alpha, "field": self.field}
+
+    def get_state(self) -> dict:
+        return {"indicator": self.indicator, "params": self.params(), "count": self.count,
+                "value": _to_json_float(self.value), "seed_sum": self._seed_sum}
+
+    def _restore(self, state: dict):
+        self.count = state["count"]
+        self.value = _from_json_float(state["value"])
+        self._seed_sum = state["seed_sum"]
+
+
+class WilderState(EMAState):
+    """Wilder's moving average - an EMA with smoothing factor 1 / period"""
+    indicator = "wilder"
+
+    def __init__(self, period: int, field: str = "close"):
+        super().__init__(period, alpha=1. / period, field=field)
+
+    def params(self) -> dict:
+        return {"period": self.period, "field": self.field}
+
+
+class RSIState:
+    """relative strength index with Wilder smoothing, advanced one close price at a time"""
+    indicator = "rsi"
+
+    def __init__(self, period: int = 14):
+        self.period = period
+        self.previous_close: float | None = None
+        self.value = nan
+        self._gain = WilderState(period)
+        self._loss = WilderState(period)
+
+    def update(self, bar: dict) -> float:
+        close = float(bar["close"])
+        if self.previous_close is not None:
+            change = close - self.previous_close
+            gain = self._gain.update_value(max(change, 0.))
+            loss = self._loss.update_value(max(-change, 0.))
+            if not isnan(gain):
+                if loss == 0.:
+                    self.value = 50. if gain == 0. else 100.
+                else:
+                    self.value = 100. - 100. / (1. + gain / loss)
+        self.previous_close = close
+        return self.value
+
+    def params(self) -> dict:
+        return {"period": self.period}
+
+    def get_state(self) -> dict:
+        return {"indicator": self.indicator, "params": self.params(), "previous_close": self.previous_close,
+                "value": _to_json_float(self.value), "gain": self._gain.get_state(), "loss": self._loss.get_state()}
+
+    def _restore(self, state: dict):
+        self.previous_close = state["previous_close"]
+        self.value = _from_json_float(state["value"])
+        self._gain._restore(state["gain"])
+        self._loss._restore(state["loss"])
+
+
+class ATRState:
+    """average true range with Wilder smoothing, advanced one candle at a time"""
+    indicator = "atr"
+
+    def __init__(self, period: int = 14):
+        self.period = period
+        self.previous_close: float | None = None
+        self._true_range = WilderState(period)
+
+    @property
+    def value(self) -> float:
+        return self._true_range.value
+
+    def update(self, bar: dict) -> float:
+        high, low, close = float(bar["high"]), float(bar["low"]), float(bar["close"])
+        true_range = high - low
+        if self.previous_close is not None:
+            true_range = max(true_range, abs(high - self.previous_close), abs(low - self.previous_close))
+        self.previous_close = close
+        return self._true_range.update_value(true_range)
+
+    def params(self) -> dict:
+        return {"period": self.period}
+
+    def get_state(self) -> dict:
+        return {"indicator": self.indicator, "params": self.params(), "previous_close": self.previous_close,
+                "true_range": self._true_range.get_state()}
+
+    def _restore(self, state: dict):
+        self.previous_close = state["previous_close"]
+        self._true_range._restore(state["true_range"])
+
+
+class RollingWindowState:
+    """
+    sliding window of the last "period" values - its mean (SMA) and population standard deviation
+
+    window values are part of the state, so serialized size grows with the period, not with the data
+    """
+    indicator = "rolling_window"
+
+    def __init__(self, period: int, field: str = "close"):
+        self.period = period
+        self.field = field
+        self.window: deque[float] = deque(maxlen=period)
+        self._sum = 0.
+        self._squares = 0.
+        self._updates = 0
+
+    @property
+    def value(self) -> float:
+        """mean of the window (SMA), NaN until the window is full"""
+        if len(self.window) < self.period:
+            return nan
+        return self._sum / self.period
+
+    @property
+    def std(self) -> float:
+        if len(self.window) < self.period:
+            return nan
+        return sqrt(max(self._squares / self.period - (self._sum / self.period) ** 2, 0.))
+
+    def bollinger_bands(self, deviations: float = 2.) -> tuple[float, float, float]:
+        """(middle, upper, lower) bands of the current window"""
+        middle, width = self.value, deviations * self.std
+        return middle, middle + width, middle - width
+
+    def update_value(self, value: float) -> float:
+        if len(self.window) == self.period:
+            dropped = self.window[0]
+            self._sum -= dropped
+            self._squares -= dropped * dropped
+        self.window.append(value)
+        self._updates += 1
+        if self._updates % (_ROLLING_RECALCULATION * self.period) == 0:
+            self._sum = sum(self.window)
+            self._squares = sum(v * v for v in self.window)
+        else:
+            self._sum += value
+            self._squares += value * value
+        return self.value
+
+    def update(self, bar: dict) -> float:
+        return self.update_value(float(bar[self.field]))
+
+    def params(self) -> dict:
+        return {"period": self.period, "field": self.field}
+
+    def get_state(self) -> dict:
+        return {"indicator": self.indicator, "params": self.params(), "window": list(self.window),
+                "updates": self._updates}
+
+    def _restore(self, state: dict):
+        self.window.extend(state["window"])
+        self._sum = sum(self.window)
+        self._squares = sum(v * v for v in self.window)
+        self._updates = state["updates"]
+
+
+STREAMING_INDICATORS_ = {
+    state_class.indicator: state_class
+    for state_class in (EMAState, WilderState, RSIState, ATRState, RollingWindowState)
+}
+
+
+def indicator_state_from_dict_(state: dict):
+    """recreate indicator state object out of its serialized form (``get_state`` of any of the state classes)"""
+    if state.get("indicator") not in STREAMING_INDICATORS_:
+        raise ValueError(f"unknown indicator state: {state.get('indicator')}. "
+                         f"Possible indicators: {tuple(STREAMING_INDICATORS_)}")
+    indicator_state = STREAMING_INDICATORS_[state["indicator"]](**state["params"])
+    indicator_state._restore(state)
+    return indicator_state
+
+
+if __name__ == '__main__':
+    # cost of advancing a state by a single bar, including a JSON round trip of the state
+    from json import dumps, loads
+    from random import random
+    from time import perf_counter
+
+    bars_ = [{"high": 101 + random(), "low": 99 - random(), "close": 100 + random()} for _ in range(100_000)]
+    for state_ in (EMAState(20), RSIState(14), ATRState(14), RollingWindowState(20)):
+        start = perf_counter()
+        for bar_ in bars_:
+            state_.update(bar_)
+        elapsed = perf_counter() - start
+        start = perf_counter()
+        for _ in range(1000):
+            state_ = indicator_state_from_dict_(loads(dumps(state_.get_state())))
+        serialization = (perf_counter() - start) / 1000
+        print(f"{state_.indicator:>15}: {elapsed / len(bars_) * 1e6:.2f}us per bar, "
+              f"{serialization * 1e6:.1f}us per state round trip")
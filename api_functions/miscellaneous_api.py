@@ -1,8 +1,8 @@
 # from pprint import pprint
 import json
 from datetime import datetime
-from time import perf_counter, sleep
-from typing import Literal, Optional, MutableMapping
+from time import perf_counter, sleep, time
+from typing import Callable, Literal, Optional, MutableMapping
 from contextlib import suppress
 
 from api_functions.API_URLS import *
@@ -191,7 +191,8 @@ def get_all_indices_(
     return response_result['data']
 
 
-def api_key_switcher_(permitted_keys: Optional[list[str]] = None):
+def api_key_switcher_(
+        permitted_keys: Optional[list[str]] = None, credit_reserver: Optional[Callable[[str, int], bool]] = None):
     """
     Prepare a collection of usable API keys, and use them cyclically
 
@@ -202,8 +203,14 @@ def api_key_switcher_(permitted_keys: Optional[list[str]] = None):
     between many threads that way) by passing a list of keys that should be switched between.
     This way a function will switch only between the ones necessary for the process.
 
+    When many processes (or machines) share the same keys, pass a ``credit_reserver`` - a function that
+    atomically takes credits of the key from a shared ledger (see ``db_functions.api_credit_reserver``).
+    Key is yielded only after a successful reservation, and switcher waits for the next minute
+    when every permitted key has been exhausted.
+
     :param permitted_keys: list of keywords that are attached to keys that should be used by the program instance,
     for example ['regular1', 'rapid1']
+    :param credit_reserver: callable(key_name, credits) -> bool, reserving credits for a single request
     """
     # print([(n, k) for n, k in regular_api_keys.items()])
     keys_dict = {key_name: [key, False] for key_name, key in regular_api_keys.items()}
@@ -213,6 +220,16 @@ def api_key_switcher_(permitted_keys: Optional[list[str]] = None):
         permitted_keys = [key_name for key_name in keys_dict]
     elif not permitted_keys:
         raise KeyError("No api key passed to switcher. Did you forget to choose correct one?")
+    if credit_reserver is not None:
+        while True:
+            reserved_any = False
+            for key_name in permitted_keys:
+                if credit_reserver(key_name, 1):
+                    reserved_any = True
+                    yield key_name, keys_dict[key_name][0]
+            if not reserved_any:
+                # every key is out of credits in the current window - wait for the next minute to begin
+                sleep(60.05 - time() % 60)
     while True:
         start = perf_counter()
         for key_name in permitted_keys:
@@ -1,6 +1,6 @@
 from math import ceil
 from datetime import datetime
-from typing import Literal, Generator
+from typing import Callable, Literal, Generator
 
 from api_functions.miscellaneous_api import parse_get_response_
 from minor_modules import time_interval_sanitizer
@@ -203,7 +203,8 @@ def calculate_iterations_(
 @time_interval_sanitizer()
 def download_market_ticker_history_(
         symbol: str, key_switcher: Generator, time_interval=None, mic_code=None,
-        exchange=None, currency=None, verbose=False, start_date: datetime = None, end_date: datetime = None):
+        exchange=None, currency=None, verbose=False, start_date: datetime = None, end_date: datetime = None,
+        page_callback: Callable[[list[dict]], None] | None = None):
     """
     Automates the process of downloading entire history of the index, from the TwelveData provider
     queries until the last datapoint/timestamp has been reached, which it checks separately in a different API query
@@ -221,6 +222,8 @@ def download_market_ticker_history_(
     :param start_date: historically the farthest point of interest, default to "earliest timestamp" if not passed
     :param end_date: historically the latest point of interest, default 'today' if not passed
     :param verbose: print information about download progress
+    :param page_callback: called with the new rows of every page as soon as it is downloaded (newest rows first),
+        for example to keep them in a local log before they reach the database
     """
 
     start_date, end_date = preprocess_dates_(start_date, end_date)
@@ -294,6 +297,8 @@ def download_market_ticker_history_(
             conversion_string = '%Y-%m-%d'
         new_latest_time_period = datetime.strptime(last_record['datetime'], conversion_string)
         full_time_series.extend(partial_data['values'][1:])
+        if page_callback is not None:
+            page_callback(partial_data['values'] if j == 0 else partial_data['values'][1:])
 
         if verbose:
             print("downloaded rows", len(partial_data['values']))
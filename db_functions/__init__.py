@@ -8,6 +8,20 @@ import db_functions.time_series_db as time_series_db
 import db_functions.sql_loader as sql_loader
 import db_functions.db_helpers as db_helpers
 import db_functions.db_views as db_views
+import db_functions.api_credits_db as api_credits_db
+import db_functions.download_jobs_db as download_jobs_db
+import db_functions.indicator_states_db as indicator_states_db
+import db_functions.partitioned_db as partitioned_db
+import db_functions.series_catalog_db as series_catalog_db
+import db_functions.db_instrumentation as db_instrumentation
+import db_functions.maintenance_db as maintenance_db
+import db_functions.instrument_search_db as instrument_search_db
+import db_functions.reference_sync_db as reference_sync_db
+import db_functions.series_quality_db as series_quality_db
+import db_functions.shards_db as shards_db
+import db_functions.ingest_log_db as ingest_log_db
+import db_functions.archive_db as archive_db
+import db_functions.backfill_db as backfill_db
 
 
 insert_currencies: Callable = forex_db.insert_currencies_
@@ -40,11 +54,107 @@ fetch_datapoint_by_date: Callable = time_series_db.fetch_datapoint_by_date_
 fetch_ID_closest_to_date_: Callable = time_series_db.fetch_ID_closest_to_date_
 calculate_fetch_time_bracket: Callable = time_series_db.calculate_fetch_time_bracket_
 fetch_data_by_dates: Callable = time_series_db.fetch_data_by_dates_
+fetch_data_by_bracket: Callable[..., list] = time_series_db.fetch_data_by_bracket_
 resolve_time_series_location: Callable = time_series_db.resolve_time_series_location_
+fetch_time_series_arrays: Callable[..., dict] = time_series_db.fetch_time_series_arrays_
+fetch_time_series_panel: Callable[..., dict] = time_series_db.fetch_time_series_panel_
+PANEL_MISSING_POLICIES: tuple = time_series_db.PANEL_MISSING_POLICIES_
+fetch_price_scale: Callable[..., int | None] = time_series_db.fetch_price_scale_
+encode_fixed_point_price: Callable[..., int] = time_series_db.encode_fixed_point_price_
 
 create_time_series_view: Callable[[str, str, str | None], None] = db_views.create_time_series_view_
 list_nonstandard_views: Callable[[], tuple] = db_views.list_nonstandard_views_
 view_exists: Callable[[str], bool] = db_views.view_exists_
+ROLLUP_BUCKETS: dict[str, tuple] = db_views.ROLLUP_BUCKETS_
+create_time_series_rollups: Callable = db_views.create_time_series_rollups_
+refresh_reference_views: Callable = db_views.refresh_reference_views_
+REFERENCE_VIEWS: tuple = db_views.REFERENCE_VIEWS_
+refresh_time_series_rollups: Callable[..., int] = db_views.refresh_time_series_rollups_
+fetch_time_series_rollup: Callable[..., list] = db_views.fetch_time_series_rollup_
+fetch_downsampled_time_series: Callable[..., list] = db_views.fetch_downsampled_time_series_
+DOWNSAMPLE_MAX_BUCKETS: int = db_views.DOWNSAMPLE_MAX_BUCKETS_
+
+reserve_api_credits: Callable[..., bool] = api_credits_db.reserve_api_credits_
+api_credit_reserver: Callable[..., Callable[[str, int], bool]] = api_credits_db.api_credit_reserver_
+fetch_api_credit_usage: Callable[..., list] = api_credits_db.fetch_api_credit_usage_
+purge_api_credit_ledger: Callable = api_credits_db.purge_api_credit_ledger_
+
+enqueue_download_job: Callable[..., int] = download_jobs_db.enqueue_download_job_
+enqueue_tracked_download_jobs: Callable[..., list] = download_jobs_db.enqueue_tracked_download_jobs_
+claim_download_job: Callable[..., tuple | None] = download_jobs_db.claim_download_job_
+extend_download_job_lease: Callable[..., bool] = download_jobs_db.extend_download_job_lease_
+complete_download_job: Callable[[int, str], bool] = download_jobs_db.complete_download_job_
+fail_download_job: Callable[[int, str, str], str | None] = download_jobs_db.fail_download_job_
+fetch_download_jobs: Callable[..., list] = download_jobs_db.fetch_download_jobs_
+
+save_indicator_state: Callable = indicator_states_db.save_indicator_state_
+fetch_indicator_states: Callable[..., dict] = indicator_states_db.fetch_indicator_states_
+drop_indicator_states: Callable = indicator_states_db.drop_indicator_states_
+
+register_partitioned_series: Callable[..., int] = partitioned_db.register_partitioned_series_
+partitioned_series_ID: Callable[..., int | None] = partitioned_db.partitioned_series_ID_
+insert_partitioned_data: Callable = partitioned_db.insert_partitioned_data_
+fetch_partitioned_data: Callable[..., list] = partitioned_db.fetch_partitioned_data_
+fetch_partitioned_snapshot: Callable[..., list] = partitioned_db.fetch_partitioned_snapshot_
+migrate_time_series_to_partitioned: Callable[..., int] = partitioned_db.migrate_time_series_to_partitioned_
+migrate_all_time_series_to_partitioned: Callable[..., dict] = partitioned_db.migrate_all_time_series_to_partitioned_
+
+attach_series_catalog: Callable = series_catalog_db.attach_series_catalog_
+attach_all_series_catalog: Callable[..., int] = series_catalog_db.attach_all_series_catalog_
+refresh_series_catalog: Callable = series_catalog_db.refresh_series_catalog_
+fetch_series_catalog: Callable[..., list] = series_catalog_db.fetch_series_catalog_
+delete_series_catalog: Callable = series_catalog_db.delete_series_catalog_
+list_series_tables: Callable[[], list] = series_catalog_db.list_series_tables_
+
+query_statistics: Callable[..., dict] = db_instrumentation.query_statistics_
+reset_query_statistics: Callable = db_instrumentation.reset_query_statistics_
+dump_query_statistics: Callable = db_instrumentation.dump_query_statistics_
+start_query_statistics_dump: Callable = db_instrumentation.start_query_statistics_dump_
+stop_query_statistics_dump: Callable = db_instrumentation.stop_query_statistics_dump_
+query_template: Callable[[str], str] = db_instrumentation.query_template_
+
+maintain_table: Callable[..., bool] = maintenance_db.maintain_table_
+record_rows_written: Callable[..., bool] = maintenance_db.record_rows_written_
+track_ingestion: Callable = maintenance_db.track_ingestion_
+wait_for_maintenance: Callable[..., bool] = maintenance_db.wait_for_maintenance_
+maintenance_statistics: Callable[[], dict] = maintenance_db.maintenance_statistics_
+
+create_trigram_indexes: Callable[[], bool] = instrument_search_db.create_trigram_indexes_
+drop_trigram_indexes: Callable = instrument_search_db.drop_trigram_indexes_
+InstrumentIndex: type = instrument_search_db.InstrumentIndex_
+load_instrument_index: Callable[[str], InstrumentIndex] = instrument_search_db.load_instrument_index_
+instrument_index: Callable[[str], InstrumentIndex] = instrument_search_db.instrument_index_
+search_instruments: Callable[..., list] = instrument_search_db.search_instruments_
+INSTRUMENT_VIEWS: dict[str, tuple] = instrument_search_db.INSTRUMENT_VIEWS_
+
+sync_forex_pairs: Callable[..., dict] = reference_sync_db.sync_forex_pairs_
+sync_markets: Callable[..., dict] = reference_sync_db.sync_markets_
+sync_stocks: Callable[..., dict] = reference_sync_db.sync_stocks_
+sync_reference_data: Callable[..., dict] = reference_sync_db.sync_reference_data_
+
+check_series_quality: Callable[..., dict] = series_quality_db.check_series_quality_
+scan_series_quality: Callable[[str, str], dict] = series_quality_db.scan_series_quality_
+scan_archive_quality: Callable[..., dict] = series_quality_db.scan_archive_quality_
+fetch_quality_report: Callable[..., list] = series_quality_db.fetch_quality_report_
+QUALITY_CHECKS: tuple[str, ...] = series_quality_db.QUALITY_CHECKS_
+
+misplaced_series: Callable[[], list] = shards_db.misplaced_series_
+move_series: Callable[[str, str, int, int], int] = shards_db.move_series_
+rebalance_shards: Callable[..., list] = shards_db.rebalance_shards_
+
+logged_download: Callable = ingest_log_db.logged_download_
+drain_ingest_log: Callable[..., dict] = ingest_log_db.drain_ingest_log_
+start_ingest_drainer: Callable = ingest_log_db.start_ingest_drainer_
+stop_ingest_drainer: Callable = ingest_log_db.stop_ingest_drainer_
+pending_ingest_log: Callable[[], dict] = ingest_log_db.pending_ingest_log_
+read_ingest_segment: Callable[[str], list] = ingest_log_db.read_segment_
+
+backfill_time_series: Callable[..., int] = backfill_db.backfill_time_series_
+
+export_archive: Callable[..., dict] = archive_db.export_archive_
+restore_archive: Callable[..., dict] = archive_db.restore_archive_
+verify_archive: Callable[[str], list] = archive_db.verify_archive_
+read_archive_manifest: Callable[[str], dict] = archive_db.read_archive_manifest_
 
 purge_db_structure: Callable = sql_loader.purge_db_structure_
 import_db_structure: Callable = sql_loader.import_db_structure_
@@ -56,6 +166,16 @@ fetch_generic_last_ID: Callable[[str, str], int] = db_helpers.fetch_generic_last
 fetch_generic_range_by_IDs: Callable[[str, str], list] = db_helpers.fetch_generic_range_by_IDs_
 is_equity: Callable[[str], bool] = db_helpers.is_equity_
 is_forex_pair: Callable[[str], bool] = db_helpers.is_forex_pair_
+pooled_connection: Callable = db_helpers.pooled_connection_
+pooled_transaction: Callable = db_helpers.pooled_transaction_
+shard_count: Callable[[], int] = db_helpers.shard_count_
+shard_of: Callable[[str, str], int] = db_helpers.shard_of_
+execute_prepared: Callable = db_helpers.execute_prepared_
+close_connection_pool: Callable = db_helpers.close_connection_pool_
+invalidate_symbol_registry: Callable = db_helpers.invalidate_symbol_registry_
+symbol_registry_generation: Callable[[], int] = db_helpers.symbol_registry_generation_
+symbol_registry_statistics: Callable[[], dict] = db_helpers.symbol_registry_statistics_
+reset_symbol_registry_statistics: Callable = db_helpers.reset_symbol_registry_statistics_
 TimeSeriesNotFoundError: type[Exception] = db_helpers.TimeSeriesNotFoundError_
 TimeSeriesExistsError: type[Exception] = db_helpers.TimeSeriesExistsError_
 DataNotPresentError: type[Exception] = db_helpers.DataNotPresentError_
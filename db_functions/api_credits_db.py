@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+from typing import Callable
+
+import psycopg2
+
+from db_functions.db_helpers import _connection_dict, db_string_converter_
+
+
+# free tier limits of a single TwelveData key (see README)
+MINUTE_CREDIT_LIMIT_ = 8
+DAILY_CREDIT_LIMIT_ = 800
+
+# reservation queries
+_query_reserve_api_credits = "select public.reserve_api_credits({key_name}, {credits}, {minute_limit}, {daily_limit});"
+
+# select queries
+_query_fetch_api_credit_usage = """
+SELECT ledger.key_name, ledger.window_type, ledger.window_start, ledger.credits_used
+FROM "public".api_credit_ledger ledger
+WHERE ledger.window_start >= TIMESTAMP '{since}' {optional_filter}
+ORDER BY ledger.key_name, ledger.window_type, ledger.window_start;
+"""
+
+# delete queries
+_query_purge_api_credit_ledger = """
+DELETE FROM "public".api_credit_ledger ledger WHERE ledger.window_start < TIMESTAMP '{older_than}' {optional_filter};
+"""
+
+
+def reserve_api_credits_(
+        key_name: str, credits: int = 1, minute_limit: int = MINUTE_CREDIT_LIMIT_,
+        daily_limit: int = DAILY_CREDIT_LIMIT_, connection=None) -> bool:
+    """
+    atomically take credits of a given key from the shared ledger, for the current minute and day windows
+
+    windows are calculated by the database clock, so every process and machine using the same database
+    agrees on them. Returns False when either window would be exceeded - nothing is reserved then.
+
+    :param connection: already opened connection (in autocommit mode) to skip connecting on every call
+    """
+    query = _query_reserve_api_credits.format(
+        key_name=db_string_converter_(key_name), credits=int(credits),
+        minute_limit=int(minute_limit), daily_limit=int(daily_limit),
+    )
+    if connection is not None:
+        cur = connection.cursor()
+        cur.execute(query)
+        return cur.fetchone()[0]
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(query)
+        res = cur.fetchall()
+    return res[0][0]
+
+
+def api_credit_reserver_(
+        minute_limit: int = MINUTE_CREDIT_LIMIT_, daily_limit: int = DAILY_CREDIT_LIMIT_) -> Callable[[str, int], bool]:
+    """
+    prepare a reservation function bound to a single, long-living connection
+
+    this is the form that ``api_key_switcher`` consumes - it keeps the per-request overhead down to one
+    round trip to the database, instead of connecting for every downloaded page
+    """
+    conn = psycopg2.connect(**_connection_dict)
+    conn.autocommit = True
+
+    def reserve(key_name: str, credits: int = 1) -> bool:
+        return reserve_api_credits_(key_name, credits, minute_limit, daily_limit, connection=conn)
+
+    return reserve
+
+
+def fetch_api_credit_usage_(key_name: str | None = None, since: datetime | None = None) -> list[tuple]:
+    """
+    Obtain the ledger rows for all (or one) of the keys - defaults to the rows of the current UTC day
+
+    every row is (key_name, window_type, window_start, credits_used), where window type is "minute" or "day"
+    """
+    if key_name == "":
+        raise ValueError('empty values passed as "" are not valid for the query')
+    if since is None:
+        now = datetime.utcnow()
+        since = datetime(year=now.year, month=now.month, day=now.day)
+    optional_filter = f"AND ledger.key_name = {db_string_converter_(key_name)}" if key_name else ""
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_fetch_api_credit_usage.format(since=since, optional_filter=optional_filter))
+        res = cur.fetchall()
+    return res
+
+
+def purge_api_credit_ledger_(older_than: timedelta = timedelta(days=2), key_name: str | None = None):
+    """remove ledger windows that are no longer relevant for any limit (optionally only for a single key)"""
+    optional_filter = f"AND ledger.key_name = {db_string_converter_(key_name)}" if key_name else ""
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_purge_api_credit_ledger.format(
+            older_than=datetime.utcnow() - older_than, optional_filter=optional_filter))
+
+
+if __name__ == '__main__':
+    # quick throughput check of the reservation round trip
+    from time import perf_counter
+
+    reserve_ = api_credit_reserver_(minute_limit=10 ** 9, daily_limit=10 ** 9)
+    reservations = 5000
+    start = perf_counter()
+    for _ in range(reservations):
+        reserve_("benchmark_key")
+    elapsed = perf_counter() - start
+    print(f"{reservations} reservations in {elapsed:.3f}s -> {reservations / elapsed:.0f} reservations/s")
+    purge_api_credit_ledger_(older_than=-timedelta(minutes=1), key_name="benchmark_key")
@@ -1,5 +1,19 @@
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from itertools import count
+from weakref import WeakKeyDictionary
+
 import psycopg2
+from psycopg2 import sql
+from psycopg2.errors import FeatureNotSupported
+from psycopg2.pool import ThreadedConnectionPool
+
 import settings
+from db_functions.db_instrumentation import InstrumentedCursor, register_prepared_template_
 
 
 # helper queries
@@ -7,10 +21,26 @@ _information_schema = "select * from information_schema.\"tables\" where table_s
 _information_schema2 = "select * from information_schema.\"columns\" where table_schema LIKE 'public';"
 _table_rows_quantity = "select count(*) from \"{schema}\".\"{table_name}\";"
 _query_get_last_row_ID = "select \"ID\" from \"{schema}\".\"{table_name}\" tab order by tab.\"ID\" DESC LIMIT 1;"
+_prepared_catalog_last_row_ID = sql.SQL("""
+SELECT catalog."last_ID" FROM "public".series_catalog catalog
+WHERE catalog.schema_name = $1 AND catalog.table_name = $2 AND catalog."last_ID" IS NOT NULL
+""")
 _query_get_point_by_ID = "SELECT * FROM \"{schema_name}\".\"{table_name}\" series WHERE series.\"ID\" = {id_}"
 _query_get_data_by_IDs = """SELECT * FROM \"{schema_name}\".\"{table_name}\" tab WHERE {start_id} AND {end_id};"""
-_exist_in_stocks = "select public.check_is_stock('{symbol}')"
-_exist_in_forex_pairs = "select public.check_is_forex_pair('{symbol}')"
+_query_get_price_scale = """
+SELECT scales.price_scale FROM "public".price_scales scales
+WHERE scales.schema_name = {schema_name} AND scales.table_name = {table_name};
+"""
+_prepared_exist_in_stocks = sql.SQL("select public.check_is_stock($1)")
+_prepared_exist_in_forex_pairs = sql.SQL("select public.check_is_forex_pair($1)")
+
+# registry queries
+_query_registry_stocks = "select distinct stocks.symbol from \"public\".stocks stocks;"
+_query_registry_forex_pairs = "select pairs.symbol from \"public\".forex_pairs pairs;"
+_query_registry_series_tables = """
+SELECT tab.table_schema, tab.table_name FROM information_schema."tables" tab
+WHERE tab.table_schema IN ('1min_time_series', '1day_time_series', 'forex_time_series');
+"""
 _delete_single_based_on_ID = "DELETE FROM \"{schema_name}\".\"{table_name}\" tab WHERE tab.\"ID\" = {index};"
 
 _information_schema_table_check = """
@@ -22,13 +52,60 @@ _information_schema_check = "select schema_name from \"information_schema\".sche
 # Following are selects that use intermediate helper views for simplicity. These are defined in schema_dump.sql
 _information_schema_function_check = "select * from \"public\".non_standard_functions;"
 
-# connection dict
+# connection dict - its cursors record query statistics (see db_instrumentation)
 _connection_dict = {
     "database": settings.DB_NAME,
     "password": settings.DB_PASSWORD,
-    "user": settings.DB_USER
+    "user": settings.DB_USER,
+    "cursor_factory": InstrumentedCursor,
 }
 
+# schemas of the time series tables - the only tables that are spread over the shards
+SERIES_SCHEMAS_ = ("1min_time_series", "1day_time_series", "forex_time_series")
+
+
+def _shard_connection_dict(shard: str | dict) -> dict:
+    """
+    connection dict of a shard listed in the settings, as a DSN or as keywords of psycopg2.connect -
+    the main database listed among the shards is _connection_dict itself
+    """
+    connection_dict = {"dsn": shard} if isinstance(shard, str) else dict(shard)
+    connection_dict["cursor_factory"] = InstrumentedCursor
+    return _connection_dict if connection_dict == _connection_dict else connection_dict
+
+
+# series tables can be spread over several databases - settings.DB_SHARDS lists their connections. Reference data
+# (stocks, markets...) stays in the database of _connection_dict, which is the only shard when none are listed.
+# Every shard keeps the whole structure, a series keeps its price scale, catalog entry, indicator states
+# and rollups next to its table
+_shard_connection_dicts: list[dict] = [
+    _shard_connection_dict(shard) for shard in getattr(settings, "DB_SHARDS", None) or []] or [_connection_dict]
+
+# connections borrowed by the hot query paths are kept open, so statements prepared on them can be reused
+POOL_MAX_CONNECTIONS_ = 8
+# database (None for the one of _connection_dict, shard number otherwise) -> pool of its connections and the slots
+# ThreadedConnectionPool raises when it is exhausted, threads above the limit wait for a connection instead
+_connection_pools: dict[int | None, tuple[ThreadedConnectionPool, threading.BoundedSemaphore]] = {}
+_connection_pool_pid: int | None = None
+_connection_pool_lock = threading.Lock()
+# connection -> text of the prepared query -> (name of the server-side statement, text executing it)
+_prepared_statements: WeakKeyDictionary = WeakKeyDictionary()
+# text of the prepared query -> name of its statement, the same on every connection - names (and the templates
+# registered for them) grow with the queries, not with the connections preparing them
+_statement_names: dict[str, str] = {}
+_statement_numbers = count()
+
+# in-process copy of known symbols and series tables, used to resolve time series location without a query.
+# Symbols and tables added by other processes are picked up after a reload - unknown symbol reloads the registry
+# (at most once every REGISTRY_RELOAD_INTERVAL_ seconds), and every reload is dropped after REGISTRY_TTL_ seconds
+REGISTRY_TTL_ = 600.
+REGISTRY_RELOAD_INTERVAL_ = 1.
+_registry_lock = threading.Lock()
+_registry: dict = {"stocks": None, "forex_pairs": None, "series_tables": None, "loaded_at": None}
+_registry_statistics: dict[str, int] = {"hits": 0, "misses": 0, "loads": 0}
+# grows with every invalidation - caches built out of the symbols tell by it that they are out of date
+_registry_generation = 0
+
 
 # helper errors
 class TimeSeriesNotFoundError_(Exception):
@@ -57,27 +134,281 @@ def db_string_converter_(string: str):
     return to_send
 
 
+def shard_count_() -> int:
+    return len(_shard_connection_dicts)
+
+
+def shard_of_(schema_name: str, table_name: str) -> int:
+    """
+    shard keeping the series table - decided by the hash of the schema and the table name (symbol and MIC code,
+    or pair and interval), so every process places the series the same way without asking any database
+    """
+    if len(_shard_connection_dicts) == 1:
+        return 0
+    digest = hashlib.blake2b(f"{schema_name}.{table_name}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % len(_shard_connection_dicts)
+
+
+def shard_connection_dict_(schema_name: str, table_name: str | None = None) -> dict:
+    """
+    connection dict of the database keeping the table - the owning shard for the series tables,
+    the database of _connection_dict for everything else
+    """
+    if schema_name not in SERIES_SCHEMAS_ or table_name is None:
+        return _connection_dict
+    return _shard_connection_dicts[shard_of_(schema_name, table_name)]
+
+
+@contextmanager
+def pooled_connection_(shard: int | None = None):
+    """
+    borrow a connection (in autocommit mode) from the pool shared by the threads of the process
+
+    connections are not closed after use, so statements prepared by ``execute_prepared_`` on them
+    outlive a single call. Broken connections are discarded instead of being returned to the pool.
+    When every connection is taken, the thread waits for one to be returned
+
+    :param shard: number of the shard to connect to (see ``shard_of_``), the database of _connection_dict by default
+    """
+    global _connection_pool_pid
+    connection_dict = _connection_dict if shard is None else _shard_connection_dicts[shard]
+    # single database is not pooled twice
+    key = None if connection_dict is _connection_dict else shard
+    with _connection_pool_lock:
+        # connections can't be shared with the forked processes, every process opens its own
+        if _connection_pool_pid != os.getpid():
+            _connection_pools.clear()
+            _connection_pool_pid = os.getpid()
+        if key not in _connection_pools:
+            _connection_pools[key] = (
+                ThreadedConnectionPool(1, POOL_MAX_CONNECTIONS_, **connection_dict),
+                threading.BoundedSemaphore(POOL_MAX_CONNECTIONS_))
+        pool, slots = _connection_pools[key]
+    with slots:
+        conn = pool.getconn()
+        try:
+            conn.autocommit = True
+            yield conn
+        finally:
+            if pool.closed:  # pool was closed by another thread in the meantime
+                conn.close()
+            else:
+                pool.putconn(conn, close=bool(conn.closed))
+
+
+@contextmanager
+def pooled_transaction_(shard: int | None = None):
+    """
+    borrow a pooled connection (see ``pooled_connection_``) for a single transaction - committed when the block
+    ends, rolled back if it raises. Statements prepared in it are kept by the connection for the next borrower
+    """
+    with pooled_connection_(shard) as conn:
+        conn.autocommit = False
+        with conn:
+            yield conn
+
+
+def close_connection_pool_():
+    """close every pooled connection, together with statements prepared on them (used when db is purged)"""
+    with _connection_pool_lock:
+        if _connection_pool_pid == os.getpid():
+            for pool, _ in _connection_pools.values():
+                pool.closeall()
+        _connection_pools.clear()
+
+
+def execute_prepared_(cursor, query: sql.Composable, params: tuple | list = ()):
+    """
+    execute query as a server-side prepared statement, preparing it first if the connection has not seen it yet
+
+    query uses $1, $2... placeholders (types are inferred by the database) and ``sql.Identifier`` for the
+    schema and table names, so each table gets its own statement. Values are sent with EXECUTE and are parsed
+    as literals, but the statement is not parsed or planned again.
+    """
+    connection = cursor.connection
+    statements = _prepared_statements.setdefault(connection, {})
+    query_text = query.as_string(cursor)
+    prepared_now = query_text not in statements
+    if prepared_now:
+        name = _statement_names.get(query_text)
+        if name is None:
+            name = _statement_names.setdefault(query_text, f"mtv_statement_{next(_statement_numbers)}")
+            register_prepared_template_(name, query_text)
+        cursor.execute(f"PREPARE {name} AS {query_text}")
+        # EXECUTE text is kept as well - composing it again on every call costs more than the execution itself
+        arguments = f" ({', '.join(['%s'] * len(params))})" if params else ""
+        statements[query_text] = (name, f"EXECUTE {name}{arguments}")
+    try:
+        cursor.execute(statements[query_text][1], params)
+    except FeatureNotSupported:
+        # table was recreated with different columns - the cached plan can't change its result type
+        if prepared_now or not connection.autocommit:
+            raise
+        cursor.execute(f"DEALLOCATE {statements.pop(query_text)[0]}")
+        execute_prepared_(cursor, query, params)
+
+
+def _load_symbol_registry():
+    """read the symbols and series tables into the registry. Caller holds the registry lock"""
+    with pooled_connection_() as conn:
+        cur = conn.cursor()
+        cur.execute(_query_registry_stocks)
+        stocks = {r[0] for r in cur.fetchall()}
+        cur.execute(_query_registry_forex_pairs)
+        forex_pairs = {r[0] for r in cur.fetchall()}
+    series_tables = set()
+    for shard in range(len(_shard_connection_dicts)):
+        with pooled_connection_(shard) as conn:
+            cur = conn.cursor()
+            cur.execute(_query_registry_series_tables)
+            # tables waiting for a rebalance are not where the lookups go, they are not known until moved
+            series_tables.update(table for table in cur.fetchall() if shard_of_(*table) == shard)
+    _registry.update(
+        stocks=stocks, forex_pairs=forex_pairs, series_tables=series_tables, loaded_at=time.monotonic())
+    _registry_statistics["loads"] += 1
+
+
+def _registry_symbol_kind(symbol: str) -> tuple[bool, bool]:
+    """(is stock, is forex pair) of the symbol, answered by the registry (loaded or reloaded when needed)"""
+    with _registry_lock:
+        loaded_at = _registry["loaded_at"]
+        if loaded_at is None or time.monotonic() - loaded_at > REGISTRY_TTL_:
+            _registry_statistics["misses"] += 1
+            _load_symbol_registry()
+        elif symbol in _registry["stocks"] or symbol in _registry["forex_pairs"]:
+            _registry_statistics["hits"] += 1
+        elif time.monotonic() - loaded_at > REGISTRY_RELOAD_INTERVAL_:
+            # symbol might have been inserted by another process since the last load
+            _registry_statistics["misses"] += 1
+            _load_symbol_registry()
+        else:
+            _registry_statistics["hits"] += 1
+        return symbol in _registry["stocks"], symbol in _registry["forex_pairs"]
+
+
+def invalidate_symbol_registry_():
+    """forget every symbol and table kept in the registry, next lookup loads it again"""
+    global _registry_generation
+    with _registry_lock:
+        _registry.update(stocks=None, forex_pairs=None, series_tables=None, loaded_at=None)
+        _registry_generation += 1
+
+
+def symbol_registry_generation_() -> int:
+    """number of registry invalidations so far"""
+    return _registry_generation
+
+
+def registry_series_table_exists_(schema_name: str, table_name: str) -> bool:
+    """
+    check if time series table exists, with the registry answering for the tables that are known to exist
+
+    tables missing from the registry are always looked up in the database (and kept, if they turn up)
+    """
+    with _registry_lock:
+        if _registry["loaded_at"] is not None and (schema_name, table_name) in _registry["series_tables"]:
+            _registry_statistics["hits"] += 1
+            return True
+        _registry_statistics["misses"] += 1
+    with pooled_connection_(shard_of_(schema_name, table_name)) as conn:
+        cur = conn.cursor()
+        cur.execute(_information_schema_table_check.format(
+            table_name=db_string_converter_(table_name), schema=db_string_converter_(schema_name)))
+        exists = bool(cur.fetchall())
+    with _registry_lock:
+        if exists and _registry["loaded_at"] is not None:
+            _registry["series_tables"].add((schema_name, table_name))
+    return exists
+
+
+def forget_series_table_(schema_name: str, table_name: str):
+    """drop the table from the registry - called whenever a series table is removed or about to be replaced"""
+    with _registry_lock:
+        if _registry["loaded_at"] is not None:
+            _registry["series_tables"].discard((schema_name, table_name))
+
+
+def symbol_registry_statistics_() -> dict:
+    """lookups answered by the registry (hits), lookups that had to query the database (misses) and registry loads"""
+    with _registry_lock:
+        lookups = _registry_statistics["hits"] + _registry_statistics["misses"]
+        return {
+            **_registry_statistics,
+            "hit_ratio": _registry_statistics["hits"] / lookups if lookups else None,
+            "stocks": len(_registry["stocks"]) if _registry["loaded_at"] is not None else None,
+            "forex_pairs": len(_registry["forex_pairs"]) if _registry["loaded_at"] is not None else None,
+            "series_tables": len(_registry["series_tables"]) if _registry["loaded_at"] is not None else None,
+        }
+
+
+def reset_symbol_registry_statistics_():
+    with _registry_lock:
+        _registry_statistics.update(hits=0, misses=0, loads=0)
+
+
 def fetch_generic_last_ID_(schema_name: str, table_name: str) -> int:
-    """obtain the last rows ID form a specified table"""
-    with psycopg2.connect(**_connection_dict) as conn:
+    """obtain the last rows ID form a specified table (time series answer from the series catalog)"""
+    with pooled_connection_(shard_of_(schema_name, table_name) if schema_name in SERIES_SCHEMAS_ else None) as conn:
         cur = conn.cursor()
-        cur.execute(_query_get_last_row_ID.format(schema=schema_name, table_name=table_name))
+        execute_prepared_(cur, _prepared_catalog_last_row_ID, (schema_name, table_name))
         res = cur.fetchall()
+        if not res:
+            cur.execute(_query_get_last_row_ID.format(schema=schema_name, table_name=table_name))
+            res = cur.fetchall()
     return res[0][0]
 
 
+def fetch_price_scale_(schema_name: str, table_name: str, cursor=None) -> int | None:
+    """
+    number of decimal places kept by a series with fixed-point prices, None for series with numeric prices
+
+    :param cursor: cursor of an already opened connection, to skip connecting just for this lookup
+    """
+    query = _query_get_price_scale.format(
+        schema_name=db_string_converter_(schema_name), table_name=db_string_converter_(table_name))
+    if cursor is not None:
+        cursor.execute(query)
+        res = cursor.fetchall()
+    else:
+        with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+            cur = conn.cursor()
+            cur.execute(query)
+            res = cur.fetchall()
+    return res[0][0] if res else None
+
+
+def decode_fixed_point_rows_(rows: list[tuple], price_scale: int | None, first_price: int = 2) -> list[tuple]:
+    """
+    prices of rows read from a fixed-point series as Decimals, the way rows of numeric series have them
+
+    :param first_price: column of the "open" price, followed by close, high and low
+    """
+    if price_scale is None:
+        return rows
+    decoded = []
+    for row in rows:
+        row = list(row)
+        for index in range(first_price, first_price + 4):
+            if row[index] is not None:
+                row[index] = Decimal(row[index]).scaleb(-price_scale)
+        decoded.append(tuple(row))
+    return decoded
+
+
 def fetch_generic_by_ID_(id_: int, table_name: str, schema_name: str) -> tuple:
     """
     the simplest form of fetching data from the table
     column "ID" serves as the primary key of every time series that comes into existence
     """
-    with psycopg2.connect(**_connection_dict) as conn:
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
         cur = conn.cursor()
         # print(id_, table_name, schema_name)
         cur.execute(_query_get_point_by_ID.format(
             schema_name=schema_name, table_name=table_name, id_=id_,
         ))
         res = cur.fetchall()
+        if schema_name in SERIES_SCHEMAS_:
+            res = decode_fixed_point_rows_(res, fetch_price_scale_(schema_name, table_name, cursor=cur))
     # print(res)
     return res[0]
 
@@ -87,7 +418,7 @@ def fetch_generic_range_by_IDs_(
     """
     Fetch data from certain table using raw primary key "ID" bracket sa reference.
     Since this is generic function it is alowed to fetch from any table.
-    Defaults to yielding entire table (0 -> last index).
+    Defaults to yielding entire table (0 -> last index). Fixed-point prices of time series are decoded.
     """
     if start_id is None:
         # the tables ALLOW FOR NEGATIVE NUMBERS!!! We still assume that those
@@ -102,26 +433,36 @@ def fetch_generic_range_by_IDs_(
         "start_id": f"tab.\"ID\" >= {start_id}",
         "end_id": f"tab.\"ID\" <= {end_id}",
     }
-    with psycopg2.connect(**_connection_dict) as conn:
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
         cur = conn.cursor()
         cur.execute(_query_get_data_by_IDs.format(**q))
         data = cur.fetchall()
+        if schema_name in SERIES_SCHEMAS_:
+            data = decode_fixed_point_rows_(data, fetch_price_scale_(schema_name, table_name, cursor=cur))
     return data
 
 
-def is_equity_(symbol: str) -> bool:
-    """search if the symbol already exist in stocks table. If not, assume forex pair"""
-    with psycopg2.connect(**_connection_dict) as conn:
+def is_equity_(symbol: str, use_registry: bool = True) -> bool:
+    """
+    search if the symbol already exist in stocks table. If not, assume forex pair
+
+    :param use_registry: answer from the in-process registry of symbols, instead of asking the database
+    """
+    if use_registry:
+        return _registry_symbol_kind(symbol)[0]
+    with pooled_connection_() as conn:
         cur = conn.cursor()
-        cur.execute(_exist_in_stocks.format(symbol=symbol))
+        execute_prepared_(cur, _prepared_exist_in_stocks, (symbol,))
         res = cur.fetchall()
     return res[0][0]
 
 
-def is_forex_pair_(symbol: str) -> bool:
-    with psycopg2.connect(**_connection_dict) as conn:
+def is_forex_pair_(symbol: str, use_registry: bool = True) -> bool:
+    if use_registry:
+        return _registry_symbol_kind(symbol)[1]
+    with pooled_connection_() as conn:
         cur = conn.cursor()
-        cur.execute(_exist_in_forex_pairs.format(symbol=symbol))
+        execute_prepared_(cur, _prepared_exist_in_forex_pairs, (symbol,))
         res = cur.fetchall()
     return res[0][0]
 
@@ -132,3 +473,46 @@ def list_nonstandard_functions_():
         cur.execute(_information_schema_function_check)
         res = cur.fetchall()
     return tuple(r for r in res)
+
+
+if __name__ == '__main__':
+    # per-call latency of the closest ID lookup - formatted query on a fresh connection (as it used to be),
+    # formatted query on an open connection, and a prepared statement on an open connection
+    from datetime import datetime, timedelta
+    from random import randint
+    from time import perf_counter
+
+    calls_ = 2000
+    bench_table_ = sql.Identifier("public", "prepared_statement_bench")
+    dates_ = [datetime(2020, 1, 1) + timedelta(minutes=randint(0, 200_000)) for _ in range(calls_)]
+    formatted_ = """SELECT "ID" FROM "public"."prepared_statement_bench" series
+    where series.datetime <= TIMESTAMP '{search_date}' ORDER BY series.datetime DESC LIMIT 1;"""
+    prepared_ = sql.SQL("""SELECT "ID" FROM {table} series
+    where series.datetime <= $1 ORDER BY series.datetime DESC LIMIT 1;""").format(table=bench_table_)
+    with pooled_connection_() as conn_:
+        cur_ = conn_.cursor()
+        cur_.execute(sql.SQL("""CREATE TABLE {table} AS SELECT i AS "ID", TIMESTAMP '2020-01-01' + i * INTERVAL '1 minute'
+        AS datetime FROM generate_series(0, 200000) i; CREATE INDEX ON {table} (datetime);""").format(
+            table=bench_table_))
+        try:
+            start_ = perf_counter()
+            for date_ in dates_[:200]:
+                with psycopg2.connect(**_connection_dict) as fresh_:
+                    fresh_.cursor().execute(formatted_.format(search_date=date_))
+                fresh_.close()
+            fresh_time_ = (perf_counter() - start_) / 200
+            start_ = perf_counter()
+            for date_ in dates_:
+                cur_.execute(formatted_.format(search_date=date_))
+                cur_.fetchall()
+            formatted_time_ = (perf_counter() - start_) / calls_
+            start_ = perf_counter()
+            for date_ in dates_:
+                execute_prepared_(cur_, prepared_, (date_,))
+                cur_.fetchall()
+            prepared_time_ = (perf_counter() - start_) / calls_
+        finally:
+            cur_.execute(sql.SQL("DROP TABLE {table}").format(table=bench_table_))
+    print(f"new connection + formatted query: {fresh_time_ * 1e6:.0f}us per call")
+    print(f"open connection + formatted query: {formatted_time_ * 1e6:.0f}us per call")
+    print(f"open connection + prepared statement: {prepared_time_ * 1e6:.0f}us per call")
@@ -0,0 +1,300 @@
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import psycopg2
+import psycopg2.extensions
+
+
+# every connection opened with ``_connection_dict`` creates instrumented cursors - switch to stop recording
+QUERY_STATISTICS_ENABLED_ = True
+# executions slower than this (in seconds) are kept as slow queries, together with their plan
+SLOW_QUERY_THRESHOLD_ = 0.5
+# EXPLAIN ANALYZE runs a read once more - a template gets its plan captured at most once in this many seconds
+SLOW_QUERY_PLAN_INTERVAL_ = 60.
+SLOW_QUERIES_KEPT_ = 100
+# upper bounds (in milliseconds) of latency histogram buckets, the last bucket takes everything above
+LATENCY_BUCKETS_MS_ = (0.1, 0.25, 0.5, 1., 2.5, 5., 10., 25., 50., 100., 250., 500., 1000., 2500., 5000., 10000.)
+# size of the fetched result is estimated out of this many first rows
+_RESULT_SIZE_SAMPLE = 100
+_TEMPLATE_CACHE_LIMIT = 4096
+
+_statistics_lock = threading.Lock()
+_statistics: dict[str, dict] = {}
+_slow_queries: deque = deque(maxlen=SLOW_QUERIES_KEPT_)
+_plans_captured_at: dict[str, float] = {}
+# name of the prepared statement -> template of the query it was prepared from (filled by ``execute_prepared_``,
+# once for every query text)
+_prepared_templates: dict[str, str] = {}
+_dump_thread: threading.Thread | None = None
+_dump_stop = threading.Event()
+
+_explainable = ("select", "insert", "update", "delete", "with", "values", "execute")
+_series_identifier = re.compile(r'"(1min_time_series|1day_time_series|forex_time_series)"\."[^"]+"')
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r"(?<![\w$\"])-?\d+(?:\.\d+)?(?![\w\"])")
+_whitespace = re.compile(r"\s+")
+_values_rows = re.compile(r"(\([?, ]*\))(?: ?, ?\([?, ]*\))+")
+_execute_prepared = re.compile(r"^EXECUTE (mtv_statement_\d+)")
+_writes = re.compile(r"\b(insert|update|delete|merge)\b", re.IGNORECASE)
+_statement_name = re.compile(r"\bmtv_statement_\d+\b")
+
+
+def query_template_(query: str) -> str:
+    """
+    group queries that differ only with values - literals become ?, series tables become "<schema>".<series>
+
+    EXECUTE of a statement prepared by ``execute_prepared_`` is reported as the query it was prepared from
+    (preparing it is reported as PREPARE <statement> AS query), rows of multi-row VALUES lists are collapsed
+    into the first one
+    """
+    if len(query) > _TEMPLATE_CACHE_LIMIT:  # values inlined into the query - every text is different
+        return _query_template(query)
+    return _cached_query_template(query)
+
+
+def _query_template(query: str) -> str:
+    match = _execute_prepared.match(query)
+    if match and match.group(1) in _prepared_templates:
+        return _prepared_templates[match.group(1)]
+    template = _statement_name.sub("<statement>", query)
+    template = _series_identifier.sub(r'"\1".<series>', template)
+    template = _string_literal.sub("?", template)
+    template = _number_literal.sub("?", template)
+    template = _whitespace.sub(" ", template)
+    return _values_rows.sub(r"\1, ...", template).strip().rstrip(";").rstrip()
+
+
+_cached_query_template = lru_cache(maxsize=4096)(_query_template)
+
+
+def register_prepared_template_(name: str, query: str):
+    """remember what the prepared statement runs, so its executions are grouped with the query and not the name"""
+    _prepared_templates[name] = query_template_(query)
+
+
+def _empty_entry() -> dict:
+    return {
+        "calls": 0, "errors": 0, "total_time": 0., "max_time": 0., "rows": 0,
+        "bytes_sent": 0, "bytes_received": 0, "histogram": [0] * (len(LATENCY_BUCKETS_MS_) + 1),
+    }
+
+
+def _record(template: str, elapsed: float, rows: int, bytes_sent: int, failed: bool = False):
+    with _statistics_lock:
+        entry = _statistics.get(template)
+        if entry is None:
+            entry = _statistics[template] = _empty_entry()
+        entry["calls"] += 1
+        entry["errors"] += failed
+        entry["total_time"] += elapsed
+        entry["max_time"] = max(entry["max_time"], elapsed)
+        entry["rows"] += max(rows, 0)
+        entry["bytes_sent"] += bytes_sent
+        entry["histogram"][bisect_left(LATENCY_BUCKETS_MS_, elapsed * 1000.)] += 1
+
+
+def _record_received(template: str, rows: list):
+    """text protocol sends values as text - length of their text is close to what came over the wire"""
+    if not rows:
+        return
+    sample = rows[:_RESULT_SIZE_SAMPLE]
+    size = sum(len(str(value)) for row in sample for value in row)
+    with _statistics_lock:
+        entry = _statistics.get(template)
+        if entry is not None:
+            entry["bytes_received"] += size * len(rows) // len(sample)
+
+
+def _capture_plan(connection, query: str) -> dict | str:
+    """
+    EXPLAIN (ANALYZE, BUFFERS) of the statement, run on the same connection and rolled back right after
+
+    statement sees the same data and locks as the original did, and whatever it changes is undone.
+    Statements that write are only planned - running the slowest writes (and their triggers) again costs
+    as much as they did
+    :return: JSON plan, or a message why the plan could not be captured
+    """
+    query = query.strip().rstrip(";")
+    if not query.split(None, 1) or query.split(None, 1)[0].lower() not in _explainable or ";" in query:
+        return "statement can't be explained"
+    # EXECUTE is judged by the query its statement was prepared from, a statement not known is taken for a write
+    match = _execute_prepared.match(query)
+    statement = _prepared_templates.get(match.group(1)) if match else query
+    writes = statement is None or _writes.search(statement) is not None
+    options = "FORMAT JSON" if writes else "ANALYZE, BUFFERS, FORMAT JSON"
+    cursor = connection.cursor(cursor_factory=psycopg2.extensions.cursor)
+    in_transaction = not connection.autocommit
+    try:
+        cursor.execute("SAVEPOINT mtv_explain" if in_transaction else "BEGIN")
+        try:
+            cursor.execute(f"EXPLAIN ({options}) {query}")
+            plan = cursor.fetchone()[0][0]
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT mtv_explain" if in_transaction else "ROLLBACK")
+    except psycopg2.Error as error:
+        return f"plan not captured: {str(error).strip()}"
+    finally:
+        cursor.close()
+    return plan
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    cursor recording latency, rows and bytes of every execution, grouped by the query template
+
+    executions above ``SLOW_QUERY_THRESHOLD_`` are kept with their plan. Latency of the client-side cursor covers
+    the whole result being transferred, fetching rows afterwards only adds to the received bytes
+    """
+    _template: str | None = None
+
+    def execute(self, query, vars=None):
+        if not QUERY_STATISTICS_ENABLED_:
+            return super().execute(query, vars)
+        template = query_template_(query if isinstance(query, str) else self._text_of(query))
+        self._template = template
+        start = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except Exception:
+            _record(template, time.perf_counter() - start, 0, len(self.query or b""), failed=True)
+            raise
+        elapsed = time.perf_counter() - start
+        _record(template, elapsed, self.rowcount, len(self.query or b""))
+        if elapsed >= SLOW_QUERY_THRESHOLD_:
+            self._slow_query(template, elapsed)
+        return result
+
+    def executemany(self, query, vars_list):
+        if not QUERY_STATISTICS_ENABLED_:
+            return super().executemany(query, vars_list)
+        template = query_template_(query if isinstance(query, str) else self._text_of(query))
+        self._template = template
+        start = time.perf_counter()
+        try:
+            result = super().executemany(query, vars_list)
+        except Exception:
+            _record(template, time.perf_counter() - start, 0, 0, failed=True)
+            raise
+        _record(template, time.perf_counter() - start, self.rowcount, 0)
+        return result
+
+    def _text_of(self, query) -> str:
+        if isinstance(query, bytes):
+            return query.decode(errors="replace")
+        return query.as_string(self)
+
+    def _slow_query(self, template: str, elapsed: float):
+        now = time.monotonic()
+        plan = None
+        with _statistics_lock:
+            capture = now - _plans_captured_at.get(template, -SLOW_QUERY_PLAN_INTERVAL_) >= SLOW_QUERY_PLAN_INTERVAL_
+            if capture:
+                _plans_captured_at[template] = now
+        if capture:
+            plan = _capture_plan(self.connection, self.query.decode(errors="replace"))
+        _slow_queries.append({
+            "template": template, "query": self.query.decode(errors="replace")[:2000], "time": elapsed,
+            "rows": self.rowcount, "at": datetime.now(timezone.utc).isoformat(), "plan": plan,
+        })
+
+    def fetchone(self):
+        row = super().fetchone()
+        if self._template is not None and row is not None:
+            _record_received(self._template, [row])
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self._template is not None:
+            _record_received(self._template, rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self._template is not None:
+            _record_received(self._template, rows)
+        return rows
+
+
+def query_statistics_(top: int | None = None) -> dict:
+    """
+    what the process has executed so far - per query template, the slowest (by total time) first
+
+    :param top: number of templates to report, all of them by default
+    :return: {"templates": {template: entry}, "slow_queries": [...], "latency_buckets_ms": (...)} where the entry
+        holds calls, errors, total/max/mean time (seconds), rows, bytes sent/received and the latency histogram
+    """
+    with _statistics_lock:
+        entries = sorted(_statistics.items(), key=lambda item: item[1]["total_time"], reverse=True)[:top]
+        templates = {
+            template: {**entry, "histogram": list(entry["histogram"]),
+                       "mean_time": entry["total_time"] / entry["calls"] if entry["calls"] else 0.}
+            for template, entry in entries
+        }
+        slow_queries = list(_slow_queries)
+    return {"templates": templates, "slow_queries": slow_queries, "latency_buckets_ms": LATENCY_BUCKETS_MS_}
+
+
+def reset_query_statistics_():
+    with _statistics_lock:
+        _statistics.clear()
+        _slow_queries.clear()
+        _plans_captured_at.clear()
+
+
+def dump_query_statistics_(path: str, top: int | None = None):
+    """write the statistics as JSON, replacing the file at once - a reader never sees half of the dump"""
+    statistics = query_statistics_(top)
+    statistics["dumped_at"] = datetime.now(timezone.utc).isoformat()
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(statistics, file, indent=2, default=str)
+    os.replace(temporary, path)
+
+
+def start_query_statistics_dump_(path: str, interval: float = 60., top: int | None = None):
+    """dump the statistics every "interval" seconds from a background thread, until stopped or the process ends"""
+    global _dump_thread
+    stop_query_statistics_dump_()
+    _dump_stop.clear()
+
+    def dump_periodically():
+        while not _dump_stop.wait(interval):
+            dump_query_statistics_(path, top)
+
+    _dump_thread = threading.Thread(target=dump_periodically, name="query-statistics-dump", daemon=True)
+    _dump_thread.start()
+
+
+def stop_query_statistics_dump_():
+    global _dump_thread
+    if _dump_thread is not None:
+        _dump_stop.set()
+        _dump_thread.join()
+        _dump_thread = None
+
+
+if __name__ == '__main__':
+    # cost of the instrumentation on a cheap query - the same point query with recording switched on and off.
+    # Recording adds 2-5us to a ~20us round trip on a local database
+    # connections use the cursor class of the imported module, not of this __main__ copy
+    import db_functions.db_instrumentation as instrumentation_
+    from db_functions.db_helpers import _connection_dict
+
+    with psycopg2.connect(**_connection_dict) as conn_:
+        cur_ = conn_.cursor()
+        for enabled_ in (False, True, False, True):
+            instrumentation_.QUERY_STATISTICS_ENABLED_ = enabled_
+            start_ = time.perf_counter()
+            for i_ in range(20_000):
+                cur_.execute("SELECT %s::int, 'value' WHERE 1 = 1;", (i_,))
+                cur_.fetchall()
+            elapsed_ = (time.perf_counter() - start_) / 20_000
+            print(f"recording {'on ' if enabled_ else 'off'}: {elapsed_ * 1e6:.1f}us per query")
@@ -1,19 +1,51 @@
+from datetime import datetime
+
 import psycopg2
+from psycopg2.errors import UndefinedTable
 
 from db_functions.db_helpers import (
     _connection_dict,
+    shard_connection_dict_,
+    db_string_converter_,
+    decode_fixed_point_rows_,
+    fetch_price_scale_,
     TimeSeriesNotFoundError_, DataUncertainError_,
     is_equity_, is_forex_pair_,
+    invalidate_symbol_registry_,
 )
-from db_functions.time_series_db import time_series_table_exists_
+from db_functions.time_series_db import time_series_table_exists_, resolve_time_series_location_
+from minor_modules import time_interval_sanitizer
+
+# rollups that make sense for each of the stored intervals - rolling daily candles into days is pointless
+ROLLUP_BUCKETS_ = {
+    "1min": ("hour", "day", "week"),
+    "1day": ("week", "month"),
+}
+
+# materialized views of the reference tables, with relation IDs substituted by human-readable content.
+# Reference data changes only when the database is filled, so the joins are not repeated on every fetch
+REFERENCE_VIEWS_ = ("forex_pairs_explained", "markets_explained", "stocks_explained")
+
+# more buckets than that are more candles than any chart has pixels for
+DOWNSAMPLE_MAX_BUCKETS_ = 20_000
 
 # create queries
 _query_create_view = "select {db_create_view_function}('{table_of_origin}');"
+_query_create_rollup = "select public.generate_time_series_rollup({schema_name}, {table_name}, {bucket});"
+
+# update queries
+_query_refresh_reference_view = "REFRESH MATERIALIZED VIEW {concurrently}\"public\".{view_name};"
+_query_refresh_rollups = "select public.refresh_time_series_rollups({schema_name}, {table_name}, {since});"
 
 # select queries
 _information_schema_list_views = "select * from \"public\".non_standard_views;"
 _query_check_view_existance = """select exists (select * from non_standard_views 
 where table_name = '{view_name}' and table_schema = '{schema_name}');"""
+_query_fetch_rollup = """
+SELECT rollup.bucket_start, rollup.open, rollup.close, rollup.high, rollup.low, rollup.volume, rollup.candles
+FROM "{schema_name}"."{table_name}_rollup_{bucket}" rollup {optional_filter} ORDER BY rollup.bucket_start;
+"""
+_query_downsample_time_series = "SELECT * FROM public.downsample_time_series(%s, %s, %s, %s, %s);"
 
 
 def create_time_series_view_(
@@ -31,7 +63,8 @@ def create_time_series_view_(
     if not time_series_table_exists_(
             symbol=symbol, time_interval=time_interval, mic_code=mic_code):
         raise TimeSeriesNotFoundError_("can't create a view for a non-existent table")
-    with psycopg2.connect(**_connection_dict) as conn:
+    schema_name, table_name, _ = resolve_time_series_location_(symbol, time_interval, mic_code=mic_code)
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
         cur = conn.cursor()
         if is_equity_(symbol):
             create_params = {
@@ -59,6 +92,32 @@ def list_nonstandard_views_():
     return tuple(r for r in res)
 
 
+def refresh_reference_views_(views: tuple[str, ...] = REFERENCE_VIEWS_, concurrently: bool = True, cursor=None):
+    """
+    bring materialized views of the references up to date with their tables (after the references are filled)
+
+    concurrent refresh lets ``fetch_stocks`` and the like read the previous content meanwhile, instead of waiting
+    :param views: some of the REFERENCE_VIEWS_, all of them by default
+    :param cursor: cursor of an already opened connection, to refresh within the caller's transaction
+        (instrument indexes kept by the process are reloaded on their next use anyway)
+    """
+    for view_name in views:
+        if view_name not in REFERENCE_VIEWS_:
+            raise ValueError(f"unknown reference view {view_name}. Possible views: {REFERENCE_VIEWS_}")
+    queries = [_query_refresh_reference_view.format(
+        concurrently="CONCURRENTLY " if concurrently else "", view_name=view_name) for view_name in views]
+    if cursor is not None:
+        for query in queries:
+            cursor.execute(query)
+    else:
+        with psycopg2.connect(**_connection_dict) as conn:
+            cur = conn.cursor()
+            for query in queries:
+                cur.execute(query)
+    # in-process instrument indexes are built out of the views
+    invalidate_symbol_registry_()
+
+
 def view_exists_(view_name: str, schema_name: str) -> bool:
     """check if given view really exist in database"""
     with psycopg2.connect(**_connection_dict) as conn:
@@ -67,3 +126,193 @@ def view_exists_(view_name: str, schema_name: str) -> bool:
         res = cur.fetchall()
     return res[0][0]  # unpacks PGSQL boolean
 
+
+@time_interval_sanitizer()
+def create_time_series_rollups_(
+        symbol: str, time_interval: str, is_equity: bool | None = None, mic_code: str | None = None,
+        buckets: tuple[str, ...] | None = None):
+    """
+    create the "continuous aggregates" of a time series - tables of hourly/daily/weekly (or weekly/monthly
+    for daily series) OHLCV candles, calculated by the database and kept next to the series itself
+
+    rollups get filled with the entire history on creation, later on only the buckets touched by new rows
+    are recalculated (see ``refresh_time_series_rollups``). Buckets are aligned to the clock (UTC).
+    """
+    if not time_series_table_exists_(symbol, time_interval, is_equity, mic_code):
+        raise TimeSeriesNotFoundError_("can't create rollups for a non-existent table")
+    schema_name, table_name, _ = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+    if buckets is None:
+        buckets = ROLLUP_BUCKETS_[time_interval]
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+        cur = conn.cursor()
+        for bucket in buckets:
+            cur.execute(_query_create_rollup.format(
+                schema_name=db_string_converter_(schema_name), table_name=db_string_converter_(table_name),
+                bucket=db_string_converter_(bucket)))
+
+
+def refresh_time_series_rollups_(
+        symbol: str, time_interval: str, since: datetime | None = None,
+        is_equity: bool | None = None, mic_code: str | None = None) -> int:
+    """
+    recalculate rollup buckets that contain rows newer than "since" (all of them, when it is skipped)
+
+    series without rollups are left alone, so it is safe to call after every update
+
+    :return: number of rollup rows that got inserted or recalculated
+    """
+    schema_name, table_name, _ = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_refresh_rollups.format(
+            schema_name=db_string_converter_(schema_name), table_name=db_string_converter_(table_name),
+            since=f"TIMESTAMP '{since}'" if since is not None else "NULL"))
+        res = cur.fetchall()
+    return res[0][0]
+
+
+def fetch_time_series_rollup_(
+        symbol: str, time_interval: str, bucket: str, is_equity: bool | None = None, mic_code: str | None = None,
+        start_date: datetime | None = None, end_date: datetime | None = None) -> list[tuple]:
+    """
+    Obtain aggregated candles of a series, optionally between the dates (both inclusive)
+
+    every row is (bucket_start, open, close, high, low, volume, candles), where "candles" is the number of
+    rows of the original series folded into the bucket. Volume is NULL for forex pairs.
+    Fixed-point prices are decoded, as in rows of the series
+    """
+    schema_name, table_name, _ = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+    if bucket not in ROLLUP_BUCKETS_.get(time_interval, ()):
+        raise ValueError(f"{time_interval} series do not have {bucket} rollups. "
+                         f"Possible buckets: {ROLLUP_BUCKETS_.get(time_interval)}")
+    brackets = []
+    if start_date is not None:
+        brackets.append(f"rollup.bucket_start >= TIMESTAMP '{start_date}'")
+    if end_date is not None:
+        brackets.append(f"rollup.bucket_start <= TIMESTAMP '{end_date}'")
+    try:
+        with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+            cur = conn.cursor()
+            cur.execute(_query_fetch_rollup.format(
+                schema_name=schema_name, table_name=table_name, bucket=bucket,
+                optional_filter="WHERE " + " AND ".join(brackets) if brackets else ""))
+            res = decode_fixed_point_rows_(
+                cur.fetchall(), fetch_price_scale_(schema_name, table_name, cursor=cur), first_price=1)
+    except UndefinedTable:
+        raise TimeSeriesNotFoundError_(f'{bucket} rollup of {schema_name}.{table_name} does not exist')
+    return res
+
+
+def fetch_downsampled_time_series_(
+        symbol: str, time_interval: str, buckets: int, is_equity: bool | None = None, mic_code: str | None = None,
+        start_date: datetime | None = None, end_date: datetime | None = None) -> list[tuple]:
+    """
+    Obtain a series (optionally between the dates, both inclusive) folded by the database into at most "buckets"
+    candles of equal time span - first open, last close, highest high, lowest low and summed volume
+
+    pick buckets by the width of the chart (in pixels, or in candles the chart can draw), only that many rows
+    are sent instead of the entire range. Rows come in the shape of ``fetch_data_by_dates`` rows -
+    (bucket number, datetime, open, close, high, low) with volume for equities, so they go straight into
+    ``PriceChart``. Datetime of a bucket is the one of its first candle, empty buckets are skipped.
+    """
+    if not 1 <= buckets <= DOWNSAMPLE_MAX_BUCKETS_:
+        raise ValueError(f"number of buckets has to be between 1 and {DOWNSAMPLE_MAX_BUCKETS_} (got {buckets})")
+    schema_name, table_name, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+    try:
+        with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+            cur = conn.cursor()
+            cur.execute(_query_downsample_time_series, (schema_name, table_name, start_date, end_date, buckets))
+            res = cur.fetchall()
+    except UndefinedTable:
+        raise TimeSeriesNotFoundError_(f'series: {schema_name}.{table_name} does not exist')
+    # number of candles folded into the bucket is not a part of the chart data
+    return [row[:7] if is_equity else row[:6] for row in res]
+
+
+if __name__ == '__main__':
+    # 20k stocks - filtered fetch from the joins of the former plain view against the materialized one.
+    # Single symbol 3.38ms vs 0.13ms, all 20k rows matched by country 137ms vs 47ms
+    from time import perf_counter
+
+    from db_functions.time_series_db import fetch_data_by_dates_
+
+    # rows of the benchmark take IDs after the stored ones - only they are deleted afterwards
+    bench_tables_ = ("plans", "countries", "timezones", "currencies", "investment_types", "markets", "stocks")
+    with psycopg2.connect(**_connection_dict) as conn_:
+        cur_ = conn_.cursor()
+        bench_IDs_ = {}
+        for table_ in bench_tables_:
+            cur_.execute(f'SELECT coalesce(max(tab."ID"), -1) + 1 FROM public.{table_} tab;')
+            bench_IDs_[table_] = cur_.fetchone()[0]
+        cur_.execute("""
+            INSERT INTO public.plans ("ID", global, plan) VALUES (%(plans)s, 'Level A', 'Bench');
+            INSERT INTO public.countries ("ID", name) VALUES (%(countries)s, 'Benchland');
+            INSERT INTO public.timezones ("ID", name) VALUES (%(timezones)s, 'Bench/Zone');
+            INSERT INTO public.currencies ("ID", symbol, name) VALUES (%(currencies)s, 'BNC', 'Bench coin');
+            INSERT INTO public.investment_types ("ID", name) VALUES (%(investment_types)s, 'Bench Stock');
+            INSERT INTO public.markets ("ID", name, code, access, timezone, country)
+            VALUES (%(markets)s, 'BENCH', 'XBEN', %(plans)s, %(timezones)s, %(countries)s);
+            INSERT INTO public.stocks ("ID", symbol, name, currency, exchange, country, type, plan)
+            SELECT %(stocks)s + i, 'B' || i, 'Bench company ' || i, %(currencies)s, %(markets)s, %(countries)s,
+                %(investment_types)s, %(plans)s FROM generate_series(0, 19999) i;
+        """, bench_IDs_)
+    refresh_reference_views_()
+    joins_ = """SELECT main_tab."ID", main_tab.symbol, main_tab.name, curs.symbol, mkts.code, cntrs.name,
+        i_types.name, p.plan FROM public.stocks main_tab
+        LEFT JOIN public.currencies curs ON main_tab.currency = curs."ID"
+        LEFT JOIN public.markets mkts ON main_tab.exchange = mkts."ID"
+        LEFT JOIN public.countries cntrs ON main_tab.country = cntrs."ID"
+        LEFT JOIN public.investment_types i_types ON main_tab.type = i_types."ID"
+        LEFT JOIN public.plans p ON main_tab.plan = p."ID" WHERE {column} LIKE '{pattern}';"""
+    try:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            cur_ = conn_.cursor()
+            for label_, plain_, materialized_ in [
+                ("symbol 'B1234'", joins_.format(column="main_tab.symbol", pattern="B1234"),
+                 "SELECT * FROM public.stocks_explained s WHERE s.symbol LIKE 'B1234';"),
+                ("country '%ench%'", joins_.format(column="cntrs.name", pattern="%ench%"),
+                 "SELECT * FROM public.stocks_explained s WHERE s.country_name LIKE '%ench%';"),
+            ]:
+                timings_ = []
+                for query_ in (plain_, materialized_):
+                    start_ = perf_counter()
+                    for _ in range(20):
+                        cur_.execute(query_)
+                        cur_.fetchall()
+                    timings_.append((perf_counter() - start_) / 20 * 1000)
+                print(f"{label_:>17}: joins {timings_[0]:.2f}ms, materialized view {timings_[1]:.2f}ms")
+    finally:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            cur_ = conn_.cursor()
+            cur_.execute('DELETE FROM public.stocks WHERE "ID" BETWEEN %(stocks)s AND %(stocks)s + 19999;', bench_IDs_)
+            # stocks go first, the rest is referenced by them
+            for table_ in bench_tables_[-2::-1]:
+                cur_.execute(f'DELETE FROM public.{table_} WHERE "ID" = %s;', (bench_IDs_[table_],))
+        refresh_reference_views_()
+
+    # a year of 1min candles (98k rows) for a 1200 pixels wide chart - every row against downsampled buckets.
+    # 98280 rows (5.9MB as text) in 370ms against 575 rows (34KB) in 170ms, spent on the aggregation by the database
+    with psycopg2.connect(**_connection_dict) as conn_:
+        cur_ = conn_.cursor()
+        cur_.execute("""CREATE TABLE "1min_time_series"."BENCH_XBEN" AS SELECT i AS "ID",
+            TIMESTAMP '2021-01-04 14:30' + (i / 390) * INTERVAL '1 day' + (i % 390) * INTERVAL '1 minute' AS datetime,
+            (100 + sin(i / 500.) * 10)::numeric(10,5) AS open, (100.2 + sin(i / 500.) * 10)::numeric(10,5) AS close,
+            (101 + sin(i / 500.) * 10)::numeric(10,5) AS high, (99 + sin(i / 500.) * 10)::numeric(10,5) AS low,
+            1000::bigint AS volume FROM generate_series(0, 98279) i;
+            ALTER TABLE "1min_time_series"."BENCH_XBEN" ADD PRIMARY KEY ("ID");
+            CREATE INDEX ON "1min_time_series"."BENCH_XBEN" (datetime);""")
+    start_date_, end_date_ = datetime(2021, 1, 4), datetime(2021, 9, 14)
+    try:
+        for label_, fetch_ in [
+            ("every row", lambda: fetch_data_by_dates_(
+                "BENCH", "1min", True, "XBEN", start_date=start_date_, end_date=end_date_)),
+            ("1200 buckets", lambda: fetch_downsampled_time_series_(
+                "BENCH", "1min", 1200, True, "XBEN", start_date=start_date_, end_date=end_date_)),
+        ]:
+            start_ = perf_counter()
+            rows_ = fetch_()
+            print(f"{label_:>12}: {len(rows_)} rows in {(perf_counter() - start_) * 1000:.0f}ms, "
+                  f"{sum(len(str(value_)) for row_ in rows_ for value_ in row_) / 2 ** 10:.0f}KB as text")
+    finally:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            conn_.cursor().execute('DROP TABLE "1min_time_series"."BENCH_XBEN";')
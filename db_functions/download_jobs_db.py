@@ -0,0 +1,207 @@
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from db_functions.db_helpers import _connection_dict, db_string_converter_
+from minor_modules import time_interval_sanitizer
+
+
+# insert queries
+_query_enqueue_download_job = """
+INSERT INTO "public".download_jobs (symbol, mic_code, time_interval, start_date, end_date, max_attempts)
+VALUES ({symbol}, {mic_code}, {time_interval}, {start_date}, {end_date}, {max_attempts})
+RETURNING "ID";
+"""
+_query_enqueue_tracked_download_jobs = """
+INSERT INTO "public".download_jobs (symbol, mic_code, time_interval, max_attempts)
+SELECT s.symbol, m.code, tracked.time_interval, {max_attempts}
+FROM "public".time_tracking_info t_trk
+JOIN "public".stocks s ON t_trk.stock = s."ID"
+JOIN "public".markets m ON s.exchange = m."ID"
+CROSS JOIN LATERAL (
+    VALUES ('1min', t_trk.is_tracked_1min), ('1day', t_trk.is_tracked_1day)
+) tracked(time_interval, is_tracked)
+WHERE tracked.is_tracked {optional_filter}
+AND NOT EXISTS (
+    SELECT 1 FROM "public".download_jobs open_job
+    WHERE open_job.symbol = s.symbol AND open_job.mic_code = m.code
+    AND open_job.time_interval = tracked.time_interval AND open_job.status IN ('pending', 'running')
+)
+RETURNING "ID";
+"""
+
+# update queries
+# jobs whose lease expired on their last attempt are not given out again - worker dies on them every time
+_query_fail_expired_download_jobs = """
+UPDATE "public".download_jobs job
+SET status = 'failed', lease_expires_at = NULL, finished_at = timezone('UTC', now()),
+    last_error = coalesce(job.last_error || '; ', '') || 'lease of ' || job.worker_name || ' expired on the last attempt'
+WHERE job.status = 'running' AND job.lease_expires_at < timezone('UTC', now()) AND job.attempts >= job.max_attempts;
+"""
+# job is claimable when it waits, or when the worker that took it did not renew its lease in time.
+# Jobs of the same series are handed out one at a time, in the order of enqueueing, so the rows
+# of a single time series are always appended from the oldest to the newest
+_query_claim_download_job = """
+UPDATE "public".download_jobs job
+SET status = 'running', worker_name = {worker_name}, attempts = job.attempts + 1,
+    lease_expires_at = timezone('UTC', now()) + INTERVAL '{lease_seconds} seconds'
+WHERE job."ID" = (
+    SELECT candidate."ID" FROM "public".download_jobs candidate
+    WHERE (candidate.status = 'pending'
+        OR (candidate.status = 'running' AND candidate.lease_expires_at < timezone('UTC', now())
+            AND candidate.attempts < candidate.max_attempts))
+    AND NOT EXISTS (
+        SELECT 1 FROM "public".download_jobs earlier
+        WHERE earlier.symbol = candidate.symbol AND earlier.time_interval = candidate.time_interval
+        AND earlier.mic_code IS NOT DISTINCT FROM candidate.mic_code
+        AND earlier.status IN ('pending', 'running') AND earlier."ID" < candidate."ID"
+    )
+    ORDER BY candidate."ID"
+    FOR UPDATE SKIP LOCKED
+    LIMIT 1
+)
+RETURNING job."ID", job.symbol, job.mic_code, job.time_interval, job.start_date, job.end_date, job.attempts;
+"""
+_query_extend_download_job_lease = """
+UPDATE "public".download_jobs job
+SET lease_expires_at = timezone('UTC', now()) + INTERVAL '{lease_seconds} seconds'
+WHERE job."ID" = {job_id} AND job.worker_name = {worker_name} AND job.status = 'running'
+RETURNING job."ID";
+"""
+_query_complete_download_job = """
+UPDATE "public".download_jobs job
+SET status = 'done', lease_expires_at = NULL, finished_at = timezone('UTC', now())
+WHERE job."ID" = {job_id} AND job.worker_name = {worker_name} AND job.status = 'running'
+RETURNING job."ID";
+"""
+_query_fail_download_job = """
+UPDATE "public".download_jobs job
+SET status = CASE WHEN job.attempts >= job.max_attempts THEN 'failed' ELSE 'pending' END,
+    lease_expires_at = NULL, last_error = {error_message},
+    finished_at = CASE WHEN job.attempts >= job.max_attempts THEN timezone('UTC', now()) END
+WHERE job."ID" = {job_id} AND job.worker_name = {worker_name} AND job.status = 'running'
+RETURNING job.status;
+"""
+
+# select queries
+_query_fetch_download_jobs = """
+SELECT job."ID", job.symbol, job.mic_code, job.time_interval, job.start_date, job.end_date, job.status,
+    job.attempts, job.max_attempts, job.worker_name, job.lease_expires_at, job.last_error
+FROM "public".download_jobs job {optional_filter} ORDER BY job."ID";
+"""
+
+_JOB_STATUSES = ['pending', 'running', 'done', 'failed']
+
+
+def _sql_value(value) -> str:
+    """represent optional text/timestamp value of a job inside of the query"""
+    if value is None:
+        return "NULL"
+    return db_string_converter_(str(value))
+
+
+@time_interval_sanitizer()
+def enqueue_download_job_(
+        symbol: str, time_interval: str, mic_code: str | None = None,
+        start_date: datetime | None = None, end_date: datetime | None = None, max_attempts: int = 3) -> int:
+    """
+    put a single (symbol, MIC, interval, date window) work item into the download queue
+
+    skipping both dates means "download entire history, or everything past the last saved point"
+
+    :return: ID of the created job
+    """
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_enqueue_download_job.format(
+            symbol=db_string_converter_(symbol), mic_code=_sql_value(mic_code),
+            time_interval=db_string_converter_(time_interval), start_date=_sql_value(start_date),
+            end_date=_sql_value(end_date), max_attempts=int(max_attempts),
+        ))
+        res = cur.fetchall()
+    return res[0][0]
+
+
+def enqueue_tracked_download_jobs_(worker_name: str | None = None, max_attempts: int = 3) -> list[int]:
+    """
+    enqueue update jobs for every series that is marked as tracked in "time_tracking_info"
+
+    series that already wait in the queue are skipped. Passing a worker name limits the jobs to the
+    series assigned to that worker in the tracking table.
+    """
+    if worker_name == "":
+        raise ValueError('empty values passed as "" are not valid for the query')
+    optional_filter = f"AND t_trk.worker_name = {db_string_converter_(worker_name)}" if worker_name else ""
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_enqueue_tracked_download_jobs.format(
+            max_attempts=int(max_attempts), optional_filter=optional_filter))
+        res = cur.fetchall()
+    return [r[0] for r in res]
+
+
+def claim_download_job_(worker_name: str, lease: timedelta = timedelta(minutes=30)) -> tuple | None:
+    """
+    take the next job from the queue, marking it with the name of the worker
+
+    many workers (on many machines) can claim concurrently - rows locked by others are skipped,
+    so no two workers ever get the same job. Job is given back to the queue, if its lease expires
+    before the worker completes it - or marked as failed, when that was its last attempt.
+
+    :return: (ID, symbol, mic_code, time_interval, start_date, end_date, attempts) or None if there is nothing to do
+    """
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_fail_expired_download_jobs)
+        cur.execute(_query_claim_download_job.format(
+            worker_name=db_string_converter_(worker_name), lease_seconds=int(lease.total_seconds())))
+        res = cur.fetchall()
+    return res[0] if res else None
+
+
+def extend_download_job_lease_(job_id: int, worker_name: str, lease: timedelta = timedelta(minutes=30)) -> bool:
+    """renew the lease of a long-running job. False means the job is no longer owned by this worker"""
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_extend_download_job_lease.format(
+            job_id=int(job_id), worker_name=db_string_converter_(worker_name),
+            lease_seconds=int(lease.total_seconds())))
+        res = cur.fetchall()
+    return bool(res)
+
+
+def complete_download_job_(job_id: int, worker_name: str) -> bool:
+    """mark job as done. False means the lease has been lost and another worker took the job over"""
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_complete_download_job.format(
+            job_id=int(job_id), worker_name=db_string_converter_(worker_name)))
+        res = cur.fetchall()
+    return bool(res)
+
+
+def fail_download_job_(job_id: int, worker_name: str, error_message: str) -> str | None:
+    """
+    give the job back to the queue for a retry, or mark it as failed when it is out of attempts
+
+    :return: new status of the job ('pending'/'failed'), None when the job is not owned by this worker anymore
+    """
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_fail_download_job.format(
+            job_id=int(job_id), worker_name=db_string_converter_(worker_name),
+            error_message=db_string_converter_(error_message)))
+        res = cur.fetchall()
+    return res[0][0] if res else None
+
+
+def fetch_download_jobs_(status: str | None = None) -> list[tuple]:
+    """Obtain a list of jobs in the queue, optionally only the ones with given status"""
+    if status is not None and status not in _JOB_STATUSES:
+        raise ValueError(f'status {status} is not allowed. allowed statuses: {_JOB_STATUSES}')
+    optional_filter = f"WHERE job.status = {db_string_converter_(status)}" if status else ""
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_fetch_download_jobs.format(optional_filter=optional_filter))
+        res = cur.fetchall()
+    return res
@@ -1,6 +1,7 @@
 from ast import literal_eval
 import psycopg2
-from db_functions.db_helpers import _connection_dict, db_string_converter_
+from db_functions.db_helpers import _connection_dict, db_string_converter_, invalidate_symbol_registry_
+from db_functions.db_views import refresh_reference_views_
 
 
 # insert queries
@@ -53,8 +54,13 @@ def insert_forex_currency_groups_(forex_currency_groups: set[str]):
         cur.close()
 
 
-def insert_forex_pairs_available_(pairs: list[dict]):
-    """fill currencies table with all the tradeable currency pairs covered by TwelveData API"""
+def insert_forex_pairs_available_(pairs: list[dict], refresh_views: bool = True):
+    """
+    fill currencies table with all the tradeable currency pairs covered by TwelveData API
+
+    :param refresh_views: refresh materialized forex_pairs_explained afterwards - turned off when more
+        references are filled at once, and the views are refreshed after all of them
+    """
     with psycopg2.connect(**_connection_dict) as conn:
         cur = conn.cursor()
         for index, pair_dict in enumerate(sorted(pairs, key=lambda x: x['symbol'])):
@@ -69,6 +75,9 @@ def insert_forex_pairs_available_(pairs: list[dict]):
             cur.execute(_query_insert_forex_pair.format(**query_dict))
             conn.commit()
         cur.close()
+    invalidate_symbol_registry_()
+    if refresh_views:
+        refresh_reference_views_(("forex_pairs_explained",))
 
 
 def fetch_currencies_(symbol_like: str | None = None, name_like: str | None = None):
@@ -0,0 +1,113 @@
+import json
+
+import psycopg2
+
+from analysis_functions.streaming import indicator_state_from_dict_
+from db_functions.db_helpers import shard_connection_dict_, db_string_converter_
+
+
+# insert queries
+_query_save_indicator_state = """
+INSERT INTO "public".indicator_states AS st (schema_name, table_name, state_name, "last_ID", state)
+VALUES ({schema_name}, {table_name}, {state_name}, {last_ID}, {state}::jsonb)
+ON CONFLICT (schema_name, table_name, state_name) DO UPDATE
+SET "last_ID" = EXCLUDED."last_ID", state = EXCLUDED.state, updated_at = timezone('UTC', now());
+"""
+
+# select queries
+_query_fetch_indicator_states = """
+SELECT st.state_name, st."last_ID", st.state FROM "public".indicator_states st
+WHERE st.schema_name = {schema_name} AND st.table_name = {table_name} ORDER BY st.state_name;
+"""
+_query_fetch_rows_between_IDs = """
+SELECT * FROM "{schema_name}"."{table_name}" series
+WHERE series."ID" > {after_ID} AND series."ID" < {before_ID} ORDER BY series."ID";
+"""
+
+# delete queries
+_query_drop_indicator_states = """
+DELETE FROM "public".indicator_states st
+WHERE st.schema_name = {schema_name} AND st.table_name = {table_name} {optional_filter};
+"""
+
+
+def save_indicator_state_(
+        schema_name: str, table_name: str, state_name: str, state, last_ID: int, cursor=None):
+    """
+    store indicator state object of a time series, together with the ID of the last row folded into it
+
+    :param cursor: cursor of an already opened connection, to save state within the caller's transaction
+    """
+    query = _query_save_indicator_state.format(
+        schema_name=db_string_converter_(schema_name), table_name=db_string_converter_(table_name),
+        state_name=db_string_converter_(state_name), last_ID=int(last_ID),
+        state=db_string_converter_(json.dumps(state.get_state())),
+    )
+    if cursor is not None:
+        cursor.execute(query)
+        return
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+        cur = conn.cursor()
+        cur.execute(query)
+
+
+def fetch_indicator_states_(schema_name: str, table_name: str, cursor=None) -> dict[str, tuple]:
+    """
+    Obtain all the indicator states kept for a time series
+
+    :return: state name -> (ID of the last row folded into the state, state object)
+    """
+    query = _query_fetch_indicator_states.format(
+        schema_name=db_string_converter_(schema_name), table_name=db_string_converter_(table_name))
+    if cursor is not None:
+        cursor.execute(query)
+        res = cursor.fetchall()
+    else:
+        with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+            cur = conn.cursor()
+            cur.execute(query)
+            res = cur.fetchall()
+    return {state_name: (last_ID, indicator_state_from_dict_(state)) for state_name, last_ID, state in res}
+
+
+def drop_indicator_states_(schema_name: str, table_name: str, state_name: str | None = None):
+    """remove every indicator state of a time series, or only the one with given name"""
+    optional_filter = f"AND st.state_name = {db_string_converter_(state_name)}" if state_name else ""
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_drop_indicator_states.format(
+            schema_name=db_string_converter_(schema_name), table_name=db_string_converter_(table_name),
+            optional_filter=optional_filter))
+
+
+def advance_indicator_states_(
+        schema_name: str, table_name: str, candles: list[dict], first_ID: int, cursor,
+        price_scale: int | None = None) -> int:
+    """
+    fold freshly inserted candles (with IDs starting at "first_ID") into every state kept for the series
+
+    rows already folded into a state are skipped, rows missing between the state and the new candles are
+    read from the series first - states never skip a row. Called by ``insert_historical_data`` with its cursor.
+
+    :param price_scale: decimal places of the series with fixed-point prices, to decode the rows read from it
+    :return: number of states advanced
+    """
+    states = fetch_indicator_states_(schema_name, table_name, cursor=cursor)
+    last_candle_ID = first_ID + len(candles) - 1
+    for state_name, (last_ID, state) in states.items():
+        if last_ID >= last_candle_ID:
+            continue
+        if last_ID < first_ID - 1:
+            cursor.execute(_query_fetch_rows_between_IDs.format(
+                schema_name=schema_name, table_name=table_name, after_ID=last_ID, before_ID=first_ID))
+            columns = [column.name for column in cursor.description]
+            for row in cursor.fetchall():
+                row = dict(zip(columns, row))
+                if price_scale is not None:
+                    for price in ["open", "close", "high", "low"]:
+                        row[price] = row[price] / 10 ** price_scale
+                state.update(row)
+        for candle in candles[max(last_ID - first_ID + 1, 0):]:
+            state.update(candle)
+        save_indicator_state_(schema_name, table_name, state_name, state, last_candle_ID, cursor=cursor)
+    return len(states)
@@ -0,0 +1,449 @@
+import json
+import os
+import struct
+import threading
+import uuid
+import zlib
+from contextlib import contextmanager
+from os.path import abspath, dirname, join
+
+try:
+    import fcntl
+except ImportError:  # Windows - directories of finished processes are not recovered there
+    fcntl = None
+
+from psycopg2.errors import InvalidParameterValue
+
+import settings
+from db_functions.backfill_db import backfill_time_series_
+from db_functions.db_views import refresh_time_series_rollups_
+from db_functions.time_series_db import (
+    create_time_series_,
+    insert_historical_data_,
+    resolve_time_series_location_,
+    time_series_latest_timestamp_,
+    time_series_table_exists_,
+)
+
+
+# downloaded pages are kept here until they are committed to the database - a directory per process,
+# locked by its owner for as long as it runs. Directories no one holds are left by the processes that ended
+INGEST_LOG_DIRECTORY_ = \
+    getattr(settings, "INGEST_LOG_DIR", None) or join(dirname(dirname(abspath(__file__))), "ingest_log")
+# segment being written is sealed (and a new one started) once it grows above this size
+INGEST_SEGMENT_MAX_BYTES_ = 64 * 1024 * 1024
+# every record is flushed to the disk before the call returns - switch off only for tests and benchmarks
+INGEST_FSYNC_ = True
+
+# record = length and crc32 of the payload, then the payload (JSON). A record torn by a crash fails its checksum
+_record_header = struct.Struct(">II")
+_segment_prefix, _segment_suffix = "segment-", ".log"
+_lock_name = "owner.lock"
+
+_log_lock = threading.Lock()
+# only one drain runs in the process at a time, pages keep being written meanwhile
+_drain_lock = threading.Lock()
+_segment_file = None
+_segment_number: int | None = None
+# directory of the segments of this process, and the descriptor holding its lock
+_own_directory_path: str | None = None
+_own_directory_lock: int | None = None
+_own_directory_pid: int | None = None
+# downloads begun in this process that are neither committed nor aborted - their segments are not removed yet
+_downloads_in_progress: set[str] = set()
+_drainer_thread: threading.Thread | None = None
+_drainer_stop = threading.Event()
+
+
+def _segment_path(directory: str, number: int) -> str:
+    return join(directory, f"{_segment_prefix}{number:012d}{_segment_suffix}")
+
+
+def _segment_numbers(directory: str | None) -> list[int]:
+    if directory is None or not os.path.isdir(directory):
+        return []
+    return sorted(
+        int(name[len(_segment_prefix):-len(_segment_suffix)]) for name in os.listdir(directory)
+        if name.startswith(_segment_prefix) and name.endswith(_segment_suffix))
+
+
+def _fsync_directory(directory: str):
+    """new and removed segments are durable once the directory entry is (not available on Windows)"""
+    if INGEST_FSYNC_ and hasattr(os, "O_DIRECTORY"):
+        descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+
+def _seal_segment():
+    """close the segment being written - the next record starts a new one. Caller holds the log lock"""
+    global _segment_file
+    if _segment_file is not None:
+        _segment_file.close()
+    _segment_file = None
+
+
+def _lock_directory(directory: str, create: bool = False) -> int | None:
+    """
+    take the lock of a process directory - descriptor holding it, None when another process holds it
+
+    :param create: create the lock file - only the owner does, a directory being removed does not get it back
+    """
+    descriptor = os.open(join(directory, _lock_name), os.O_RDWR | (os.O_CREAT if create else 0))
+    if fcntl is not None:
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(descriptor)
+            return None
+    return descriptor
+
+
+def _own_directory(create: bool = False) -> str | None:
+    """
+    directory of the segments of this process - made and locked when the first record is written.
+    Caller holds the log lock
+    """
+    global _own_directory_path, _own_directory_lock, _own_directory_pid, _segment_file, _segment_number
+    if _own_directory_pid != os.getpid():
+        # forked process writes a directory of its own, the segment and downloads of its parent are not its own.
+        # Its copy of the lock would keep the directory of the parent locked after the parent ends
+        if _own_directory_lock is not None:
+            os.close(_own_directory_lock)
+        _own_directory_path = _own_directory_lock = _segment_file = _segment_number = None
+        _own_directory_pid = os.getpid()
+        _downloads_in_progress.clear()
+    elif _own_directory_path is not None and dirname(_own_directory_path) != INGEST_LOG_DIRECTORY_:
+        # log moved - directory left behind is recovered like the one of a process that ended
+        _seal_segment()
+        os.close(_own_directory_lock)
+        _own_directory_path = _own_directory_lock = _segment_number = None
+    if _own_directory_path is None and create:
+        directory = join(INGEST_LOG_DIRECTORY_, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(directory)
+        _own_directory_lock = _lock_directory(directory, create=True)
+        _own_directory_path = directory
+        _fsync_directory(INGEST_LOG_DIRECTORY_)
+    return _own_directory_path
+
+
+def _lock_orphaned_directories() -> list[tuple[str, int]]:
+    """
+    directories of the processes that ended, locked - so that only one process recovers each of them
+
+    :return: (directory, descriptor holding its lock) pairs
+    """
+    if fcntl is None or not os.path.isdir(INGEST_LOG_DIRECTORY_):
+        return []
+    orphans = []
+    for name in sorted(os.listdir(INGEST_LOG_DIRECTORY_)):
+        directory = join(INGEST_LOG_DIRECTORY_, name)
+        if directory == _own_directory_path or not os.path.isdir(directory):
+            continue
+        try:
+            descriptor = _lock_directory(directory)
+        except FileNotFoundError:  # recovered by another process meanwhile
+            continue
+        if descriptor is not None:
+            orphans.append((directory, descriptor))
+    return orphans
+
+
+def _release_orphaned_directories(orphans: list[tuple[str, int]], remove: bool = False):
+    """unlock the directories of the processes that ended - removing them, once their downloads are applied"""
+    for directory, descriptor in orphans:
+        if remove:
+            for number in _segment_numbers(directory):
+                os.remove(_segment_path(directory, number))
+            os.remove(join(directory, _lock_name))
+            os.rmdir(directory)
+        os.close(descriptor)
+    if remove and orphans:
+        _fsync_directory(INGEST_LOG_DIRECTORY_)
+
+
+def _append_record(record: dict):
+    """write a record to the segment being written and flush it to the disk"""
+    global _segment_file, _segment_number
+    payload = json.dumps(record, default=str).encode()
+    with _log_lock:
+        directory = _own_directory(create=True)
+        if _segment_file is None:
+            # segment torn by a crash is never appended to, records after its torn tail would not be read
+            _segment_number = max(_segment_numbers(directory) + [_segment_number or 0]) + 1
+            _segment_file = open(_segment_path(directory, _segment_number), "ab")
+            _fsync_directory(directory)
+        _segment_file.write(_record_header.pack(len(payload), zlib.crc32(payload)) + payload)
+        _segment_file.flush()
+        if INGEST_FSYNC_:
+            os.fsync(_segment_file.fileno())
+        if _segment_file.tell() >= INGEST_SEGMENT_MAX_BYTES_:
+            _seal_segment()
+
+
+def read_segment_(path: str) -> list[dict]:
+    """records of a segment, up to its end or its first torn record (a crash in the middle of a write)"""
+    records = []
+    with open(path, "rb") as segment:
+        content = segment.read()
+    position = 0
+    while position + _record_header.size <= len(content):
+        length, checksum = _record_header.unpack_from(content, position)
+        payload = content[position + _record_header.size:position + _record_header.size + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        records.append(json.loads(payload))
+        position += _record_header.size + length
+    return records
+
+
+@contextmanager
+def logged_download_(
+        symbol: str, time_interval: str, is_equity: bool | None = None, mic_code: str | None = None,
+        backfill: bool = False):
+    """
+    keep the pages of a download in the local log, before any of them reaches the database
+
+    yields a page callback (for ``download_market_ticker_history``) - every page it gets is written and fsync'd
+    right away. Download is committed when the block ends, pages of a download that raised are aborted
+    and never applied. Committed pages are inserted by ``drain_ingest_log``
+    :param backfill: download is the entire history of the series - it replaces the stored rows
+        (see ``backfill_time_series_``) instead of being appended to them
+    """
+    _, _, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+    download = uuid.uuid4().hex
+    series = [symbol, time_interval, mic_code, is_equity]
+    with _log_lock:
+        _downloads_in_progress.add(download)
+    try:
+        yield lambda rows: _append_record({"download": download, "kind": "page", "series": series, "rows": rows})
+    except BaseException:
+        _append_record({"download": download, "kind": "abort", "series": series})
+        raise
+    else:
+        _append_record({"download": download, "kind": "commit", "series": series, "backfill": backfill})
+    finally:
+        with _log_lock:
+            _downloads_in_progress.discard(download)
+
+
+def _apply_series_pages(series: list, pages: list[list[dict]], date_format: str, backfill: bool = False) -> int:
+    """
+    insert rows of the pages that are newer than the latest row of the series, oldest first, in a single batch
+
+    rows already stored (by an earlier drain that did not get to remove its segments) are skipped,
+    so replaying the log any number of times inserts every row once
+    :param backfill: pages replace the stored rows of the series
+    :return: number of rows inserted (rows of the series, for a backfill)
+    """
+    symbol, time_interval, mic_code, is_equity = series
+    if backfill:
+        rows = {row["datetime"]: row for page in pages for row in page}
+        return backfill_time_series_(
+            [rows[moment] for moment in sorted(rows)], symbol, time_interval, is_equity, mic_code)
+    if not time_series_table_exists_(symbol, time_interval, is_equity, mic_code):
+        create_time_series_(symbol, time_interval, is_equity, mic_code)
+    # pages overlap by a row - the last copy of a timestamp wins. Timestamps of the provider have a fixed width,
+    # so their texts sort (and compare) the same way as the dates
+    rows = {row["datetime"]: row for page in pages for row in page}
+    while True:
+        latest = time_series_latest_timestamp_(symbol, time_interval, is_equity, mic_code)
+        latest_text = latest.strftime(date_format) if latest is not None else ""
+        new_rows = [rows[moment] for moment in sorted(rows) if moment > latest_text]
+        if not new_rows:
+            return 0
+        # IDs are given by the database, right after the last stored row
+        try:
+            insert_historical_data_(new_rows, symbol, time_interval, is_equity=is_equity, mic_code=mic_code)
+        except InvalidParameterValue:
+            # another drain (or appender) stored newer rows after the latest one was read - rows are filtered
+            # again against them, the pages are not given up
+            continue
+        refresh_time_series_rollups_(symbol, time_interval, since=latest, is_equity=is_equity, mic_code=mic_code)
+        return len(new_rows)
+
+
+def drain_ingest_log_(verbose: bool = False) -> dict[tuple[str, str], int]:
+    """
+    apply committed downloads of the log to the database and remove the segments that are done
+
+    segment being written is sealed first, pages written meanwhile go to a new one. Pages of every committed
+    download of a series are merged and inserted in a single batch (a backfill replaces the series
+    with its own pages and the ones committed after it). Segments holding pages of downloads still
+    in progress stay for the next drain. Directories of the processes that ended are recovered as well,
+    pages of downloads they never finished are dropped. Directories of the processes that still run are left
+    to their owners. Safe to run again after any failure - on startup it replays what a crash left
+    :return: (schema name, table name) -> number of rows inserted
+    """
+    with _drain_lock:
+        with _log_lock:
+            directory = _own_directory()
+            _seal_segment()
+            in_progress = set(_downloads_in_progress)
+            numbers = _segment_numbers(directory)
+        segments = [_segment_path(directory, number) for number in numbers]
+        # segments left by the processes that ended were written before the ones of this process
+        orphans = _lock_orphaned_directories()
+        try:
+            inserted, segment_downloads = _apply_segments(
+                [_segment_path(orphan, number) for orphan, _ in orphans for number in _segment_numbers(orphan)]
+                + segments, verbose)
+        except BaseException:
+            _release_orphaned_directories(orphans)
+            raise
+        _release_orphaned_directories(orphans, remove=True)
+
+        removed = False
+        for path in segments:
+            if not segment_downloads[path] & in_progress:
+                os.remove(path)
+                removed = True
+        if removed:
+            _fsync_directory(directory)
+    return inserted
+
+
+def _apply_segments(paths: list[str], verbose: bool = False) -> tuple[dict[tuple[str, str], int], dict[str, set]]:
+    """
+    apply committed downloads of the segments, in the order of their records
+
+    :return: (schema name, table name) -> number of rows inserted, segment -> downloads it has records of
+    """
+    pages: dict[str, list] = {}
+    finished: dict[str, dict] = {}
+    segment_downloads: dict[str, set[str]] = {}
+    for path in paths:
+        records = read_segment_(path)
+        segment_downloads[path] = {record["download"] for record in records}
+        for record in records:
+            if record["kind"] == "page":
+                pages.setdefault(record["download"], []).append(record["rows"])
+            else:
+                finished[record["download"]] = record
+
+    series_pages: dict[tuple, list] = {}
+    backfills: set[tuple] = set()
+    # downloads are finished in the order of their records
+    for download, record in finished.items():
+        if record["kind"] == "commit":
+            if record.get("backfill"):
+                # entire history replaces whatever the downloads committed before it would append
+                series_pages[tuple(record["series"])] = []
+                backfills.add(tuple(record["series"]))
+            series_pages.setdefault(tuple(record["series"]), []).extend(pages.get(download, []))
+    inserted = {}
+    for series, committed_pages in series_pages.items():
+        date_format = '%Y-%m-%d' if series[1] == "1day" else '%Y-%m-%d %H:%M:%S'
+        schema_name, table_name, _ = resolve_time_series_location_(*series[:2], series[3], series[2])
+        inserted[(schema_name, table_name)] = _apply_series_pages(
+            list(series), committed_pages, date_format, series in backfills)
+        if verbose:
+            print(f"{schema_name}.{table_name}: {inserted[(schema_name, table_name)]} rows applied from the log")
+    return inserted, segment_downloads
+
+
+def start_ingest_drainer_(interval: float = 5., verbose: bool = False):
+    """
+    drain the log every "interval" seconds from a background thread, until stopped or the process ends
+
+    drains that fail (database is down) leave the log as it is, the next one tries again
+    """
+    global _drainer_thread
+    stop_ingest_drainer_()
+    _drainer_stop.clear()
+
+    def drain_periodically():
+        while not _drainer_stop.wait(interval):
+            try:
+                drain_ingest_log_(verbose)
+            except Exception as error:  # noqa - pages stay in the log until a drain succeeds
+                if verbose:
+                    print(f"ingest log drain failed, pages are kept: {error!r}")
+
+    _drainer_thread = threading.Thread(target=drain_periodically, name="ingest-log-drainer", daemon=True)
+    _drainer_thread.start()
+
+
+def stop_ingest_drainer_():
+    global _drainer_thread
+    if _drainer_thread is not None:
+        _drainer_stop.set()
+        _drainer_thread.join()
+        _drainer_thread = None
+
+
+def pending_ingest_log_() -> dict:
+    """
+    what the log keeps - segments, downloads committed but not drained yet, downloads in progress.
+    Segments of the processes that ended are counted, the ones of the processes still running are not
+    """
+    with _log_lock:
+        directory = _own_directory()
+        segments = [_segment_path(directory, number) for number in _segment_numbers(directory)]
+        in_progress = set(_downloads_in_progress)
+    committed, pages = set(), 0
+    # segments of the processes that ended are read while locked - another drain might be removing them
+    orphans = _lock_orphaned_directories()
+    try:
+        segments += [_segment_path(orphan, number) for orphan, _ in orphans for number in _segment_numbers(orphan)]
+        for path in segments:
+            for record in read_segment_(path):
+                pages += record["kind"] == "page"
+                if record["kind"] == "commit":
+                    committed.add(record["download"])
+    finally:
+        _release_orphaned_directories(orphans)
+    return {"segments": len(segments), "pages": pages, "committed": len(committed), "in_progress": len(in_progress)}
+
+
+if __name__ == '__main__':
+    # 1min download of 40 pages (5000 rows each) - pages inserted one by one as they come, against logging them
+    # (fsync'd) and a single drain. Download waits 8.4ms per logged page instead of ~200ms per insert,
+    # the drain itself takes as long as the inserts did (8.4s vs 7.9s) - parsing the rows dominates both
+    import tempfile
+    from datetime import datetime, timedelta
+    from time import perf_counter
+
+    import psycopg2
+    from psycopg2 import sql
+
+    from db_functions.db_helpers import _connection_dict
+
+    start_ = datetime(2020, 1, 1)
+    rows_ = [
+        {"datetime": str(start_ + timedelta(minutes=i)), "open": 100 + i % 7, "close": 100 + i % 5,
+         "high": 108, "low": 99, "volume": 1000}
+        for i in range(200_000)
+    ]
+    pages_ = [list(reversed(rows_))[i:i + 5000] for i in range(0, len(rows_), 5000)]
+    table_ = sql.Identifier("1min_time_series", "BENCH_XBEN")
+    try:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            conn_.cursor().execute(sql.SQL("""CREATE TABLE {table} ("ID" integer PRIMARY KEY, datetime timestamp,
+                open numeric(10,5), close numeric(10,5), high numeric(10,5), low numeric(10,5),
+                volume bigint);""").format(table=table_))
+        begin_ = perf_counter()
+        for number_, page_ in enumerate(pages_):
+            insert_historical_data_(
+                list(reversed(page_)), "BENCH", "1min", rownum_start=len(rows_) - 5000 * (number_ + 1),
+                is_equity=True, mic_code="XBEN")
+        per_page_ = perf_counter() - begin_
+        with psycopg2.connect(**_connection_dict) as conn_:
+            conn_.cursor().execute(sql.SQL("TRUNCATE {table};").format(table=table_))
+        with tempfile.TemporaryDirectory() as directory_:
+            INGEST_LOG_DIRECTORY_ = directory_
+            begin_ = perf_counter()
+            with logged_download_("BENCH", "1min", True, "XBEN") as log_page_:
+                for page_ in pages_:
+                    log_page_(page_)
+            logging_ = perf_counter() - begin_
+            begin_ = perf_counter()
+            drain_ingest_log_()
+            drain_ = perf_counter() - begin_
+        print(f"{len(pages_)} pages: logging {logging_ / len(pages_) * 1000:.1f}ms per page, "
+              f"drain {drain_:.2f}s, inserts per page {per_page_:.2f}s")
+    finally:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            conn_.cursor().execute(sql.SQL("DROP TABLE IF EXISTS {table};").format(table=table_))
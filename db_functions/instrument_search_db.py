@@ -0,0 +1,266 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+
+import psycopg2
+from psycopg2.errors import UndefinedFile, FeatureNotSupported
+
+from db_functions.db_helpers import _connection_dict, REGISTRY_TTL_, symbol_registry_generation_
+
+
+# searchable views, and the columns their in-process indexes complete prefixes of
+INSTRUMENT_VIEWS_ = {
+    "stocks": ("stocks_explained", ("symbol", "name")),
+    "markets": ("markets_explained", ("mic_code", "name")),
+    "forex_pairs": ("forex_pairs_explained", ("symbol", "base_currency_name", "quote_currency_name")),
+}
+
+# trigram indexes, for LIKE '%...%' filters of the materialized views - the columns searched by names.
+# Codes and symbols of currencies, markets or plans are short enough to be scanned
+_trigram_indexes = {
+    "stocks_explained_symbol_trgm_idx": ("stocks_explained", "symbol"),
+    "stocks_explained_name_trgm_idx": ("stocks_explained", "name"),
+    "stocks_explained_country_name_trgm_idx": ("stocks_explained", "country_name"),
+    "markets_explained_name_trgm_idx": ("markets_explained", "name"),
+    "forex_pairs_explained_base_currency_name_trgm_idx": ("forex_pairs_explained", "base_currency_name"),
+    "forex_pairs_explained_quote_currency_name_trgm_idx": ("forex_pairs_explained", "quote_currency_name"),
+}
+_query_create_trigram_extension = "CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;"
+_query_create_trigram_index = \
+    "CREATE INDEX IF NOT EXISTS {index_name} ON \"public\".{table_name} USING gin ({column} public.gin_trgm_ops);"
+_query_drop_trigram_index = "DROP INDEX IF EXISTS \"public\".{index_name};"
+
+# select queries
+_query_fetch_instrument_view = "SELECT * FROM \"public\".{view_name};"
+
+# index kind -> (index, generation of the symbol registry it was loaded at, time of the load)
+_instrument_indexes: dict[str, tuple] = {}
+_instrument_indexes_lock = threading.Lock()
+
+
+def create_trigram_indexes_() -> bool:
+    """
+    create pg_trgm extension and trigram (GIN) indexes used by LIKE filters of ``fetch_stocks``,
+    ``fetch_markets`` and ``fetch_forex_pairs`` - leading wildcards stop forcing a scan of the whole view
+
+    pg_trgm is a contrib module, servers without it keep working without the indexes
+    :return: False if the extension is not available on the server
+    """
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(_query_create_trigram_extension)
+        except (UndefinedFile, FeatureNotSupported):
+            return False
+        for index_name, (table_name, column) in _trigram_indexes.items():
+            cur.execute(_query_create_trigram_index.format(
+                index_name=index_name, table_name=table_name, column=column))
+    return True
+
+
+def drop_trigram_indexes_():
+    """remove trigram indexes (extension stays, other objects may use it)"""
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        for index_name in _trigram_indexes:
+            cur.execute(_query_drop_trigram_index.format(index_name=index_name))
+
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _like_to_regex(pattern: str, case_sensitive: bool = True) -> re.Pattern:
+    """LIKE pattern as a regular expression - % is any text, _ any character and a backslash escapes them"""
+    parts, escaped = [], False
+    for character in pattern:
+        if escaped:
+            parts.append(re.escape(character))
+            escaped = False
+        elif character == "\\":
+            escaped = True
+        elif character == "%":
+            parts.append(".*")
+        elif character == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(character))
+    return re.compile("".join(parts), re.DOTALL if case_sensitive else re.DOTALL | re.IGNORECASE)
+
+
+def _like_fragments(pattern: str) -> list[str]:
+    """literal parts of the LIKE pattern, every matching text contains each of them"""
+    return [fragment.replace("\\", "") for fragment in re.split(r"(?<!\\)[%_]", pattern) if fragment]
+
+
+class InstrumentIndex_:
+    """
+    in-process index of a snapshot of rows - sorted keys for prefix completion and lowercase trigram postings
+    for LIKE filters, which narrow the rows down before the patterns are checked
+
+    rows are kept as they come from the view, results follow their order
+    """
+
+    def __init__(self, rows: list[tuple], columns: list[str], completed_columns: tuple[str, ...] = ()):
+        self.rows = rows
+        self.columns = list(columns)
+        self._positions = {column: position for position, column in enumerate(self.columns)}
+        # column -> lowercase trigram / distinct value -> numbers of the rows having it
+        self._postings: dict[str, dict[str, set[int]]] = {}
+        self._values: dict[str, dict[str, list[int]]] = {}
+        for column, position in self._positions.items():
+            values = self._values[column] = {}
+            for row_number, row in enumerate(rows):
+                if isinstance(row[position], str):
+                    values.setdefault(row[position], []).append(row_number)
+            postings = self._postings[column] = {}
+            for value, row_numbers in values.items():
+                for trigram in _trigrams(value.lower()):
+                    postings.setdefault(trigram, set()).update(row_numbers)
+        # column -> sorted (lowercase value, row number)
+        self._sorted_keys = {
+            column: sorted(
+                (row[self._positions[column]].lower(), row_number) for row_number, row in enumerate(rows)
+                if isinstance(row[self._positions[column]], str))
+            for column in completed_columns
+        }
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def complete(self, prefix: str, column: str | None = None, limit: int = 10) -> list[tuple]:
+        """
+        rows whose value starts with given prefix (case-insensitive), shortest values first - for autocomplete
+
+        :param column: one of the completed columns, every completed column when not given
+        """
+        prefix = prefix.lower()
+        columns = [column] if column is not None else list(self._sorted_keys)
+        found: dict[int, str] = {}
+        for column_ in columns:
+            if column_ not in self._sorted_keys:
+                raise ValueError(f"column {column_} is not completed. Completed columns: {tuple(self._sorted_keys)}")
+            keys = self._sorted_keys[column_]
+            for position in range(bisect_left(keys, (prefix, -1)), len(keys)):
+                key, row_number = keys[position]
+                if not key.startswith(prefix):
+                    break
+                if row_number not in found or len(key) < len(found[row_number]):
+                    found[row_number] = key
+        best = sorted(found, key=lambda row_number: (len(found[row_number]), found[row_number]))[:limit]
+        return [self.rows[row_number] for row_number in best]
+
+    def match(self, case_sensitive: bool = True, **column_patterns: str) -> list[tuple]:
+        """
+        rows matching every LIKE pattern given for the columns - the same rows the view gives for the filters
+
+        example: ``match(symbol="A%", country_name="%U%S%")``
+        """
+        matching: set[int] | None = None
+        for column, pattern in column_patterns.items():
+            if column not in self._positions:
+                raise ValueError(f"unknown column {column}. Possible columns: {tuple(self.columns)}")
+            if pattern == "":
+                raise ValueError('empty values passed as "" are not valid for the query')
+            regex = _like_to_regex(pattern, case_sensitive)
+            postings = [self._postings[column].get(trigram, set())
+                        for fragment in _like_fragments(pattern) for trigram in _trigrams(fragment.lower())]
+            if postings:
+                # rarest trigrams first - the intersection shrinks the fastest
+                postings.sort(key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+                if matching is not None:
+                    candidates &= matching
+                position = self._positions[column]
+                matching = {row_number for row_number in candidates if regex.fullmatch(self.rows[row_number][position])}
+            else:
+                # pattern without three letters in a row - checked once per distinct value of the column
+                found = set()
+                for value, row_numbers in self._values[column].items():
+                    if regex.fullmatch(value):
+                        found.update(row_numbers)
+                matching = found if matching is None else matching & found
+            if not matching:
+                return []
+        if matching is None:
+            return list(self.rows)
+        return [self.rows[row_number] for row_number in sorted(matching)]
+
+
+def load_instrument_index_(kind: str) -> InstrumentIndex_:
+    """read the whole view of given kind ("stocks", "markets" or "forex_pairs") and index it"""
+    if kind not in INSTRUMENT_VIEWS_:
+        raise ValueError(f"unknown instrument kind {kind}. Possible kinds: {tuple(INSTRUMENT_VIEWS_)}")
+    view_name, completed_columns = INSTRUMENT_VIEWS_[kind]
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_fetch_instrument_view.format(view_name=view_name))
+        rows = cur.fetchall()
+        columns = [column.name for column in cur.description]
+    return InstrumentIndex_(rows, columns, completed_columns)
+
+
+def instrument_index_(kind: str) -> InstrumentIndex_:
+    """
+    index of the instruments kept for the process - loaded again when symbols or markets are inserted
+    (in this process) or after REGISTRY_TTL_ seconds
+    """
+    generation = symbol_registry_generation_()
+    with _instrument_indexes_lock:
+        cached = _instrument_indexes.get(kind)
+    if cached is not None and cached[1] == generation and time.monotonic() - cached[2] < REGISTRY_TTL_:
+        return cached[0]
+    index = load_instrument_index_(kind)
+    with _instrument_indexes_lock:
+        _instrument_indexes[kind] = (index, generation, time.monotonic())
+    return index
+
+
+def search_instruments_(
+        kind: str, prefix: str | None = None, limit: int = 10, case_sensitive: bool = True,
+        **column_patterns: str) -> list[tuple]:
+    """
+    search the instruments of given kind in memory, instead of querying the view
+
+    with a prefix - rows completing it (up to limit, see ``InstrumentIndex.complete``), otherwise rows
+    matching LIKE patterns of the columns (see ``InstrumentIndex.match``)
+    """
+    index = instrument_index_(kind)
+    if prefix is not None:
+        return index.complete(prefix, limit=limit)
+    return index.match(case_sensitive=case_sensitive, **column_patterns)
+
+
+if __name__ == '__main__':
+    # 20k synthetic instruments - lookups of the index against checking the pattern on every row.
+    # Prefix 0.035ms vs 7.1ms, '%Pharma Mining 12%' 0.064ms vs 4.6ms, '%U%S%' (no trigram) 0.83ms vs 4.9ms
+    from random import choice, randint, seed
+    from string import ascii_uppercase
+    from time import perf_counter
+
+    seed(1)
+    words_ = ["Holdings", "Corp", "Inc", "Group", "Energy", "Capital", "Bank", "Technologies", "Pharma", "Mining"]
+    rows_ = [
+        (i, "".join(choice(ascii_uppercase) for _ in range(randint(2, 5))),
+         f"{choice(words_)} {choice(words_)} {choice(words_)} {i}", choice(["United States", "Germany", "Japan"]))
+        for i in range(20_000)
+    ]
+    start_ = perf_counter()
+    index_ = InstrumentIndex_(rows_, ["ID", "symbol", "name", "country_name"], ("symbol", "name"))
+    print(f"index of {len(rows_)} rows built in {perf_counter() - start_:.2f}s")
+    for label_, lookup_, scan_ in [
+        ("prefix 'AB'", lambda: index_.complete("AB"),
+         lambda: [row for row in rows_ if row[1].lower().startswith("ab") or row[2].lower().startswith("ab")]),
+        ("name '%Pharma Mining 12%'", lambda: index_.match(name="%Pharma Mining 12%"),
+         lambda regex_=_like_to_regex("%Pharma Mining 12%"): [row for row in rows_ if regex_.fullmatch(row[2])]),
+        ("country '%U%S%'", lambda: index_.match(country_name="%U%S%"),
+         lambda regex_=_like_to_regex("%U%S%"): [row for row in rows_ if regex_.fullmatch(row[3])]),
+    ]:
+        timings_ = []
+        for function_ in (lookup_, scan_):
+            start_ = perf_counter()
+            for _ in range(20):
+                function_()
+            timings_.append((perf_counter() - start_) / 20 * 1000)
+        print(f"{label_:>26}: index {timings_[0]:.3f}ms, scan {timings_[1]:.3f}ms")
@@ -0,0 +1,221 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2 import sql
+
+from db_functions.db_helpers import shard_connection_dict_
+
+
+# tables that got this many rows since their last analyze are analyzed in the background
+MAINTENANCE_ENABLED_ = True
+ANALYZE_MIN_ROWS_ = 10_000
+# ... or this fraction of the rows they had at the last analyze, whichever is more
+ANALYZE_FRACTION_ = 0.1
+# new rows making this much of the table are vacuumed as well - visibility map lets range queries scan index only
+VACUUM_FRACTION_ = 0.5
+# maintenance runs at most on this many tables at once
+MAINTENANCE_MAX_WORKERS_ = 2
+# maintenance waits until no load was running in the process for this many seconds
+MAINTENANCE_QUIET_PERIOD_ = 1.
+
+# maintenance queries
+_query_analyze_table = sql.SQL("ANALYZE {table};")
+_query_vacuum_analyze_table = sql.SQL("VACUUM (ANALYZE) {table};")
+_query_estimated_rows = "SELECT greatest(cls.reltuples, 0)::bigint FROM pg_class cls WHERE cls.oid = to_regclass(%s);"
+
+_maintenance_lock = threading.Lock()
+# load running in the process holds maintenance off, its end wakes up the waiting workers
+_activity = threading.Condition(_maintenance_lock)
+_active_loads = 0
+_last_load_finished = float("-inf")
+# (schema name, table name) -> rows written since the last analyze and what the maintenance has done to the table
+_tables: dict[tuple[str, str], dict] = {}
+_scheduled: dict[tuple[str, str], Future] = {}
+# maintenance that is scheduled or running
+_pending: set[Future] = set()
+_executor: ThreadPoolExecutor | None = None
+_executor_pid: int | None = None
+
+
+def _table_entry(schema_name: str, table_name: str) -> dict:
+    """entry of the table. Caller holds the maintenance lock"""
+    key = (schema_name, table_name)
+    if key not in _tables:
+        _tables[key] = {
+            "written": 0, "analyzed_rows": 0, "analyzes": 0, "vacuums": 0,
+            "last_maintenance": None, "last_error": None,
+        }
+    return _tables[key]
+
+
+@contextmanager
+def track_ingestion_(schema_name: str, table_name: str, rows: int):
+    """
+    mark a load of rows into the table - maintenance of any table waits for it to end
+
+    rows are counted as written once the load succeeds, which may schedule maintenance of the table
+    """
+    global _active_loads, _last_load_finished
+    with _activity:
+        _active_loads += 1
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        with _activity:
+            _active_loads -= 1
+            _last_load_finished = time.monotonic()
+            _activity.notify_all()
+        if succeeded:
+            record_rows_written_(schema_name, table_name, rows)
+
+
+def record_rows_written_(schema_name: str, table_name: str, rows: int) -> bool:
+    """
+    count rows written into the table, and schedule its maintenance when enough of them piled up
+
+    :return: True if maintenance of the table is scheduled (now or by one of the earlier calls)
+    """
+    with _maintenance_lock:
+        entry = _table_entry(schema_name, table_name)
+        entry["written"] += rows
+        key = (schema_name, table_name)
+        if key in _scheduled:
+            return True
+        if not MAINTENANCE_ENABLED_ or \
+                entry["written"] < max(ANALYZE_MIN_ROWS_, ANALYZE_FRACTION_ * entry["analyzed_rows"]):
+            return False
+        future = _scheduled[key] = _maintenance_executor().submit(_maintain_when_quiet, schema_name, table_name)
+        _pending.add(future)
+        future.add_done_callback(_pending.discard)
+        return True
+
+
+def _maintenance_executor() -> ThreadPoolExecutor:
+    """worker pool of the process. Caller holds the maintenance lock"""
+    global _executor, _executor_pid, _scheduled, _pending
+    # threads of the parent do not exist in the forked process
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(MAINTENANCE_MAX_WORKERS_, thread_name_prefix="db-maintenance")
+        _executor_pid = os.getpid()
+        _scheduled, _pending = {}, set()
+    return _executor
+
+
+def _maintain_when_quiet(schema_name: str, table_name: str):
+    with _activity:
+        while True:
+            remaining = _last_load_finished + MAINTENANCE_QUIET_PERIOD_ - time.monotonic()
+            if not _active_loads and remaining <= 0:
+                break
+            _activity.wait(MAINTENANCE_QUIET_PERIOD_ if _active_loads else remaining)
+        del _scheduled[(schema_name, table_name)]
+    maintain_table_(schema_name, table_name)
+
+
+def maintain_table_(schema_name: str, table_name: str, vacuum: bool | None = None) -> bool:
+    """
+    ANALYZE the table right away - with VACUUM when new rows make most of it
+
+    :param vacuum: force VACUUM on or off, by default it is decided out of rows written since the last analyze
+    :return: True if the table was vacuumed as well
+    """
+    with _maintenance_lock:
+        entry = _table_entry(schema_name, table_name)
+        written = entry["written"]
+        if vacuum is None:
+            vacuum = written >= VACUUM_FRACTION_ * (entry["analyzed_rows"] + written)
+    query = _query_vacuum_analyze_table if vacuum else _query_analyze_table
+    try:
+        # VACUUM can't run inside a transaction block
+        conn = psycopg2.connect(**shard_connection_dict_(schema_name, table_name))
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(query.format(table=sql.Identifier(schema_name, table_name)))
+            cur.execute(_query_estimated_rows, (sql.Identifier(schema_name, table_name).as_string(cur),))
+            analyzed_rows = cur.fetchone()
+        finally:
+            conn.close()
+    except psycopg2.Error as error:
+        with _maintenance_lock:
+            entry["last_error"] = str(error).strip()
+        raise
+    with _maintenance_lock:
+        entry["written"] -= written
+        entry["analyzed_rows"] = analyzed_rows[0] if analyzed_rows else 0
+        entry["analyzes"] += 1
+        entry["vacuums"] += vacuum
+        entry["last_maintenance"] = datetime.now(timezone.utc)
+        entry["last_error"] = None
+    return vacuum
+
+
+def forget_table_maintenance_(schema_name: str, table_name: str):
+    """drop what is counted for the table - a new table under the same name starts from scratch"""
+    with _maintenance_lock:
+        _tables.pop((schema_name, table_name), None)
+
+
+def wait_for_maintenance_(timeout: float | None = None) -> bool:
+    """
+    block until the scheduled maintenance is done - for the scripts that query the tables right after the load
+
+    :return: False if some of the maintenance is still not done after timeout
+    """
+    with _maintenance_lock:
+        pending = list(_pending)
+    done, not_done = wait(pending, timeout)
+    return not not_done
+
+
+def maintenance_statistics_() -> dict[tuple[str, str], dict]:
+    """(schema name, table name) -> rows written since the last analyze, analyzes and vacuums done, last error"""
+    with _maintenance_lock:
+        return {key: {**entry, "scheduled": key in _scheduled} for key, entry in _tables.items()}
+
+
+if __name__ == '__main__':
+    # range query on a freshly loaded table - right after the load and after the maintenance it schedules.
+    # Without statistics the planner expects 2309 of 87841 rows (bitmap heap scan, 8.2ms), after VACUUM (ANALYZE)
+    # the estimate is right and the visibility map allows an index only scan (7.4ms)
+    from time import perf_counter
+
+    table_ = sql.Identifier("1min_time_series", "BENCH_XBEN")
+    # maintenance goes to the shard the table is placed on
+    bench_connection_dict_ = shard_connection_dict_("1min_time_series", "BENCH_XBEN")
+    with psycopg2.connect(**bench_connection_dict_) as conn_:
+        cur_ = conn_.cursor()
+        cur_.execute(sql.SQL("""CREATE TABLE {table} ("ID" integer PRIMARY KEY, datetime timestamp NOT NULL,
+            close numeric(10,5)) WITH (autovacuum_enabled = false);
+            CREATE INDEX ON {table} (datetime);""").format(table=table_))
+    try:
+        with track_ingestion_("1min_time_series", "BENCH_XBEN", 500_000), \
+                psycopg2.connect(**bench_connection_dict_) as conn_:
+            cur_ = conn_.cursor()
+            cur_.execute(sql.SQL("""INSERT INTO {table} SELECT i, TIMESTAMP '2000-01-03' + i * INTERVAL '1 minute',
+                100 + i % 100 FROM generate_series(0, 499999) i;""").format(table=table_))
+        range_query_ = sql.SQL("""SELECT count(*) FROM {table} series
+            WHERE series.datetime BETWEEN TIMESTAMP '2000-03-01' AND TIMESTAMP '2000-05-01';""").format(table=table_)
+        for stage_ in ("after the load", "after maintenance"):
+            if stage_ == "after maintenance":
+                wait_for_maintenance_()
+            with psycopg2.connect(**bench_connection_dict_) as conn_:
+                cur_ = conn_.cursor()
+                start_ = perf_counter()
+                for _ in range(20):
+                    cur_.execute(range_query_)
+                elapsed_ = (perf_counter() - start_) / 20
+                cur_.execute(sql.SQL("EXPLAIN ") + range_query_)
+                plan_ = cur_.fetchall()[1][0].strip(" ->")
+            print(f"{stage_:>17}: {elapsed_ * 1000:.2f}ms per query, {plan_}")
+        print(maintenance_statistics_()[("1min_time_series", "BENCH_XBEN")])
+    finally:
+        with psycopg2.connect(**bench_connection_dict_) as conn_:
+            conn_.cursor().execute(sql.SQL("DROP TABLE {table};").format(table=table_))
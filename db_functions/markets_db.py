@@ -1,7 +1,8 @@
 from ast import literal_eval
 
 import psycopg2
-from db_functions.db_helpers import _connection_dict, db_string_converter_
+from db_functions.db_helpers import _connection_dict, db_string_converter_, invalidate_symbol_registry_
+from db_functions.db_views import refresh_reference_views_
 
 
 # insert queries
@@ -80,7 +81,7 @@ def insert_plans_(plans: set[str]):
         cur.close()
 
 
-def insert_markets_(markets: list[dict]):
+def insert_markets_(markets: list[dict], refresh_views: bool = True):
     with psycopg2.connect(**_connection_dict) as conn:
         cur = conn.cursor()
         for index, market in enumerate(sorted(markets, key=lambda x: x['name'])):
@@ -99,6 +100,9 @@ def insert_markets_(markets: list[dict]):
             cur.execute(_query_insert_markets.format(**query_dict))
             conn.commit()
         cur.close()
+    invalidate_symbol_registry_()
+    if refresh_views:
+        refresh_reference_views_(("markets_explained", "stocks_explained"))
 
 
 def fetch_markets_(
@@ -0,0 +1,373 @@
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from db_functions.db_helpers import (
+    _connection_dict, _shard_connection_dicts, db_string_converter_, forget_series_table_, shard_connection_dict_,
+)
+from db_functions.maintenance_db import track_ingestion_
+from db_functions.series_catalog_db import delete_series_catalog_, list_series_tables_
+from db_functions.shards_db import MOVE_SPOOL_MAX_BYTES_
+from db_functions.time_series_db import resolve_time_series_location_, fetch_price_scale_
+from minor_modules import time_interval_sanitizer
+
+
+# insert queries
+_query_register_partitioned_series = """
+INSERT INTO "public".partitioned_series (symbol, mic_code, time_interval, is_equity)
+VALUES ({symbol}, {mic_code}, {time_interval}, {is_equity})
+ON CONFLICT (symbol, time_interval, (COALESCE(mic_code, ''))) DO NOTHING;
+"""
+_query_create_series_partitions = "select public.create_series_partitions({time_interval}, {since}, {until});"
+_query_insert_partitioned_data = """
+INSERT INTO "partitioned_time_series".candles_{time_interval}
+(series_id, "ID", datetime, open, close, high, low, volume) VALUES %s;
+"""
+_query_migrated_rows = """
+SELECT {series_id}, series."ID", series.datetime, {open}, {close}, {high}, {low}, {volume}
+FROM "{schema_name}"."{table_name}" series
+"""
+_query_migrate_series = """
+INSERT INTO "partitioned_time_series".candles_{time_interval}
+(series_id, "ID", datetime, open, close, high, low, volume)
+{migrated_rows}
+ON CONFLICT (series_id, datetime) DO NOTHING;
+"""
+# series kept by another shard travel through a temporary table of the database with partitioned storage
+_query_copy_migrated_rows = "COPY ({migrated_rows}) TO STDOUT;"
+_query_create_migrated_rows = """
+CREATE TEMPORARY TABLE migrated_rows (LIKE "partitioned_time_series".candles_{time_interval}) ON COMMIT DROP;
+"""
+_query_copy_into_migrated_rows = "COPY migrated_rows FROM STDIN;"
+
+# select queries
+# appends of the same series wait for each other, so each one continues the IDs where the previous one ended -
+# after the latest row of the series (found by the (series_id, datetime) key), which is also the row of the last ID
+_query_allocate_partitioned_IDs = """
+SELECT pg_advisory_xact_lock(hashtext('partitioned_time_series.candles_{time_interval}'), {series_id});
+SELECT candles."ID" + 1, candles.datetime FROM "partitioned_time_series".candles_{time_interval} candles
+WHERE candles.series_id = {series_id} ORDER BY candles.datetime DESC LIMIT 1;
+"""
+_query_get_partitioned_series_ID = """
+SELECT p_ser."ID" FROM "public".partitioned_series p_ser
+WHERE p_ser.symbol = {symbol} AND p_ser.time_interval = {time_interval} AND COALESCE(p_ser.mic_code, '') = {mic_code};
+"""
+_query_get_partitioned_data = """
+SELECT candles."ID", candles.datetime, candles.open, candles.close, candles.high, candles.low {optional_volume}
+FROM "partitioned_time_series".candles_{time_interval} candles
+WHERE candles.series_id = {series_id} {optional_filter} ORDER BY candles.datetime;
+"""
+_query_get_partitioned_snapshot = """
+SELECT p_ser.symbol, p_ser.mic_code, last_candle.datetime, last_candle.open, last_candle.close,
+    last_candle.high, last_candle.low, last_candle.volume
+FROM "public".partitioned_series p_ser
+CROSS JOIN LATERAL (
+    SELECT * FROM "partitioned_time_series".candles_{time_interval} candles
+    WHERE candles.series_id = p_ser."ID" AND candles.datetime <= TIMESTAMP '{moment}'
+    ORDER BY candles.datetime DESC LIMIT 1
+) last_candle
+WHERE p_ser.time_interval = {time_interval_str}
+ORDER BY p_ser.symbol, p_ser.mic_code;
+"""
+_query_source_date_range = """
+SELECT min(series.datetime), max(series.datetime), count(*) FROM "{schema_name}"."{table_name}" series;
+"""
+_query_source_largest_price = """
+SELECT max(greatest(abs(series.open), abs(series.close), abs(series.high), abs(series.low)))
+FROM "{schema_name}"."{table_name}" series;
+"""
+
+# drop queries
+_drop_table = 'DROP TABLE IF EXISTS "{schema_name}"."{table_name}";'
+
+# prices of partitioned storage are numeric(10,5)
+PARTITIONED_PRICE_SCALE_ = 5
+PARTITIONED_PRICE_LIMIT_ = 10 ** 5
+
+
+def _mic_value(mic_code: str | None) -> str:
+    return db_string_converter_(mic_code) if mic_code is not None else "NULL"
+
+
+@time_interval_sanitizer()
+def register_partitioned_series_(
+        symbol: str, time_interval: str, is_equity: bool | None = None, mic_code: str | None = None) -> int:
+    """
+    give the series its ID in the partitioned storage - registering the same series again only returns its ID
+
+    :return: ID of the series - the partition key of "candles_{time_interval}"
+    """
+    _, __, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+    q = {
+        "symbol": db_string_converter_(symbol),
+        "mic_code": _mic_value(mic_code),
+        "time_interval": db_string_converter_(time_interval),
+        "is_equity": "true" if is_equity else "false",
+    }
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_register_partitioned_series.format(**q))
+        cur.execute(_query_get_partitioned_series_ID.format(
+            symbol=q["symbol"], time_interval=q["time_interval"], mic_code=db_string_converter_(mic_code or "")))
+        res = cur.fetchall()
+    return res[0][0]
+
+
+def partitioned_series_ID_(symbol: str, time_interval: str, mic_code: str | None = None) -> int | None:
+    """
+    find the ID of the series in the partitioned storage, None when it is not registered
+
+    this is the partitioned counterpart of ``time_series_table_exists`` - a primary key lookup
+    in a small table, instead of a search through the catalog of thousands of tables
+    """
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_get_partitioned_series_ID.format(
+            symbol=db_string_converter_(symbol), time_interval=db_string_converter_(time_interval),
+            mic_code=db_string_converter_(mic_code or "")))
+        res = cur.fetchall()
+    return res[0][0] if res else None
+
+
+def _create_partitions(cur, time_interval: str, since: datetime, until: datetime):
+    """make sure partitions for every date range between the dates exist, before rows get inserted"""
+    cur.execute(_query_create_series_partitions.format(
+        time_interval=db_string_converter_(time_interval),
+        since=f"TIMESTAMP '{since}'", until=f"TIMESTAMP '{until}'"))
+
+
+@time_interval_sanitizer()
+def insert_partitioned_data_(
+        historical_data: list[dict], symbol: str, time_interval: str,
+        rownum_start: int | None = None, is_equity: bool | None = None, mic_code: str | None = None):
+    """
+    Insert historical data of the series into partitioned storage, registering the series when needed
+
+    counterpart of ``insert_historical_data`` - rows are inserted from the oldest one, range partitions
+    covering the dates of the data are created beforehand. All the rows travel in a single statement.
+    IDs continue from the last stored row of the series, unless "rownum_start" says otherwise - rows that are not
+    newer than that row are refused with psycopg2.DataError then, so ID order stays the datetime order
+    """
+    series_id = partitioned_series_ID_(symbol, time_interval, mic_code)
+    if series_id is None:
+        series_id = register_partitioned_series_(symbol, time_interval, is_equity, mic_code)
+    timestring = '%Y-%m-%d' if time_interval == '1day' else '%Y-%m-%d %H:%M:%S'
+    if datetime.strptime(historical_data[0]['datetime'], timestring) > \
+            datetime.strptime(historical_data[-1]['datetime'], timestring):
+        historical_data = list(reversed(historical_data))
+    rows = [
+        [series_id, rownum, candle['datetime'], candle['open'], candle['close'],
+         candle['high'], candle['low'], candle.get('volume')]
+        for rownum, candle in enumerate(historical_data)
+    ]
+    # autovacuum never analyzes partitioned tables themselves, only their partitions
+    with track_ingestion_("partitioned_time_series", f"candles_{time_interval}", len(rows)), \
+            psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        if rownum_start is None:
+            cur.execute(_query_allocate_partitioned_IDs.format(time_interval=time_interval, series_id=series_id))
+            latest = cur.fetchone()
+            rownum_start = 0 if latest is None else latest[0]
+            if latest is not None and datetime.strptime(rows[0][2], timestring) <= latest[1]:
+                raise psycopg2.DataError(f"rows of {symbol} {time_interval} starting at {rows[0][2]} "
+                                         f"do not follow its last row ({latest[1]})")
+        for row in rows:
+            row[1] += rownum_start
+        _create_partitions(cur, time_interval, rows[0][2], rows[-1][2])
+        execute_values(cur, _query_insert_partitioned_data.format(time_interval=time_interval), rows, page_size=1000)
+
+
+@time_interval_sanitizer()
+def fetch_partitioned_data_(
+        symbol: str, time_interval: str, mic_code: str | None = None,
+        start_date: datetime | None = None, end_date: datetime | None = None) -> list[tuple]:
+    """
+    Obtain rows of the series from partitioned storage, optionally between the dates (both inclusive)
+
+    filters on series ID and datetime let the planner skip every partition that can't hold the rows.
+    Rows have the same layout as the rows of per-symbol tables: ("ID", datetime, open, close, high, low, [volume])
+    """
+    series_id = partitioned_series_ID_(symbol, time_interval, mic_code)
+    if series_id is None:
+        return []
+    brackets = []
+    if start_date is not None:
+        brackets.append(f"AND candles.datetime >= TIMESTAMP '{start_date}'")
+    if end_date is not None:
+        brackets.append(f"AND candles.datetime <= TIMESTAMP '{end_date}'")
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_get_partitioned_data.format(
+            time_interval=time_interval, series_id=series_id, optional_filter=" ".join(brackets),
+            optional_volume=", candles.volume" if mic_code is not None else ""))
+        res = cur.fetchall()
+    return res
+
+
+@time_interval_sanitizer()
+def fetch_partitioned_snapshot_(time_interval: str, moment: datetime) -> list[tuple]:
+    """
+    the last candle of every series in partitioned storage, at given moment - a query across all the symbols
+
+    :return: rows of (symbol, mic_code, datetime, open, close, high, low, volume)
+    """
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_get_partitioned_snapshot.format(
+            time_interval=time_interval, time_interval_str=db_string_converter_(time_interval), moment=moment))
+        res = cur.fetchall()
+    return res
+
+
+def migrate_time_series_to_partitioned_(
+        symbol: str, time_interval: str, is_equity: bool | None = None, mic_code: str | None = None,
+        drop_source: bool = False, shard: int | None = None) -> int:
+    """
+    copy the per-symbol table of the series into partitioned storage
+
+    rows that are already present are skipped, so an interrupted migration can simply be repeated.
+    Series kept by the database of the partitioned storage are copied by a single statement, series of other
+    shards are streamed over. Fixed-point prices are decoded on the way, partitioned storage keeps numeric prices -
+    series whose prices do not fit in them (too large, or with more decimal places) are refused
+    with ``psycopg2.DataError``
+
+    :param drop_source: remove per-symbol table after the copy
+    :param shard: shard keeping the table, the one it is placed on by default
+    :return: number of rows copied
+    """
+    schema_name, table_name, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+    source = shard_connection_dict_(schema_name, table_name) if shard is None else _shard_connection_dicts[shard]
+    with psycopg2.connect(**source) as conn:
+        cur = conn.cursor()
+        price_scale = fetch_price_scale_(schema_name, table_name, cursor=cur)
+        if price_scale is not None and price_scale > PARTITIONED_PRICE_SCALE_:
+            raise psycopg2.DataError(
+                f"{schema_name}.{table_name}: prices with {price_scale} decimal places would be rounded "
+                f"in partitioned storage (up to {PARTITIONED_PRICE_SCALE_})")
+        if price_scale is not None:
+            cur.execute(_query_source_largest_price.format(schema_name=schema_name, table_name=table_name))
+            largest = cur.fetchall()[0][0]
+            if largest is not None and largest >= PARTITIONED_PRICE_LIMIT_ * 10 ** price_scale:
+                raise psycopg2.DataError(
+                    f"{schema_name}.{table_name}: prices up to {largest / 10 ** price_scale} do not fit "
+                    f"in partitioned storage (below {PARTITIONED_PRICE_LIMIT_})")
+        cur.execute(_query_source_date_range.format(schema_name=schema_name, table_name=table_name))
+        since, until, rows = cur.fetchall()[0]
+    series_id = register_partitioned_series_(symbol, time_interval, is_equity, mic_code)
+    prices = {
+        price: f"series.{price}" if price_scale is None else f"series.{price}::numeric / {10 ** price_scale}"
+        for price in ["open", "close", "high", "low"]
+    }
+    migrated_rows = _query_migrated_rows.format(
+        series_id=series_id, schema_name=schema_name, table_name=table_name,
+        volume="series.volume" if is_equity else "NULL::bigint", **prices)
+    copied = 0
+    if rows and source is _connection_dict:
+        with psycopg2.connect(**_connection_dict) as conn:
+            cur = conn.cursor()
+            _create_partitions(cur, time_interval, since, until)
+            cur.execute(_query_migrate_series.format(time_interval=time_interval, migrated_rows=migrated_rows))
+            copied = cur.rowcount
+    elif rows:
+        with psycopg2.connect(**source) as source_conn, psycopg2.connect(**_connection_dict) as conn, \
+                SpooledTemporaryFile(max_size=MOVE_SPOOL_MAX_BYTES_) as spool:
+            source_conn.cursor().copy_expert(_query_copy_migrated_rows.format(migrated_rows=migrated_rows), spool)
+            spool.seek(0)
+            cur = conn.cursor()
+            _create_partitions(cur, time_interval, since, until)
+            cur.execute(_query_create_migrated_rows.format(time_interval=time_interval))
+            cur.copy_expert(_query_copy_into_migrated_rows, spool)
+            cur.execute(_query_migrate_series.format(
+                time_interval=time_interval, migrated_rows="SELECT * FROM migrated_rows"))
+            copied = cur.rowcount
+    if drop_source:
+        with psycopg2.connect(**source) as conn:
+            cur = conn.cursor()
+            cur.execute(_drop_table.format(schema_name=schema_name, table_name=table_name))
+            delete_series_catalog_(schema_name, table_name, cursor=cur)
+        forget_series_table_(schema_name, table_name)
+    return copied
+
+
+def migrate_all_time_series_to_partitioned_(drop_source: bool = False, verbose: bool = False) -> dict[str, int]:
+    """
+    migrate every per-symbol table of the three time series schemas, on every shard (rollups are skipped -
+    they can be rebuilt)
+
+    :return: "schema.table" -> number of rows copied
+    """
+    migrated = {}
+    for shard, schema_name, table_name in list_series_tables_():
+        if schema_name == "forex_time_series":
+            base, quote, time_interval = table_name.split("_")
+            symbol, mic_code, is_equity = f"{base}/{quote}", None, False
+        else:
+            symbol, mic_code = table_name.rsplit("_", 1)
+            time_interval, is_equity = schema_name.split("_")[0], True
+        migrated[f"{schema_name}.{table_name}"] = migrate_time_series_to_partitioned_(
+            symbol, time_interval, is_equity, mic_code, drop_source, shard)
+        if verbose:
+            print(f"{schema_name}.{table_name}: {migrated[f'{schema_name}.{table_name}']} rows")
+    return migrated
+
+
+if __name__ == '__main__':
+    # catalog-heavy operations with one table per symbol, compared to the partitioned storage
+    from time import perf_counter
+
+    from db_functions.db_helpers import _information_schema_table_check
+    from db_functions.time_series_db import _create_time_table, NUMERIC_PRICE_TYPE_
+
+    series_count, moment_ = 1000, datetime(2023, 1, 5)
+    symbols = [f"BENCH{i}" for i in range(series_count)]
+    conn_ = psycopg2.connect(**_connection_dict)
+    conn_.autocommit = True
+    cur_ = conn_.cursor()
+    start_ = perf_counter()
+    for s in symbols:
+        cur_.execute(_create_time_table.format(
+            time_interval="1day", symbol=s, market_identification_code="XBEN", lower_symbol=s.lower(),
+            price_type=NUMERIC_PRICE_TYPE_))
+        cur_.execute(f"""INSERT INTO "1day_time_series"."{s}_XBEN" VALUES (0, '{moment_}', 1, 2, 3, 0.5, 10)""")
+    print(f"creating {series_count} per-symbol tables: {perf_counter() - start_:.3f}s")
+    start_ = perf_counter()
+    for s in symbols:
+        cur_.execute(_query_register_partitioned_series.format(
+            symbol=db_string_converter_(s), mic_code="'XBEN'", time_interval="'1day'", is_equity="true"))
+    cur_.execute("""SELECT p_ser."ID" FROM "public".partitioned_series p_ser WHERE p_ser.symbol LIKE 'BENCH%'""")
+    ids_ = [r[0] for r in cur_.fetchall()]
+    _create_partitions(cur_, "1day", moment_, moment_)
+    execute_values(cur_, _query_insert_partitioned_data.format(time_interval="1day"),
+                   [(id_, 0, moment_, 1, 2, 3, 0.5, 10) for id_ in ids_])
+    print(f"registering {series_count} partitioned series: {perf_counter() - start_:.3f}s")
+
+    start_ = perf_counter()
+    for s in symbols:
+        cur_.execute(_information_schema_table_check.format(
+            table_name=db_string_converter_(f"{s}_XBEN"), schema=db_string_converter_("1day_time_series")))
+        cur_.fetchall()
+    print(f"{series_count} existence checks in the catalog: {perf_counter() - start_:.3f}s")
+    start_ = perf_counter()
+    for s in symbols:
+        cur_.execute(_query_get_partitioned_series_ID.format(
+            symbol=db_string_converter_(s), time_interval="'1day'", mic_code="'XBEN'"))
+        cur_.fetchall()
+    print(f"{series_count} existence checks in the registry: {perf_counter() - start_:.3f}s")
+
+    start_ = perf_counter()
+    cur_.execute(" UNION ALL ".join(
+        f"""(SELECT '{s}', * FROM "1day_time_series"."{s}_XBEN" ORDER BY datetime DESC LIMIT 1)""" for s in symbols))
+    cur_.fetchall()
+    print(f"snapshot across per-symbol tables (dynamic SQL): {perf_counter() - start_:.3f}s")
+    start_ = perf_counter()
+    fetch_partitioned_snapshot_("1day", moment_)
+    print(f"snapshot across partitioned storage: {perf_counter() - start_:.3f}s")
+
+    for s in symbols:
+        cur_.execute(_drop_table.format(schema_name="1day_time_series", table_name=f"{s}_XBEN"))
+    cur_.execute(
+        f"""DELETE FROM "partitioned_time_series".candles_1day WHERE series_id IN ({", ".join(map(str, ids_))})""")
+    cur_.execute("""DELETE FROM "public".partitioned_series p_ser WHERE p_ser.symbol LIKE 'BENCH%'""")
+    conn_.close()
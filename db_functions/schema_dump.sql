@@ -16,7 +16,14 @@ SET xmloption = content;
 SET client_min_messages = warning;
 SET row_security = off;
 
-CREATE USER db_user;
+-- every shard keeps the structure under the same role, which already exists once the first of them is set up
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT FROM pg_catalog.pg_roles WHERE rolname = 'db_user') THEN
+        CREATE USER db_user;
+    END IF;
+END
+$$;
 
 ALTER USER db_user WITH CREATEDB CREATEROLE LOGIN;
 
@@ -47,6 +54,15 @@ CREATE SCHEMA "forex_time_series";
 
 ALTER SCHEMA "forex_time_series" OWNER TO db_user;
 
+--
+-- Name: partitioned_time_series; Type: SCHEMA; Schema: -; Owner: db_user
+--
+
+CREATE SCHEMA "partitioned_time_series";
+
+
+ALTER SCHEMA "partitioned_time_series" OWNER TO db_user;
+
 --
 -- Name: adminpack; Type: EXTENSION; Schema: -; Owner: -
 --
@@ -111,7 +127,8 @@ CREATE TABLE IF NOT EXISTS public.forex_pairs (
     currency_group integer,
     symbol character varying(10),
     currency_base integer,
-    currency_quote integer
+    currency_quote integer,
+    delisted_at timestamp without time zone
 );
 
 
@@ -139,7 +156,8 @@ CREATE TABLE IF NOT EXISTS public.markets (
     access integer,
     timezone integer,
     country integer,
-    code character varying(20) NOT NULL
+    code character varying(20) NOT NULL,
+    delisted_at timestamp without time zone
 );
 
 
@@ -170,7 +188,8 @@ CREATE TABLE IF NOT EXISTS public.stocks (
     exchange integer NOT NULL,
     country integer NOT NULL,
     type integer NOT NULL,
-    plan integer NOT NULL
+    plan integer NOT NULL,
+    delisted_at timestamp without time zone
 );
 
 
@@ -203,6 +222,172 @@ CREATE TABLE IF NOT EXISTS public.timezones (
 
 ALTER TABLE public.timezones OWNER TO db_user;
 
+--
+-- Name: api_credit_ledger; Type: TABLE; Schema: public; Owner: db_user
+--
+
+CREATE TABLE IF NOT EXISTS public.api_credit_ledger (
+    key_name character varying(35) NOT NULL,
+    window_type character varying(10) NOT NULL,
+    window_start timestamp without time zone NOT NULL,
+    credits_used integer DEFAULT 0 NOT NULL
+);
+
+
+ALTER TABLE public.api_credit_ledger OWNER TO db_user;
+
+--
+-- Name: download_jobs; Type: TABLE; Schema: public; Owner: db_user
+--
+
+CREATE TABLE IF NOT EXISTS public.download_jobs (
+    "ID" integer GENERATED BY DEFAULT AS IDENTITY,
+    symbol character varying(20) NOT NULL,
+    mic_code character varying(20),
+    time_interval character varying(10) NOT NULL,
+    start_date timestamp without time zone,
+    end_date timestamp without time zone,
+    status character varying(10) DEFAULT 'pending' NOT NULL,
+    attempts integer DEFAULT 0 NOT NULL,
+    max_attempts integer DEFAULT 3 NOT NULL,
+    worker_name character varying(35),
+    lease_expires_at timestamp without time zone,
+    last_error text,
+    created_at timestamp without time zone DEFAULT timezone('UTC', now()) NOT NULL,
+    finished_at timestamp without time zone,
+    CONSTRAINT download_jobs_status_check CHECK (status IN ('pending', 'running', 'done', 'failed'))
+);
+
+
+ALTER TABLE public.download_jobs OWNER TO db_user;
+
+--
+-- Name: indicator_states; Type: TABLE; Schema: public; Owner: db_user
+--
+
+CREATE TABLE IF NOT EXISTS public.indicator_states (
+    schema_name character varying(35) NOT NULL,
+    table_name character varying(63) NOT NULL,
+    state_name character varying(35) NOT NULL,
+    "last_ID" integer NOT NULL,
+    state jsonb NOT NULL,
+    updated_at timestamp without time zone DEFAULT timezone('UTC', now()) NOT NULL
+);
+
+
+ALTER TABLE public.indicator_states OWNER TO db_user;
+
+--
+-- Name: price_scales; Type: TABLE; Schema: public; Owner: db_user
+--
+
+CREATE TABLE IF NOT EXISTS public.price_scales (
+    schema_name character varying(35) NOT NULL,
+    table_name character varying(63) NOT NULL,
+    price_scale smallint NOT NULL
+);
+
+
+ALTER TABLE public.price_scales OWNER TO db_user;
+
+--
+-- Name: series_catalog; Type: TABLE; Schema: public; Owner: db_user
+--
+
+CREATE TABLE IF NOT EXISTS public.series_catalog (
+    schema_name character varying(35) NOT NULL,
+    table_name character varying(63) NOT NULL,
+    first_datetime timestamp without time zone,
+    last_datetime timestamp without time zone,
+    "first_ID" integer,
+    "last_ID" integer,
+    row_count bigint DEFAULT 0 NOT NULL,
+    min_price numeric,
+    max_price numeric,
+    updated_at timestamp without time zone DEFAULT timezone('UTC', now()) NOT NULL
+);
+
+
+ALTER TABLE public.series_catalog OWNER TO db_user;
+
+--
+-- Name: partitioned_series; Type: TABLE; Schema: public; Owner: db_user
+--
+
+CREATE TABLE IF NOT EXISTS public.partitioned_series (
+    "ID" integer GENERATED BY DEFAULT AS IDENTITY,
+    symbol character varying(20) NOT NULL,
+    mic_code character varying(20),
+    time_interval character varying(10) NOT NULL,
+    is_equity boolean NOT NULL,
+    created_at timestamp without time zone DEFAULT timezone('UTC', now()) NOT NULL
+);
+
+
+ALTER TABLE public.partitioned_series OWNER TO db_user;
+
+--
+-- Name: series_quality; Type: TABLE; Schema: public; Owner: db_user
+--
+
+CREATE TABLE IF NOT EXISTS public.series_quality (
+    schema_name character varying(35) NOT NULL,
+    table_name character varying(63) NOT NULL,
+    row_count bigint DEFAULT 0 NOT NULL,
+    first_datetime timestamp without time zone,
+    last_datetime timestamp without time zone,
+    duplicate_timestamps integer DEFAULT 0 NOT NULL,
+    invalid_prices integer DEFAULT 0 NOT NULL,
+    inconsistent_candles integer DEFAULT 0 NOT NULL,
+    outlier_returns integer DEFAULT 0 NOT NULL,
+    session_gaps integer DEFAULT 0 NOT NULL,
+    missing_sessions integer DEFAULT 0 NOT NULL,
+    "non_monotonic_IDs" integer DEFAULT 0 NOT NULL,
+    issues integer DEFAULT 0 NOT NULL,
+    scanned_at timestamp without time zone DEFAULT timezone('UTC', now()) NOT NULL
+);
+
+
+ALTER TABLE public.series_quality OWNER TO db_user;
+
+--
+-- Name: candles_1min; Type: TABLE; Schema: partitioned_time_series; Owner: db_user
+--
+
+CREATE TABLE IF NOT EXISTS "partitioned_time_series".candles_1min (
+    series_id integer NOT NULL,
+    "ID" integer NOT NULL,
+    datetime timestamp without time zone NOT NULL,
+    open numeric(10,5),
+    close numeric(10,5),
+    high numeric(10,5),
+    low numeric(10,5),
+    volume bigint,
+    CONSTRAINT candles_1min_pkey PRIMARY KEY (series_id, datetime)
+) PARTITION BY HASH (series_id);
+
+
+ALTER TABLE "partitioned_time_series".candles_1min OWNER TO db_user;
+
+--
+-- Name: candles_1day; Type: TABLE; Schema: partitioned_time_series; Owner: db_user
+--
+
+CREATE TABLE IF NOT EXISTS "partitioned_time_series".candles_1day (
+    series_id integer NOT NULL,
+    "ID" integer NOT NULL,
+    datetime timestamp without time zone NOT NULL,
+    open numeric(10,5),
+    close numeric(10,5),
+    high numeric(10,5),
+    low numeric(10,5),
+    volume bigint,
+    CONSTRAINT candles_1day_pkey PRIMARY KEY (series_id, datetime)
+) PARTITION BY HASH (series_id);
+
+
+ALTER TABLE "partitioned_time_series".candles_1day OWNER TO db_user;
+
 --
 -- Name: tracked_indexes; Type: VIEW; Schema: public; Owner: db_user
 --
@@ -247,52 +432,60 @@ ALTER TABLE public.non_standard_functions OWNER TO db_user;
 --
 
 CREATE VIEW public.non_standard_views AS
-SELECT table_schema, table_name
+SELECT table_schema::text AS table_schema, table_name::text AS table_name
 FROM information_schema.views
-WHERE table_schema NOT IN ('pg_catalog', 'information_schema');
+WHERE table_schema NOT IN ('pg_catalog', 'information_schema')
+UNION ALL
+SELECT schemaname::text, matviewname::text
+FROM pg_catalog.pg_matviews
+WHERE schemaname NOT IN ('pg_catalog', 'information_schema');
 
 
 ALTER TABLE public.non_standard_views OWNER TO db_user;
 
 
 --
--- Name: forex_pairs_explained; Type: VIEW; Schema: public; Owner: db_user
+-- Name: forex_pairs_explained; Type: MATERIALIZED VIEW; Schema: public; Owner: db_user
 --
 
-CREATE VIEW public.forex_pairs_explained AS
+CREATE MATERIALIZED VIEW public.forex_pairs_explained AS
 SELECT main_tab."ID", f_grps.name as currency_group_name, main_tab.symbol,
     base_cur.symbol as base_currency_symbol, quote_cur.symbol as quote_currency_symbol,
     base_cur.name as base_currency_name, quote_cur.name as quote_currency_name
 FROM public.forex_pairs main_tab
 LEFT JOIN public.forex_currency_groups f_grps ON main_tab.currency_group = f_grps."ID"
 LEFT JOIN public.currencies quote_cur ON main_tab.currency_quote = quote_cur."ID"
-LEFT JOIN public.currencies base_cur ON main_tab.currency_base = base_cur."ID";
+LEFT JOIN public.currencies base_cur ON main_tab.currency_base = base_cur."ID"
+WHERE main_tab.delisted_at IS NULL
+WITH DATA;
 
 
-ALTER TABLE public.forex_pairs_explained OWNER TO db_user;
+ALTER MATERIALIZED VIEW public.forex_pairs_explained OWNER TO db_user;
 
 
 --
--- Name: forex_pairs_explained; Type: VIEW; Schema: public; Owner: db_user
+-- Name: markets_explained; Type: MATERIALIZED VIEW; Schema: public; Owner: db_user
 --
 
-CREATE VIEW public.markets_explained AS
+CREATE MATERIALIZED VIEW public.markets_explained AS
 SELECT main_tab."ID", main_tab.name, main_tab.code as mic_code, tz.name as timezone_name,
     p.plan as access_plan, cntrs.name as country_name
 FROM public.markets main_tab
 LEFT JOIN public.timezones tz ON main_tab.timezone = tz."ID"
 LEFT JOIN public.countries cntrs ON main_tab.country = cntrs."ID"
-LEFT JOIN public.plans p ON main_tab.access = p."ID";
+LEFT JOIN public.plans p ON main_tab.access = p."ID"
+WHERE main_tab.delisted_at IS NULL
+WITH DATA;
 
 
-ALTER TABLE public.markets_explained OWNER TO db_user;
+ALTER MATERIALIZED VIEW public.markets_explained OWNER TO db_user;
 
 
 --
--- Name: stocks_explained; Type: VIEW; Schema: public; Owner: db_user
+-- Name: stocks_explained; Type: MATERIALIZED VIEW; Schema: public; Owner: db_user
 --
 
-CREATE VIEW public.stocks_explained AS
+CREATE MATERIALIZED VIEW public.stocks_explained AS
 SELECT main_tab."ID", main_tab.symbol, main_tab.name, curs.symbol as currency_symbol, mkts.code as exchange_mic_code,
     cntrs.name as country_name, i_types.name as investment_type, p.plan as access_plan
 FROM public.stocks main_tab
@@ -300,10 +493,12 @@ LEFT JOIN public.currencies curs ON main_tab.currency = curs."ID"
 LEFT JOIN public.markets mkts ON main_tab.exchange = mkts."ID"
 LEFT JOIN public.countries cntrs ON main_tab.country = cntrs."ID"
 LEFT JOIN public.investment_types i_types ON main_tab.type = i_types."ID"
-LEFT JOIN public.plans p ON main_tab.plan = p."ID";
+LEFT JOIN public.plans p ON main_tab.plan = p."ID"
+WHERE main_tab.delisted_at IS NULL
+WITH DATA;
 
 
-ALTER TABLE public.stocks_explained OWNER TO db_user;
+ALTER MATERIALIZED VIEW public.stocks_explained OWNER TO db_user;
 
 --
 -- Name: generate_financial_view_1day(text); Type: FUNCTION; Schema: public; Owner: db_user
@@ -382,6 +577,344 @@ $$;
 
 ALTER FUNCTION public.generate_forex_view(tbl_name text) OWNER TO db_user;
 
+
+--
+-- Name: generate_time_series_rollup(text, text, text); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.generate_time_series_rollup(schema_name text, tbl_name text, bucket text) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    rollup_name TEXT;
+BEGIN
+    IF bucket NOT IN ('hour', 'day', 'week', 'month') THEN
+        RAISE EXCEPTION 'rollup bucket has to be one of: hour, day, week, month (got %)', bucket;
+    END IF;
+    rollup_name := tbl_name || '_rollup_' || bucket;
+
+    IF to_regclass(format('%I.%I', schema_name, rollup_name)) IS NULL THEN
+        -- prices of the rollup have the type of the series prices (numeric or fixed-point integers)
+        EXECUTE format('
+            CREATE TABLE %1$I.%2$I AS
+            SELECT series.datetime AS bucket_start, series.open, series.close, series.high, series.low,
+                %4$s AS volume, 0 AS candles
+            FROM %1$I.%3$I series WITH NO DATA', schema_name, rollup_name, tbl_name,
+            CASE WHEN EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = schema_name AND table_name = tbl_name AND column_name = 'volume'
+            ) THEN 'series.volume' ELSE 'NULL::bigint' END);
+        EXECUTE format('ALTER TABLE %I.%I ADD PRIMARY KEY (bucket_start)', schema_name, rollup_name);
+    END IF;
+    -- buckets affected by an update are found by the datetime of the freshly appended rows
+    EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I.%I (datetime)',
+        tbl_name || '_datetime_idx', schema_name, tbl_name);
+    PERFORM public.refresh_time_series_rollups(schema_name, tbl_name, NULL, ARRAY[bucket]);
+END;
+$$;
+
+
+ALTER FUNCTION public.generate_time_series_rollup(schema_name text, tbl_name text, bucket text) OWNER TO db_user;
+
+
+--
+-- Name: refresh_time_series_rollups(text, text, timestamp without time zone, text[]); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.refresh_time_series_rollups(
+    schema_name text, tbl_name text, since timestamp without time zone,
+    buckets text[] DEFAULT ARRAY['hour', 'day', 'week', 'month']) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    bucket TEXT;
+    volume_expression TEXT;
+    refreshed_rows INTEGER;
+    total_rows INTEGER := 0;
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = schema_name AND table_name = tbl_name AND column_name = 'volume'
+    ) THEN
+        volume_expression := 'sum(series.volume)';
+    ELSE
+        volume_expression := 'NULL::bigint';
+    END IF;
+
+    FOREACH bucket IN ARRAY buckets LOOP
+        CONTINUE WHEN to_regclass(format('%I.%I', schema_name, tbl_name || '_rollup_' || bucket)) IS NULL;
+        -- only buckets starting at (or containing) "since" are recalculated, NULL rebuilds the entire rollup
+        EXECUTE format('
+            INSERT INTO %1$I.%2$I AS rollup (bucket_start, open, close, high, low, volume, candles)
+            SELECT
+                date_trunc(%4$L, series.datetime),
+                (array_agg(series.open ORDER BY series."ID"))[1],
+                (array_agg(series.close ORDER BY series."ID" DESC))[1],
+                max(series.high),
+                min(series.low),
+                %5$s,
+                count(*)
+            FROM %1$I.%3$I series
+            WHERE $1 IS NULL OR series.datetime >= date_trunc(%4$L, $1)
+            GROUP BY 1
+            ON CONFLICT (bucket_start) DO UPDATE
+            SET open = EXCLUDED.open, close = EXCLUDED.close, high = EXCLUDED.high, low = EXCLUDED.low,
+                volume = EXCLUDED.volume, candles = EXCLUDED.candles',
+            schema_name, tbl_name || '_rollup_' || bucket, tbl_name, bucket, volume_expression)
+        USING since;
+        GET DIAGNOSTICS refreshed_rows = ROW_COUNT;
+        total_rows := total_rows + refreshed_rows;
+    END LOOP;
+    RETURN total_rows;
+END;
+$$;
+
+
+ALTER FUNCTION public.refresh_time_series_rollups(text, text, timestamp without time zone, text[]) OWNER TO db_user;
+
+
+--
+-- Name: downsample_time_series(text, text, timestamp without time zone, timestamp without time zone, integer); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.downsample_time_series(
+    schema_name text, tbl_name text, start_date timestamp without time zone,
+    end_date timestamp without time zone, buckets integer)
+    RETURNS TABLE (
+        bucket integer, datetime timestamp without time zone, open double precision, close double precision,
+        high double precision, low double precision, volume bigint, candles integer)
+    LANGUAGE plpgsql STABLE
+    AS $$
+DECLARE
+    -- fixed-point prices are returned as decoded numbers
+    scale_divisor double precision := COALESCE((
+        SELECT 10 ^ scales.price_scale FROM public.price_scales scales
+        WHERE scales.schema_name = downsample_time_series.schema_name AND scales.table_name = tbl_name), 1);
+    volume_expression TEXT;
+    first_datetime timestamp without time zone;
+    last_datetime timestamp without time zone;
+BEGIN
+    IF buckets IS NULL OR buckets < 1 THEN
+        RAISE EXCEPTION 'number of buckets has to be positive (got %)', buckets;
+    END IF;
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = schema_name AND table_name = tbl_name AND column_name = 'volume'
+    ) THEN
+        volume_expression := 'sum(series.volume)::bigint';
+    ELSE
+        volume_expression := 'NULL::bigint';
+    END IF;
+    -- range missing on either side reaches the end of the series
+    IF start_date IS NULL OR end_date IS NULL THEN
+        EXECUTE format('SELECT min(series.datetime), max(series.datetime) FROM %I.%I series', schema_name, tbl_name)
+        INTO first_datetime, last_datetime;
+        start_date := COALESCE(start_date, first_datetime);
+        end_date := COALESCE(end_date, last_datetime);
+    END IF;
+    IF start_date IS NULL OR end_date IS NULL OR end_date < start_date THEN
+        RETURN;
+    END IF;
+
+    -- range is split into buckets of equal width, rows of the last instant fall into the last bucket.
+    -- Empty buckets (nights, weekends) give no row, datetime of a bucket is the one of its first candle.
+    -- Open of the lowest ID and close of the highest one are picked by comparing (ID, price) arrays - a single
+    -- pass over the rows, without sorting every bucket
+    RETURN QUERY EXECUTE format('
+        SELECT least(width_bucket(extract(epoch FROM series.datetime)::float8, $1, $2, $3), $3),
+            min(series.datetime),
+            (min(ARRAY[series."ID"::float8, series.open::float8]))[2] / $4,
+            (max(ARRAY[series."ID"::float8, series.close::float8]))[2] / $4,
+            max(series.high)::float8 / $4,
+            min(series.low)::float8 / $4,
+            %3$s,
+            count(*)::integer
+        FROM %1$I.%2$I series
+        WHERE series.datetime BETWEEN $5 AND $6
+        GROUP BY 1 ORDER BY 1', schema_name, tbl_name, volume_expression)
+    USING extract(epoch FROM start_date)::float8,
+        -- a range of a single instant still needs a width
+        greatest(extract(epoch FROM end_date)::float8, extract(epoch FROM start_date)::float8 + 1),
+        buckets, scale_divisor, start_date, end_date;
+END;
+$$;
+
+
+ALTER FUNCTION public.downsample_time_series(text, text, timestamp without time zone, timestamp without time zone, integer) OWNER TO db_user;
+
+
+--
+-- Name: create_series_partitions(text, timestamp without time zone, timestamp without time zone); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.create_series_partitions(
+    time_interval text, since timestamp without time zone, until timestamp without time zone) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    -- series are spread over a fixed number of partitions, so the catalog does not grow with the number of symbols
+    series_partitions CONSTANT INTEGER := 16;
+    parent_name TEXT := 'candles_' || time_interval;
+    series_partition TEXT;
+    range_unit TEXT;
+    range_label TEXT;
+    range_start timestamp without time zone;
+    range_partition TEXT;
+    created INTEGER := 0;
+BEGIN
+    -- monthly ranges of minute data hold ~10k rows per series, daily data is split by years instead
+    IF time_interval = '1min' THEN
+        range_unit := 'month';
+        range_label := 'YYYYMM';
+    ELSIF time_interval = '1day' THEN
+        range_unit := 'year';
+        range_label := 'YYYY';
+    ELSE
+        RAISE EXCEPTION 'partitioned storage is prepared for 1min and 1day intervals (got %)', time_interval;
+    END IF;
+
+    FOR remainder IN 0..series_partitions - 1 LOOP
+        series_partition := parent_name || '_p' || remainder;
+        IF to_regclass(format('partitioned_time_series.%I', series_partition)) IS NULL THEN
+            EXECUTE format('
+                CREATE TABLE "partitioned_time_series".%I PARTITION OF "partitioned_time_series".%I
+                FOR VALUES WITH (MODULUS %s, REMAINDER %s) PARTITION BY RANGE (datetime)',
+                series_partition, parent_name, series_partitions, remainder);
+        END IF;
+        CONTINUE WHEN since IS NULL OR until IS NULL;
+
+        range_start := date_trunc(range_unit, since);
+        WHILE range_start <= until LOOP
+            range_partition := series_partition || '_' || to_char(range_start, range_label);
+            IF to_regclass(format('partitioned_time_series.%I', range_partition)) IS NULL THEN
+                EXECUTE format('
+                    CREATE TABLE "partitioned_time_series".%I PARTITION OF "partitioned_time_series".%I
+                    FOR VALUES FROM (%L) TO (%L)', range_partition, series_partition,
+                    range_start, range_start + ('1 ' || range_unit)::interval);
+                created := created + 1;
+            END IF;
+            range_start := range_start + ('1 ' || range_unit)::interval;
+        END LOOP;
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+
+ALTER FUNCTION public.create_series_partitions(text, timestamp without time zone, timestamp without time zone) OWNER TO db_user;
+
+
+--
+-- Name: refresh_series_catalog(text, text); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.refresh_series_catalog(schema_name text, tbl_name text) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    -- fixed-point prices are kept in the catalog as decoded numbers
+    scale_divisor numeric := COALESCE((
+        SELECT 10 ^ scales.price_scale FROM public.price_scales scales
+        WHERE scales.schema_name = refresh_series_catalog.schema_name AND scales.table_name = tbl_name), 1);
+BEGIN
+    EXECUTE format('
+        INSERT INTO public.series_catalog AS catalog (schema_name, table_name, first_datetime, last_datetime,
+            "first_ID", "last_ID", row_count, min_price, max_price)
+        SELECT %1$L, %2$L, min(series.datetime), max(series.datetime), min(series."ID"), max(series."ID"),
+            count(*), min(series.low) / $1, max(series.high) / $1
+        FROM %1$I.%2$I series
+        ON CONFLICT (schema_name, table_name) DO UPDATE
+        SET first_datetime = EXCLUDED.first_datetime, last_datetime = EXCLUDED.last_datetime,
+            "first_ID" = EXCLUDED."first_ID", "last_ID" = EXCLUDED."last_ID", row_count = EXCLUDED.row_count,
+            min_price = EXCLUDED.min_price, max_price = EXCLUDED.max_price, updated_at = timezone(''UTC'', now())',
+        schema_name, tbl_name)
+    USING scale_divisor;
+END;
+$$;
+
+
+ALTER FUNCTION public.refresh_series_catalog(schema_name text, tbl_name text) OWNER TO db_user;
+
+
+--
+-- Name: series_catalog_after_insert(); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.series_catalog_after_insert() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    scale_divisor numeric := COALESCE((
+        SELECT 10 ^ scales.price_scale FROM public.price_scales scales
+        WHERE scales.schema_name = TG_TABLE_SCHEMA AND scales.table_name = TG_TABLE_NAME), 1);
+BEGIN
+    -- only the rows of the statement are aggregated and merged into the entry, the series is not scanned
+    INSERT INTO public.series_catalog AS catalog (schema_name, table_name, first_datetime, last_datetime,
+        "first_ID", "last_ID", row_count, min_price, max_price)
+    SELECT TG_TABLE_SCHEMA, TG_TABLE_NAME, min(new_rows.datetime), max(new_rows.datetime),
+        min(new_rows."ID"), max(new_rows."ID"), count(*), min(new_rows.low) / scale_divisor,
+        max(new_rows.high) / scale_divisor
+    FROM new_rows
+    HAVING count(*) > 0
+    ON CONFLICT (schema_name, table_name) DO UPDATE
+    SET first_datetime = LEAST(catalog.first_datetime, EXCLUDED.first_datetime),
+        last_datetime = GREATEST(catalog.last_datetime, EXCLUDED.last_datetime),
+        "first_ID" = LEAST(catalog."first_ID", EXCLUDED."first_ID"),
+        "last_ID" = GREATEST(catalog."last_ID", EXCLUDED."last_ID"),
+        row_count = catalog.row_count + EXCLUDED.row_count,
+        min_price = LEAST(catalog.min_price, EXCLUDED.min_price),
+        max_price = GREATEST(catalog.max_price, EXCLUDED.max_price),
+        updated_at = timezone('UTC', now());
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.series_catalog_after_insert() OWNER TO db_user;
+
+
+--
+-- Name: series_catalog_after_change(); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.series_catalog_after_change() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    -- updates and deletes are rare (corrections of the data), entry of the series is simply calculated again
+    PERFORM public.refresh_series_catalog(TG_TABLE_SCHEMA, TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.series_catalog_after_change() OWNER TO db_user;
+
+
+--
+-- Name: attach_series_catalog(text, text); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.attach_series_catalog(schema_name text, tbl_name text) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    EXECUTE format('DROP TRIGGER IF EXISTS series_catalog_insert ON %I.%I', schema_name, tbl_name);
+    EXECUTE format('
+        CREATE TRIGGER series_catalog_insert AFTER INSERT ON %I.%I
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION public.series_catalog_after_insert()', schema_name, tbl_name);
+    EXECUTE format('DROP TRIGGER IF EXISTS series_catalog_change ON %I.%I', schema_name, tbl_name);
+    EXECUTE format('
+        CREATE TRIGGER series_catalog_change AFTER UPDATE OR DELETE OR TRUNCATE ON %I.%I
+        FOR EACH STATEMENT EXECUTE FUNCTION public.series_catalog_after_change()', schema_name, tbl_name);
+    PERFORM public.refresh_series_catalog(schema_name, tbl_name);
+END;
+$$;
+
+
+ALTER FUNCTION public.attach_series_catalog(schema_name text, tbl_name text) OWNER TO db_user;
+
 --
 -- Name: check_is_stock(text); Type: FUNCTION; Schema: public; Owner: db_user
 --
@@ -420,6 +953,84 @@ $$;
 ALTER FUNCTION public.check_is_forex_pair(symbol_to_check text) OWNER TO db_user;
 
 
+--
+-- Name: reserve_api_credits(text, integer, integer, integer); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.reserve_api_credits(
+    key_to_reserve text, credits integer, minute_limit integer, daily_limit integer) RETURNS boolean
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    reserved_at timestamp without time zone := timezone('UTC', clock_timestamp());
+BEGIN
+    IF credits > minute_limit OR credits > daily_limit THEN
+        RETURN false;
+    END IF;
+
+    -- rows are always locked in the same order (day -> minute), so concurrent reservations can't deadlock
+    INSERT INTO public.api_credit_ledger AS ledger (key_name, window_type, window_start, credits_used)
+    VALUES (key_to_reserve, 'day', date_trunc('day', reserved_at), credits)
+    ON CONFLICT (key_name, window_type, window_start) DO UPDATE
+        SET credits_used = ledger.credits_used + EXCLUDED.credits_used
+        WHERE ledger.credits_used + EXCLUDED.credits_used <= daily_limit;
+    IF NOT FOUND THEN
+        RETURN false;
+    END IF;
+
+    INSERT INTO public.api_credit_ledger AS ledger (key_name, window_type, window_start, credits_used)
+    VALUES (key_to_reserve, 'minute', date_trunc('minute', reserved_at), credits)
+    ON CONFLICT (key_name, window_type, window_start) DO UPDATE
+        SET credits_used = ledger.credits_used + EXCLUDED.credits_used
+        WHERE ledger.credits_used + EXCLUDED.credits_used <= minute_limit;
+    IF NOT FOUND THEN
+        -- minute window is exhausted, give back what has been taken from the daily one
+        UPDATE public.api_credit_ledger ledger
+        SET credits_used = ledger.credits_used - credits
+        WHERE ledger.key_name = key_to_reserve AND ledger.window_type = 'day'
+            AND ledger.window_start = date_trunc('day', reserved_at);
+        RETURN false;
+    END IF;
+    RETURN true;
+END;
+$$;
+
+
+ALTER FUNCTION public.reserve_api_credits(text, integer, integer, integer) OWNER TO db_user;
+
+
+--
+-- Name: allocate_time_series_ids(text, text, timestamp without time zone); Type: FUNCTION; Schema: public; Owner: db_user
+--
+
+CREATE FUNCTION public.allocate_time_series_ids(schema_name text, tbl_name text, first_datetime timestamp without time zone) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    next_id INTEGER;
+    last_datetime TIMESTAMP;
+BEGIN
+    -- appenders of the series take turns until their commit - IDs that follow the last stored row belong
+    -- to the transaction holding the lock. A sequence would leave gaps of the rolled back inserts behind,
+    -- while "ID" has to follow the row number of the series
+    PERFORM pg_advisory_xact_lock(format('%I.%I', schema_name, tbl_name)::regclass::oid::bigint);
+    -- statement after the lock sees the rows committed by the previous holder
+    EXECUTE format('SELECT series."ID" + 1, series.datetime FROM %I.%I series ORDER BY series."ID" DESC LIMIT 1',
+        schema_name, tbl_name) INTO next_id, last_datetime;
+    -- ID order is the datetime order of the series (brackets, downsampling and fetches by ID count on it),
+    -- rows older than the last stored one can't be appended, whichever appender got the lock first
+    IF first_datetime <= last_datetime THEN
+        RAISE EXCEPTION 'rows starting at % do not follow the last row of %.% (%)',
+            first_datetime, schema_name, tbl_name, last_datetime USING ERRCODE = 'invalid_parameter_value';
+    END IF;
+    RETURN coalesce(next_id, 0);
+END;
+$$;
+
+
+ALTER FUNCTION public.allocate_time_series_ids(text, text, timestamp without time zone) OWNER TO db_user;
+
+
 --
 -- Name: markets ID; Type: CONSTRAINT; Schema: public; Owner: db_user
 --
@@ -500,6 +1111,120 @@ ALTER TABLE ONLY public.timezones
     ADD CONSTRAINT timezones_pkey PRIMARY KEY ("ID");
 
 
+--
+-- Name: api_credit_ledger api_credit_ledger_pkey; Type: CONSTRAINT; Schema: public; Owner: db_user
+--
+
+ALTER TABLE ONLY public.api_credit_ledger
+    ADD CONSTRAINT api_credit_ledger_pkey PRIMARY KEY (key_name, window_type, window_start);
+
+
+--
+-- Name: download_jobs download_jobs_pkey; Type: CONSTRAINT; Schema: public; Owner: db_user
+--
+
+ALTER TABLE ONLY public.download_jobs
+    ADD CONSTRAINT download_jobs_pkey PRIMARY KEY ("ID");
+
+
+--
+-- Name: indicator_states indicator_states_pkey; Type: CONSTRAINT; Schema: public; Owner: db_user
+--
+
+ALTER TABLE ONLY public.indicator_states
+    ADD CONSTRAINT indicator_states_pkey PRIMARY KEY (schema_name, table_name, state_name);
+
+
+--
+-- Name: price_scales price_scales_pkey; Type: CONSTRAINT; Schema: public; Owner: db_user
+--
+
+ALTER TABLE ONLY public.price_scales
+    ADD CONSTRAINT price_scales_pkey PRIMARY KEY (schema_name, table_name);
+
+
+--
+-- Name: series_catalog series_catalog_pkey; Type: CONSTRAINT; Schema: public; Owner: db_user
+--
+
+ALTER TABLE ONLY public.series_catalog
+    ADD CONSTRAINT series_catalog_pkey PRIMARY KEY (schema_name, table_name);
+
+
+--
+-- Name: series_quality series_quality_pkey; Type: CONSTRAINT; Schema: public; Owner: db_user
+--
+
+ALTER TABLE ONLY public.series_quality
+    ADD CONSTRAINT series_quality_pkey PRIMARY KEY (schema_name, table_name);
+
+
+--
+-- Name: partitioned_series partitioned_series_pkey; Type: CONSTRAINT; Schema: public; Owner: db_user
+--
+
+ALTER TABLE ONLY public.partitioned_series
+    ADD CONSTRAINT partitioned_series_pkey PRIMARY KEY ("ID");
+
+
+--
+-- Name: partitioned_series_unique_idx; Type: INDEX; Schema: public; Owner: db_user
+--
+
+CREATE UNIQUE INDEX partitioned_series_unique_idx
+    ON public.partitioned_series USING btree (symbol, time_interval, COALESCE(mic_code, ''));
+
+
+--
+-- Name: download_jobs_open_idx; Type: INDEX; Schema: public; Owner: db_user
+--
+
+CREATE INDEX download_jobs_open_idx ON public.download_jobs
+    USING btree (symbol, time_interval, "ID") WHERE status IN ('pending', 'running');
+
+
+--
+-- Name: forex_pairs_explained_id_idx; Type: INDEX; Schema: public; Owner: db_user
+--
+
+CREATE UNIQUE INDEX forex_pairs_explained_id_idx ON public.forex_pairs_explained USING btree ("ID");
+
+
+--
+-- Name: forex_pairs_explained_symbol_idx; Type: INDEX; Schema: public; Owner: db_user
+--
+
+CREATE INDEX forex_pairs_explained_symbol_idx ON public.forex_pairs_explained USING btree (symbol text_pattern_ops);
+
+
+--
+-- Name: markets_explained_id_idx; Type: INDEX; Schema: public; Owner: db_user
+--
+
+CREATE UNIQUE INDEX markets_explained_id_idx ON public.markets_explained USING btree ("ID");
+
+
+--
+-- Name: markets_explained_mic_code_idx; Type: INDEX; Schema: public; Owner: db_user
+--
+
+CREATE INDEX markets_explained_mic_code_idx ON public.markets_explained USING btree (mic_code text_pattern_ops);
+
+
+--
+-- Name: stocks_explained_id_idx; Type: INDEX; Schema: public; Owner: db_user
+--
+
+CREATE UNIQUE INDEX stocks_explained_id_idx ON public.stocks_explained USING btree ("ID");
+
+
+--
+-- Name: stocks_explained_symbol_idx; Type: INDEX; Schema: public; Owner: db_user
+--
+
+CREATE INDEX stocks_explained_symbol_idx ON public.stocks_explained USING btree (symbol text_pattern_ops);
+
+
 --
 -- Name: markets access; Type: FK CONSTRAINT; Schema: public; Owner: db_user
 --
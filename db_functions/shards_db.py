@@ -0,0 +1,275 @@
+import json
+from tempfile import SpooledTemporaryFile
+
+import psycopg2
+from psycopg2 import sql
+
+from db_functions.db_helpers import (
+    _query_get_price_scale,
+    _shard_connection_dicts,
+    db_string_converter_,
+    forget_series_table_,
+    shard_of_,
+    TimeSeriesNotFoundError_,
+)
+from db_functions.db_views import _query_create_rollup
+from db_functions.indicator_states_db import (
+    _query_fetch_indicator_states, _query_save_indicator_state, _query_drop_indicator_states,
+)
+from db_functions.series_catalog_db import attach_series_catalog_, delete_series_catalog_, list_series_tables_
+from db_functions.time_series_db import _query_save_price_scale, _query_delete_price_scale
+
+
+# rows of a moved series are kept in memory up to this size, bigger series are spooled to a temporary file
+MOVE_SPOOL_MAX_BYTES_ = 64 * 1024 * 1024
+
+# select queries
+_query_series_columns = """
+SELECT att.attname, format_type(att.atttypid, att.atttypmod), att.attnotnull FROM pg_catalog.pg_attribute att
+WHERE att.attrelid = to_regclass({table}) AND att.attnum > 0 AND NOT att.attisdropped ORDER BY att.attnum;
+"""
+_query_series_constraints = """
+SELECT con.conname, pg_get_constraintdef(con.oid) FROM pg_catalog.pg_constraint con
+WHERE con.conrelid = to_regclass({table}) AND con.contype IN ('p', 'u');
+"""
+# indexes backing the constraints are created together with them
+_query_series_indexes = """
+SELECT pg_get_indexdef(idx.indexrelid) FROM pg_catalog.pg_index idx
+WHERE idx.indrelid = to_regclass({table})
+    AND NOT EXISTS (SELECT FROM pg_catalog.pg_constraint con WHERE con.conindid = idx.indexrelid);
+"""
+_query_series_rollup_buckets = """
+SELECT substring(tab.table_name FROM length({table_name}) + 9) FROM information_schema."tables" tab
+WHERE tab.table_schema = {schema_name} AND tab.table_name LIKE {rollup_pattern} ESCAPE '\\';
+"""
+_query_count_rows = sql.SQL("SELECT count(*) FROM {table};")
+# writes would land between the count and the copy - the source only gets read while it is moved
+_query_lock_series = sql.SQL("LOCK TABLE {table} IN SHARE MODE;")
+_query_analyze_series = sql.SQL("ANALYZE {table};")
+
+# copy queries
+_query_copy_to = sql.SQL("COPY {table} TO STDOUT (FORMAT binary);")
+_query_copy_from = sql.SQL("COPY {table} FROM STDIN (FORMAT binary);")
+
+# create queries
+_query_create_series = sql.SQL("CREATE {unlogged}TABLE {table} ({columns});")
+_query_add_constraint = sql.SQL("ALTER TABLE {table} ADD CONSTRAINT {name} {definition};")
+
+# delete queries
+_query_drop_series = sql.SQL("DROP TABLE IF EXISTS {table} CASCADE;")
+
+
+def misplaced_series_() -> list[tuple[str, str, int, int]]:
+    """
+    series kept by another shard than the one their hash places them on - all of them, after a shard is added
+    to (or removed from the end of) ``settings.DB_SHARDS``, lookups and fetches don't find them until moved
+
+    :return: rows of (schema_name, table_name, shard keeping the table, shard it belongs to)
+    """
+    return [
+        (schema_name, table_name, shard, shard_of_(schema_name, table_name))
+        for shard, schema_name, table_name in list_series_tables_() if shard_of_(schema_name, table_name) != shard
+    ]
+
+
+def series_definition_(cursor, schema_name: str, table_name: str) -> dict | None:
+    """
+    what it takes to build the series table again somewhere else - everything but its rows
+
+    :return: columns (name, type, NOT NULL), constraints, indexes, rollup buckets, price scale and indicator states
+        (name, last ID, state) - all of them JSON serializable. None if the table does not exist
+    """
+    names = {"schema_name": db_string_converter_(schema_name), "table_name": db_string_converter_(table_name)}
+    qualified = db_string_converter_(sql.Identifier(schema_name, table_name).as_string(cursor))
+    cursor.execute(_query_series_columns.format(table=qualified))
+    columns = cursor.fetchall()
+    if not columns:
+        return None
+    cursor.execute(_query_series_constraints.format(table=qualified))
+    constraints = cursor.fetchall()
+    cursor.execute(_query_series_indexes.format(table=qualified))
+    indexes = [r[0] for r in cursor.fetchall()]
+    cursor.execute(_query_series_rollup_buckets.format(
+        **names, rollup_pattern=db_string_converter_(table_name.replace("_", "\\_") + "\\_rollup\\_%")))
+    buckets = [r[0] for r in cursor.fetchall()]
+    cursor.execute(_query_get_price_scale.format(**names))
+    price_scale = cursor.fetchall()
+    cursor.execute(_query_fetch_indicator_states.format(**names))
+    indicator_states = cursor.fetchall()
+    return {
+        "columns": [list(column) for column in columns],
+        "constraints": [list(constraint) for constraint in constraints],
+        "indexes": indexes,
+        "rollups": buckets,
+        "price_scale": price_scale[0][0] if price_scale else None,
+        "indicator_states": [list(state) for state in indicator_states],
+    }
+
+
+def create_series_table_(cursor, schema_name: str, table_name: str, definition: dict, unlogged: bool = False):
+    """
+    (re)create bare table of the series out of its definition - no constraints or indexes slow the load down
+
+    :param unlogged: rows written to the table skip the WAL - make it logged (``SET LOGGED``) before it is trusted
+        with anything, a crash empties unlogged tables
+    """
+    table = sql.Identifier(schema_name, table_name)
+    cursor.execute(_query_drop_series.format(table=table))
+    cursor.execute(_query_create_series.format(
+        unlogged=sql.SQL("UNLOGGED " if unlogged else ""), table=table, columns=sql.SQL(", ").join(
+            sql.SQL(f"{{name}} {column_type}{' NOT NULL' if not_null else ''}").format(name=sql.Identifier(name))
+            for name, column_type, not_null in definition["columns"])))
+
+
+def finish_series_table_(cursor, schema_name: str, table_name: str, definition: dict):
+    """
+    once the rows are loaded - constraints, indexes, price scale, indicator states, catalog entry and rollups
+    of the series, then statistics for the planner, which knows nothing about the rows yet
+    """
+    table = sql.Identifier(schema_name, table_name)
+    names = {"schema_name": db_string_converter_(schema_name), "table_name": db_string_converter_(table_name)}
+    for name, constraint in definition["constraints"]:
+        cursor.execute(_query_add_constraint.format(
+            table=table, name=sql.Identifier(name), definition=sql.SQL(constraint)))
+    for index in definition["indexes"]:
+        cursor.execute(index)
+    if definition["price_scale"] is not None:
+        cursor.execute(_query_save_price_scale.format(**names, price_scale=definition["price_scale"]))
+    else:
+        cursor.execute(_query_delete_price_scale.format(**names))
+    cursor.execute(_query_drop_indicator_states.format(**names, optional_filter=""))
+    for state_name, last_ID, state in definition["indicator_states"]:
+        cursor.execute(_query_save_indicator_state.format(
+            **names, state_name=db_string_converter_(state_name), last_ID=int(last_ID),
+            state=db_string_converter_(json.dumps(state))))
+    attach_series_catalog_(schema_name, table_name, cursor=cursor)
+    for bucket in definition["rollups"]:
+        cursor.execute(_query_create_rollup.format(**names, bucket=db_string_converter_(bucket)))
+    cursor.execute(_query_analyze_series.format(table=table))
+
+
+def drop_series_table_(cursor, schema_name: str, table_name: str, rollups: list[str] = ()):
+    """remove the series table with its rollups, price scale, indicator states and catalog entry"""
+    names = {"schema_name": db_string_converter_(schema_name), "table_name": db_string_converter_(table_name)}
+    cursor.execute(_query_drop_series.format(table=sql.Identifier(schema_name, table_name)))
+    for bucket in rollups:
+        cursor.execute(_query_drop_series.format(table=sql.Identifier(schema_name, f"{table_name}_rollup_{bucket}")))
+    cursor.execute(_query_delete_price_scale.format(**names))
+    cursor.execute(_query_drop_indicator_states.format(**names, optional_filter=""))
+    delete_series_catalog_(schema_name, table_name, cursor=cursor)
+
+
+def move_series_(schema_name: str, table_name: str, source: int, target: int) -> int:
+    """
+    move a series table between the shards - with its price scale, indicator states, catalog entry and rollups
+
+    rows go through COPY (binary) spooled to a temporary file, the table gets its constraints and indexes
+    after the rows are in. Source is dropped only once the target holds every row, a copy left on the target
+    by an interrupted move is replaced. Views of the series are not moved - create them again on the target.
+    Loads of the series wait until it is moved
+    :return: number of rows moved
+    """
+    if source == target:
+        raise ValueError(f"{schema_name}.{table_name} is moved to the shard it is kept by ({source})")
+    table = sql.Identifier(schema_name, table_name)
+    with psycopg2.connect(**_shard_connection_dicts[source]) as source_conn, \
+            psycopg2.connect(**_shard_connection_dicts[target]) as target_conn, \
+            SpooledTemporaryFile(max_size=MOVE_SPOOL_MAX_BYTES_) as spool:
+        source_cur, target_cur = source_conn.cursor(), target_conn.cursor()
+        definition = series_definition_(source_cur, schema_name, table_name)
+        if definition is None:
+            raise TimeSeriesNotFoundError_(f'series: {schema_name}.{table_name} is not kept by shard {source}')
+        source_cur.execute(_query_lock_series.format(table=table))
+        source_cur.execute(_query_count_rows.format(table=table))
+        row_count = source_cur.fetchone()[0]
+        source_cur.copy_expert(_query_copy_to.format(table=table).as_string(source_cur), spool)
+        spool.seek(0)
+
+        create_series_table_(target_cur, schema_name, table_name, definition)
+        target_cur.copy_expert(_query_copy_from.format(table=table).as_string(target_cur), spool)
+        target_cur.execute(_query_count_rows.format(table=table))
+        moved = target_cur.fetchone()[0]
+        if moved != row_count:
+            raise psycopg2.DataError(f"{schema_name}.{table_name}: {moved} out of {row_count} rows got moved")
+        finish_series_table_(target_cur, schema_name, table_name, definition)
+        # target is committed first - a failure past this point leaves the series on both shards, not on none
+        target_conn.commit()
+        drop_series_table_(source_cur, schema_name, table_name, definition["rollups"])
+    forget_series_table_(schema_name, table_name)
+    return row_count
+
+
+def rebalance_shards_(dry_run: bool = False, verbose: bool = False) -> list[tuple[str, str, int, int]]:
+    """
+    move every misplaced series (see ``misplaced_series_``) to the shard it belongs to, one series at a time
+
+    :param dry_run: only list the moves
+    :return: rows of (schema_name, table_name, source shard, target shard) of the moves
+    """
+    moves = misplaced_series_()
+    if dry_run:
+        return moves
+    for schema_name, table_name, source, target in moves:
+        rows = move_series_(schema_name, table_name, source, target)
+        if verbose:
+            print(f"{schema_name}.{table_name}: {rows} rows moved from shard {source} to shard {target}")
+    return moves
+
+
+if __name__ == '__main__':
+    # 1min series of 500k rows moved between two databases of the same server - binary COPY through a spooled
+    # file against fetching the rows and inserting them in pages of 10k (execute_values).
+    # COPY 2.4s in total (rows, indexes, catalog) vs 17.2s for the rows alone
+    from time import perf_counter
+
+    from psycopg2.extras import execute_values
+
+    from db_functions.db_helpers import _connection_dict, close_connection_pool_
+    from db_functions.sql_loader import build_schema_instructions_file_path
+
+    shard_ = {key_: value_ for key_, value_ in _connection_dict.items() if key_ != "cursor_factory"}
+    shard_["database"] = f"{_connection_dict['database']}_bench_shard"
+    # databases are created outside of a transaction block
+    conn_ = psycopg2.connect(**_connection_dict)
+    conn_.autocommit = True
+    conn_.cursor().execute(f'CREATE DATABASE "{shard_["database"]}";')
+    conn_.close()
+    with psycopg2.connect(**shard_) as conn_, open(build_schema_instructions_file_path) as schema_:
+        conn_.cursor().execute(schema_.read())
+    conn_.close()
+    _shard_connection_dicts[:] = [_connection_dict, shard_]
+    table_ = sql.Identifier("1min_time_series", "BENCH_XBEN")
+    try:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            cur_ = conn_.cursor()
+            cur_.execute(sql.SQL("""CREATE TABLE {table} ("ID" integer PRIMARY KEY, datetime timestamp NOT NULL,
+                open numeric(10,5), close numeric(10,5), high numeric(10,5), low numeric(10,5), volume bigint);
+                CREATE INDEX ON {table} (datetime);
+                INSERT INTO {table} SELECT i, TIMESTAMP '2000-01-03' + i * INTERVAL '1 minute', 100 + i % 100,
+                100 + i % 99, 101 + i % 100, 99 + i % 100, 1000 FROM generate_series(0, 499999) i;""").format(
+                table=table_))
+            attach_series_catalog_("1min_time_series", "BENCH_XBEN", cursor=cur_)
+        start_ = perf_counter()
+        with psycopg2.connect(**_connection_dict) as conn_, psycopg2.connect(**shard_) as target_:
+            cur_, target_cur_ = conn_.cursor(), target_.cursor()
+            target_cur_.execute(sql.SQL("""CREATE TABLE {table} ("ID" integer PRIMARY KEY, datetime timestamp,
+                open numeric(10,5), close numeric(10,5), high numeric(10,5), low numeric(10,5),
+                volume bigint);""").format(table=table_))
+            cur_.execute(sql.SQL("SELECT * FROM {table};").format(table=table_))
+            while page_ := cur_.fetchmany(10_000):
+                execute_values(target_cur_, sql.SQL("INSERT INTO {table} VALUES %s").format(
+                    table=table_).as_string(target_cur_), page_, page_size=10_000)
+            target_cur_.execute(sql.SQL("DROP TABLE {table};").format(table=table_))
+        pages_ = perf_counter() - start_
+        start_ = perf_counter()
+        move_series_("1min_time_series", "BENCH_XBEN", 0, 1)
+        copy_ = perf_counter() - start_
+        print(f"500k rows: COPY {copy_:.2f}s, pages of inserts {pages_:.2f}s")
+    finally:
+        close_connection_pool_()
+        _shard_connection_dicts[:] = [_connection_dict]
+        conn_ = psycopg2.connect(**_connection_dict)
+        conn_.autocommit = True
+        conn_.cursor().execute(sql.SQL("DROP TABLE IF EXISTS {table};").format(table=table_))
+        conn_.cursor().execute(f'DROP DATABASE "{shard_["database"]}" WITH (FORCE);')
+        conn_.close()
@@ -1,7 +1,9 @@
 # following file should be used as the first one for setting up entire database
 from os.path import abspath
 
-from db_functions.db_helpers import _connection_dict
+from db_functions.db_helpers import (
+    _connection_dict, _shard_connection_dicts, close_connection_pool_, invalidate_symbol_registry_,
+)
 
 import psycopg2
 
@@ -10,13 +12,21 @@ purge_schema_instructions_file_path = "\\".join(abspath(__file__).split("\\")[:-
 
 
 def _execute_instructions_from_file(instructions_file_path):
+    # statements prepared on the pooled connections may point to the tables that are about to be dropped
+    close_connection_pool_()
     with open(instructions_file_path, 'r') as schema_sql:
         instructions_for_db = schema_sql.readlines()
     instructions_for_db = "".join(instructions_for_db)
 
-    with psycopg2.connect(**_connection_dict) as conn:
-        cur: psycopg2.cursor = conn.cursor()
-        cur.execute(instructions_for_db)
+    # every shard keeps the whole structure, so a series can be moved to any of them
+    connection_dicts = [_connection_dict] + [
+        shard for shard in _shard_connection_dicts if shard is not _connection_dict]
+    for connection_dict in connection_dicts:
+        with psycopg2.connect(**connection_dict) as conn:
+            cur: psycopg2.cursor = conn.cursor()
+            cur.execute(instructions_for_db)
+    # symbols and tables kept by the registry are gone, or not there yet
+    invalidate_symbol_registry_()
 
 
 def import_db_structure_():
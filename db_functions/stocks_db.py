@@ -1,7 +1,8 @@
 import psycopg2
 from psycopg2._psycopg import Error
 
-from db_functions.db_helpers import db_string_converter_, _connection_dict
+from db_functions.db_helpers import db_string_converter_, _connection_dict, invalidate_symbol_registry_
+from db_functions.db_views import refresh_reference_views_
 
 
 # insert queries
@@ -35,7 +36,7 @@ def insert_investment_types_(equity_types):
         cur.close()
 
 
-def insert_stocks_(stocks: list[dict]):
+def insert_stocks_(stocks: list[dict], refresh_views: bool = True):
     with psycopg2.connect(**_connection_dict) as conn:
         cur = conn.cursor()
         for index, stock in enumerate(sorted(stocks, key=lambda s: s["symbol"])):
@@ -62,6 +63,9 @@ def insert_stocks_(stocks: list[dict]):
                 raise e
             conn.commit()
         cur.close()
+    invalidate_symbol_registry_()
+    if refresh_views:
+        refresh_reference_views_(("stocks_explained",))
 
 
 def fetch_investment_types_(name_like: str | None = None):
@@ -1,30 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from decimal import Decimal
 from typing import Literal
 
+import numpy as np
 import psycopg2
+from psycopg2 import sql
 from psycopg2.errors import UndefinedTable
 
 from db_functions.db_helpers import (
     is_equity_, is_forex_pair_,
     _connection_dict,
-    _information_schema_table_check,
+    POOL_MAX_CONNECTIONS_,
+    pooled_connection_,
+    pooled_transaction_,
+    shard_of_,
+    shard_connection_dict_,
+    execute_prepared_,
+    registry_series_table_exists_,
+    forget_series_table_,
     db_string_converter_,
+    decode_fixed_point_rows_,
+    fetch_price_scale_,
     TimeSeriesNotFoundError_,
     DataNotPresentError_,
     DataUncertainError_
 )
+from db_functions.indicator_states_db import advance_indicator_states_
+from db_functions.maintenance_db import forget_table_maintenance_, track_ingestion_
+from db_functions.series_catalog_db import attach_series_catalog_
 from minor_modules import time_interval_sanitizer
 
 
+# what to do with timestamps, at which some of the series in a panel have no bar
+PANEL_MISSING_POLICIES_ = ("nan", "ffill", "drop")
+PANEL_FIELDS_ = ("open", "close", "high", "low", "volume")
+
+# prices are kept as numeric(10,5) by default, or as integers scaled by 10 ** price_scale of the series
+NUMERIC_PRICE_TYPE_ = "numeric(10,5)"
+FIXED_POINT_PRICE_TYPE_ = "bigint"
+
 # create queries
 _create_time_table = """
 create table if not exists "{time_interval}_time_series"."{symbol}_{market_identification_code}" (
     "ID" integer not null,
     datetime timestamp without time zone,
-    open numeric(10,5),
-    close numeric(10,5),
-    high numeric(10,5),
-    low numeric(10,5),
+    open {price_type},
+    close {price_type},
+    high {price_type},
+    low {price_type},
     volume bigint,
     constraint {lower_symbol}_time_series_pkey primary key("ID")
 );
@@ -33,14 +57,20 @@ _create_forex_table = """
 create table if not exists "forex_time_series"."{symbol}_{time_interval}" (
     "ID" integer not null,
     datetime timestamp without time zone,
-    open numeric(10,5),
-    close numeric(10,5),
-    high numeric(10,5),
-    low numeric(10,5),
+    open {price_type},
+    close {price_type},
+    high {price_type},
+    low {price_type},
     constraint {lower_symbol}_{time_interval}_time_series_pkey primary key("ID")
 );
 """
 
+_query_save_price_scale = """
+INSERT INTO "public".price_scales (schema_name, table_name, price_scale)
+VALUES ({schema_name}, {table_name}, {price_scale})
+ON CONFLICT (schema_name, table_name) DO UPDATE SET price_scale = EXCLUDED.price_scale;
+"""
+
 # drop queries
 _drop_time_table = """
 drop table if exists "{time_interval}_time_series"."{symbol}_{market_identification_code}";
@@ -48,39 +78,33 @@ drop table if exists "{time_interval}_time_series"."{symbol}_{market_identificat
 _drop_forex_table = """
 drop table if exists "forex_time_series"."{symbol}_{time_interval}";
 """
-
-# insert queries
-_query_insert_equity_data = """
-INSERT INTO {time_series_schema}.\"{equity_symbol}_{market_identification_code}\" 
-(\"ID\", datetime, open, close, high, low, volume) 
-VALUES (
-    {index},
-    {timestamp}:: timestamp without time zone,
-    {open_price},
-    {close_price},
-    {high_price},
-    {low_price},
-    {volume}
-);
+_query_delete_price_scale = """
+DELETE FROM "public".price_scales scales WHERE scales.schema_name = {schema_name} AND scales.table_name = {table_name};
 """
-_query_insert_forex_data = """
-INSERT INTO "forex_time_series".\"{symbol}_{time_interval}\" 
-(\"ID\", datetime, open, close, high, low) 
-VALUES (
-    {index},
-    {timestamp}:: timestamp without time zone,
-    {open_price},
-    {close_price},
-    {high_price},
-    {low_price}
-);
-"""  # the ":: timestamp.." is comment in PSQL, so it's ok
+
+# insert queries (prepared statements - {table} is a schema qualified sql.Identifier, values go as $n parameters)
+# every column is sent as an array, so the whole batch is a single statement (and a single catalog trigger call)
+_prepared_insert_equity_data = sql.SQL("""
+INSERT INTO {table} ("ID", datetime, open, close, high, low, volume)
+SELECT * FROM unnest($1::integer[], $2::timestamp[], $3::numeric[], $4::numeric[], $5::numeric[], $6::numeric[],
+    $7::bigint[]);
+""")
+_prepared_insert_forex_data = sql.SQL("""
+INSERT INTO {table} ("ID", datetime, open, close, high, low)
+SELECT * FROM unnest($1::integer[], $2::timestamp[], $3::numeric[], $4::numeric[], $5::numeric[], $6::numeric[]);
+""")
+
+# IDs of the appended rows start here - the series stays locked for other appenders until the commit
+_prepared_allocate_series_IDs = sql.SQL("SELECT public.allocate_time_series_ids($1, $2, $3);")
 
 # select queries
-_last_timetable_point = """
-SELECT series.datetime FROM "{time_series_schema}"."{time_series_table}" series 
-ORDER BY series."ID" DESC LIMIT 1
-"""
+_prepared_last_timetable_point = sql.SQL("""
+SELECT series.datetime FROM {table} series ORDER BY series."ID" DESC LIMIT 1
+""")
+_prepared_catalog_last_datetime = sql.SQL("""
+SELECT catalog.last_datetime FROM "public".series_catalog catalog
+WHERE catalog.schema_name = $1 AND catalog.table_name = $2
+""")
 
 _query_get_data_from_equity_timeseries = """
 SELECT * FROM "{time_interval}_time_series"."{symbol}_{market_identification_code}";
@@ -88,18 +112,57 @@ SELECT * FROM "{time_interval}_time_series"."{symbol}_{market_identification_cod
 _query_get_data_from_forex_timeseries = """
 SELECT * FROM "forex_time_series"."{symbol}_{time_interval}";
 """
-_query_get_single_timeseries_point = """
-SELECT * FROM "{time_series_schema}"."{time_series_table}" series 
-where series.datetime = '{search_date}';
-"""
-_query_get_ID_from_table_by_date = """
-SELECT "ID" FROM "{schema_name}"."{table_name}" series
-where series.datetime {operation} TIMESTAMP '{search_date}' ORDER BY series.datetime {operation_order} LIMIT 1;
-"""
-_query_get_data_by_timestamps = """
-SELECT * FROM \"{schema_name}\".\"{table_name}\" series 
-WHERE {earlier_bracket} {optional_and} {later_bracket} {optional_order} {optional_limit};
+_prepared_get_single_timeseries_point = sql.SQL("""
+SELECT * FROM {table} series where series.datetime = $1;
+""")
+# closest ID lookups, by operation
+_prepared_get_ID_from_table_by_date = {
+    "<=": sql.SQL("""
+SELECT "ID" FROM {table} series where series.datetime <= $1 ORDER BY series.datetime DESC LIMIT 1;
+"""),
+    ">=": sql.SQL("""
+SELECT "ID" FROM {table} series where series.datetime >= $1 ORDER BY series.datetime ASC LIMIT 1;
+"""),
+}
+_query_get_columns_by_timestamps = """
+SELECT series."ID", series.datetime, series.open{price_cast}, series.close{price_cast},
+    series.high{price_cast}, series.low{price_cast} {optional_volume}
+FROM "{schema_name}"."{table_name}" series {optional_filter} ORDER BY series."ID";
 """
+_query_get_all_price_scales = "SELECT scales.schema_name, scales.table_name, scales.price_scale FROM \"public\".price_scales scales;"
+_query_get_panel_columns = sql.SQL("""
+SELECT series.datetime, {fields} FROM {table} series {optional_filter} ORDER BY series.datetime;
+""")
+# range fetches - LIMIT NULL returns every row
+_prepared_get_data_between_timestamps = sql.SQL("""
+SELECT * FROM {table} series WHERE series.datetime >= $1 AND series.datetime <= $2 LIMIT $3;
+""")
+_prepared_get_data_before_timestamp = sql.SQL("""
+SELECT * FROM {table} series WHERE series.datetime <= $1 ORDER BY series.datetime DESC LIMIT $2;
+""")
+_prepared_get_data_after_timestamp = sql.SQL("""
+SELECT * FROM {table} series WHERE series.datetime >= $1 LIMIT $2;
+""")
+# bracket of IDs closest to both dates, extended by number of datapoints ($3) when one of the dates is missing,
+# and the rows inside of it - in a single statement. Bracket is repeated in every row (and returned alone for
+# an empty range), so the caller can tell which date couldn't be found
+_prepared_get_data_by_bracket = sql.SQL("""
+WITH closest AS (
+    SELECT
+        (SELECT series."ID" FROM {table} series WHERE series.datetime >= $1
+         ORDER BY series.datetime ASC LIMIT 1) AS start_id,
+        (SELECT series."ID" FROM {table} series WHERE series.datetime <= $2
+         ORDER BY series.datetime DESC LIMIT 1) AS end_id
+), bracket AS (
+    SELECT closest.start_id AS found_start_id, closest.end_id AS found_end_id,
+        GREATEST(COALESCE(closest.start_id, closest.end_id - $3 + 1), 0) AS start_id,
+        COALESCE(closest.end_id, closest.start_id + $3 - 1) AS end_id
+    FROM closest
+)
+SELECT bracket.found_start_id, bracket.found_end_id, series.*
+FROM bracket LEFT JOIN {table} series ON series."ID" BETWEEN bracket.start_id AND bracket.end_id
+ORDER BY series."ID";
+""")
 
 
 @time_interval_sanitizer()
@@ -136,56 +199,74 @@ def resolve_time_series_location_(
     return schema_name, table_name, is_equity
 
 
+def encode_fixed_point_price_(price: str | float | Decimal, price_scale: int) -> int:
+    """represent price as an integer number of 10 ** -price_scale units (rounded half to even)"""
+    return int((Decimal(str(price)) * 10 ** price_scale).to_integral_value())
+
+
 def insert_historical_data_(
         historical_data: list[dict], symbol: str, time_interval: str,
-        rownum_start: int = 0, is_equity: bool | None = None, mic_code: str | None = None):
+        rownum_start: int | None = None, is_equity: bool | None = None, mic_code: str | None = None):
     """
     Insert historical data for given equity into the database. Earliest timestamped rows are inserted first
-    rownum_start is used, when table already has some data, and user wants to append fresh changes to time series
     for this function, the 'is_equity' has been left alone with 'True/False' to make it easier to
 
+    IDs are given by the database - rows are appended right after the last stored one. Appenders of the same series
+    (any number of processes) take turns, the ranges they get are consecutive and without gaps. Rows that are not
+    newer than the last stored one are refused with psycopg2.DataError, so ID order stays the datetime order
+    :param rownum_start: ID of the first row, to place the rows yourself - nothing keeps other appenders away then
     :param is_equity: differentiates from forex pairs and equity (stock/bond/etc.) time series
     :param mic_code: if inserting equity data, use it to denote exchange from which it comes
     """
-    _, __, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+    schema_name, table_name, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
 
     if time_interval in ['1day']:  # future-thinking about other time intervals allowed by provider...
         timestring = '%Y-%m-%d'
     elif time_interval in ['1min']:  # ~||~ (^ as above)
         timestring = '%Y-%m-%d %H:%M:%S'
-    with psycopg2.connect(**_connection_dict) as conn:
-        conn.autocommit = True
+    # rows written are counted, so a big load gets the statistics of its table refreshed after it ends
+    # rows, the IDs allocated for them and indicator states advanced by them are committed together - on a pooled
+    # connection, so the next insert of the series reuses the statements prepared by this one
+    with track_ingestion_(schema_name, table_name, len(historical_data)), \
+            pooled_transaction_(shard_of_(schema_name, table_name)) as conn:
         cur = conn.cursor()
+        price_scale = fetch_price_scale_(schema_name, table_name, cursor=cur)
         zero_timestamp: str = historical_data[0]['datetime']
         last_timestamp: str = historical_data[-1]['datetime']
         if datetime.strptime(zero_timestamp, timestring) > datetime.strptime(last_timestamp, timestring):
-            historical_data = reversed(historical_data)
-        #  iterate from oldest to newest - new rows will be appended to the farthest row anyway
-        for rownum, candle in enumerate(historical_data):
-            query_dict = {
-                "index": rownum + rownum_start,
-                "open_price": candle['open'],
-                "close_price": candle['close'],
-                "high_price": candle['high'],
-                "low_price": candle['low'],
-                "timestamp": f"'{candle['datetime']}'"
-            }
-            if is_equity:
-                query_dict["equity_symbol"] = symbol
-                query_dict["time_series_schema"] = f'"{time_interval}_time_series"'
-                query_dict["market_identification_code"] = mic_code
-                query_dict["volume"] = candle['volume']
-                try:
-                    cur.execute(_query_insert_equity_data.format(**query_dict))
-                except psycopg2.Error as e:
-                    print(e)
-                    print(query_dict)
-                    raise psycopg2.Error("there was error with database")
+            historical_data = list(reversed(historical_data))
+        if is_equity:
+            insert_query = _prepared_insert_equity_data.format(
+                table=sql.Identifier(f"{time_interval}_time_series", f"{symbol}_{mic_code}"))
+        else:
+            insert_query = _prepared_insert_forex_data.format(
+                table=sql.Identifier("forex_time_series", f"{'_'.join(symbol.split('/')).upper()}_{time_interval}"))
+        #  columns are ordered from oldest to newest - new rows will be appended to the farthest row anyway
+        # values are typed in python, arrays of strings would not be cast to timestamps/numbers by EXECUTE
+        columns = [[datetime.strptime(candle['datetime'], timestring) for candle in historical_data]]
+        for price in ['open', 'close', 'high', 'low']:
+            if price_scale is not None:
+                columns.append([encode_fixed_point_price_(candle[price], price_scale) for candle in historical_data])
             else:
-                query_dict['symbol'] = "_".join(symbol.split("/")).upper()
-                query_dict['time_interval'] = time_interval
-                cur.execute(_query_insert_forex_data.format(**query_dict))
-        conn.commit()
+                columns.append([Decimal(str(candle[price])) for candle in historical_data])
+        if is_equity:
+            columns.append([int(candle['volume']) for candle in historical_data])
+        # IDs are allocated once the rows are ready - other appenders of the series wait only for the insert itself
+        if rownum_start is None:
+            execute_prepared_(cur, _prepared_allocate_series_IDs, (schema_name, table_name, columns[0][0]))
+            rownum_start = cur.fetchone()[0]
+        columns.insert(0, list(range(rownum_start, rownum_start + len(historical_data))))
+        if is_equity:
+            try:
+                execute_prepared_(cur, insert_query, columns)
+            except psycopg2.Error as e:
+                print(e)
+                print(historical_data[0], historical_data[-1])
+                raise psycopg2.Error("there was error with database")
+        else:
+            execute_prepared_(cur, insert_query, columns)
+        # indicators kept for the series follow the new rows, without recalculating entire history
+        advance_indicator_states_(schema_name, table_name, historical_data, rownum_start, cur, price_scale)
         cur.close()
 
 
@@ -195,29 +276,30 @@ def time_series_table_exists_(
     check if the given table exists in the time-specific schema
     """
     time_series_schema, table_name, _ = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
-    with psycopg2.connect(**_connection_dict) as conn:
-        cur = conn.cursor()
-        cur.execute(_information_schema_table_check.format(
-            table_name=db_string_converter_(table_name),
-            schema=db_string_converter_(time_series_schema),
-        ))
-        result = cur.fetchall()
-        if result:
-            return True
-        return False
+    return registry_series_table_exists_(time_series_schema, table_name)
 
 
 def create_time_series_(
-        symbol: str, time_interval: str, is_equity: bool | None = None, mic_code: str | None = None) -> None:
+        symbol: str, time_interval: str, is_equity: bool | None = None, mic_code: str | None = None,
+        price_scale: int | None = None) -> None:
     """
     creates table inside database schema, that corresponds to time_interval passed into function call
 
     each time interval has corresponding database schema that saves stock market price history
     for the given symbol/MIC pair
+
+    :param price_scale: store prices as 64-bit integers with this many decimal places, instead of numeric(10,5).
+        Fixed-point columns are smaller, faster to aggregate and fit prices above 99,999 (like BTC or indexes)
     """
     # retrieve schema and table names
     schema_name, table_name, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
-    with psycopg2.connect(**_connection_dict) as conn:
+    if price_scale is not None and not 0 <= price_scale <= 12:
+        raise ValueError("price scale has to be a number of decimal places between 0 and 12")
+    price_type = NUMERIC_PRICE_TYPE_ if price_scale is None else FIXED_POINT_PRICE_TYPE_
+    # storage of already existing series stays as it is - existence is checked in the database, not in the registry
+    forget_series_table_(schema_name, table_name)
+    table_existed = time_series_table_exists_(symbol, time_interval, is_equity, mic_code)
+    with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
         cur = conn.cursor()
         if is_equity:
             q_dict = {
@@ -225,6 +307,7 @@ def create_time_series_(
                 "symbol": symbol,
                 "lower_symbol": symbol.lower(),
                 "time_interval": time_interval,
+                "price_type": price_type,
             }
             cur.execute(_create_time_table.format(**q_dict))
         else:
@@ -233,8 +316,22 @@ def create_time_series_(
                 "symbol": symbol_,
                 "lower_symbol": symbol_.lower(),
                 "time_interval": time_interval,
+                "price_type": price_type,
             }
             cur.execute(_create_forex_table.format(**q_dict))
+        scale_dict = {
+            "schema_name": db_string_converter_(schema_name),
+            "table_name": db_string_converter_(table_name),
+            "price_scale": price_scale,
+        }
+        if not table_existed and price_scale is None:
+            cur.execute(_query_delete_price_scale.format(**scale_dict))
+        elif not table_existed:
+            cur.execute(_query_save_price_scale.format(**scale_dict))
+        if not table_existed:
+            attach_series_catalog_(schema_name, table_name, cursor=cur)
+    if not table_existed:
+        forget_table_maintenance_(schema_name, table_name)
     assert time_series_table_exists_(symbol, time_interval, mic_code=mic_code)
 
 
@@ -247,14 +344,14 @@ def time_series_latest_timestamp_(
     # retrieve schema and table names
     schema_name, table_name, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
 
-    with psycopg2.connect(**_connection_dict) as conn:
+    with pooled_connection_(shard_of_(schema_name, table_name)) as conn:
         cur = conn.cursor()
-        q_dict = {
-            "time_series_schema": schema_name,
-            "time_series_table": table_name,
-        }
-        cur.execute(_last_timetable_point.format(**q_dict))
+        execute_prepared_(cur, _prepared_catalog_last_datetime, (schema_name, table_name))
         last_record = cur.fetchall()
+        if not last_record:  # series is not in the catalog (yet) - ask the table itself
+            execute_prepared_(
+                cur, _prepared_last_timetable_point.format(table=sql.Identifier(schema_name, table_name)))
+            last_record = cur.fetchall()
         try:
             t_ = last_record[0][0]  # this will already be a "datetime.datetime()" python object
         except IndexError:
@@ -273,19 +370,15 @@ def fetch_datapoint_by_date_(
     # retrieve schema and table names
     schema_name, table_name, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
 
-    with psycopg2.connect(**_connection_dict) as conn:
+    with pooled_connection_(shard_of_(schema_name, table_name)) as conn:
         cur = conn.cursor()
-        q = _query_get_single_timeseries_point.format(
-            time_series_schema=schema_name,
-            time_series_table=table_name,
-            search_date=date,
-        )
+        q = _prepared_get_single_timeseries_point.format(table=sql.Identifier(schema_name, table_name))
         try:
-            cur.execute(q)
+            execute_prepared_(cur, q, (date,))
         # user forced 'False/True' in 'is_equity' and PSQL didn't finc anything despite efforts
         except UndefinedTable:
             raise TimeSeriesNotFoundError_(f'There is no time series: {schema_name}.{table_name}')
-        res = cur.fetchall()
+        res = decode_fixed_point_rows_(cur.fetchall(), fetch_price_scale_(schema_name, table_name, cursor=cur))
     if not res:
         raise DataNotPresentError_(f"There is no point in data that is associated with date: {date}")
     if len(res) > 1:
@@ -300,16 +393,10 @@ def fetch_ID_closest_to_date_(
     if operation not in ['<=', '>=']:
         raise ValueError(f'Operation {operation} is not allowed. allowed operations: "<=", "=>"')
     schema_name, table_name, _ = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
-    with psycopg2.connect(**_connection_dict) as conn:
+    with pooled_connection_(shard_of_(schema_name, table_name)) as conn:
         cur = conn.cursor()
-        q = {
-            "schema_name": schema_name,
-            "table_name": table_name,
-            "operation": operation,
-            "search_date": str(date_to_check),
-            "operation_order": "ASC" if operation == ">=" else "DESC"
-        }
-        cur.execute(_query_get_ID_from_table_by_date.format(**q))
+        q = _prepared_get_ID_from_table_by_date[operation].format(table=sql.Identifier(schema_name, table_name))
+        execute_prepared_(cur, q, (date_to_check,))
         res = cur.fetchall()
     if not res:
         raise DataNotPresentError_(
@@ -362,11 +449,13 @@ def calculate_fetch_time_bracket_(
     # find ID of the item that is associated with the earliest possible datapoint closest to start_date
     if start_date:
         earliest_id = fetch_ID_closest_to_date_(
-            start_date, operation=">=", symbol=symbol, time_interval=time_interval, mic_code=mic_code)
+            start_date, operation=">=", symbol=symbol, time_interval=time_interval, is_equity=is_equity,
+            mic_code=mic_code)
     # find ID of the item that is associated with the latest possible datapoint closest to end_date
     if end_date:
         latest_id = fetch_ID_closest_to_date_(
-            end_date, operation="<=", symbol=symbol, time_interval=time_interval, mic_code=mic_code)
+            end_date, operation="<=", symbol=symbol, time_interval=time_interval, is_equity=is_equity,
+            mic_code=mic_code)
 
     if (latest_id is None) and (trading_time_span is not None) and (earliest_id is not None):
         latest_id = earliest_id + trading_time_span - 1
@@ -382,6 +471,56 @@ def calculate_fetch_time_bracket_(
     return earliest_id, latest_id
 
 
+def fetch_data_by_bracket_(
+        symbol: str, time_interval: str, is_equity: bool | None = None, mic_code: str | None = None,
+        start_date: datetime | None = None, end_date: datetime | None = None,
+        time_span: timedelta | None = None, trading_time_span: int | None = None) -> list[tuple]:
+    """
+    fetch rows of the same ID bracket as ``calculate_fetch_time_bracket`` gives, in a single round trip
+
+    chained calls (two closest ID lookups, last ID lookup, range fetch) each connect and query on their own,
+    here the bracket is resolved and its rows are returned by one prepared statement. Parameters follow
+    ``calculate_fetch_time_bracket`` - 2 out of: start_date, end_date, time span (either kind).
+    Rows are sorted by their "ID"
+    """
+    missing_count = [
+        not start_date, not end_date,
+        (not time_span) and (not trading_time_span)  # this one is kind of 'either-or'
+    ].count(True)
+    if missing_count > 1:
+        raise LookupError(
+            "At least 2 different parameters need to be passed to form a db lookup range, "
+            "that can be used to perform a database fetch. \nChoose one configuration:"
+            "(Two dates 'start-end'; One date, one interval)"
+        )
+    schema_name, table_name, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+
+    if start_date and time_span and (end_date is None):
+        end_date = start_date + time_span
+    elif end_date and time_span and (start_date is None):
+        start_date = end_date - time_span
+
+    try:
+        with pooled_connection_(shard_of_(schema_name, table_name)) as conn:
+            cur = conn.cursor()
+            execute_prepared_(
+                cur, _prepared_get_data_by_bracket.format(table=sql.Identifier(schema_name, table_name)),
+                (start_date, end_date, trading_time_span))
+            res = cur.fetchall()
+            price_scale = fetch_price_scale_(schema_name, table_name, cursor=cur)
+    except UndefinedTable:
+        raise TimeSeriesNotFoundError_(f'series: {schema_name}.{table_name} does not exist')
+    found_start_id, found_end_id = res[0][:2]
+    for date_to_check, found_id, operation in [(start_date, found_start_id, ">="), (end_date, found_end_id, "<=")]:
+        if date_to_check is not None and found_id is None:
+            raise DataNotPresentError_(
+                f"Couldn't find datapoint closest to {date_to_check} "
+                f'parameters: {schema_name=}, {table_name=}, {operation=}'
+            )
+    # LEFT JOIN leaves a single row of NULLs for an empty bracket
+    return decode_fixed_point_rows_([row[2:] for row in res if row[2] is not None], price_scale)
+
+
 def fetch_data_by_dates_(
         symbol: str, time_interval: str, is_equity: bool | None = None, mic_code: str | None = None,
         start_date: datetime | None = None, end_date: datetime | None = None,
@@ -412,46 +551,305 @@ def fetch_data_by_dates_(
     elif end_date and time_span and (start_date is None):
         start_date = end_date - time_span
 
-    # optional number of datapoints
-    if trading_time_span:
-        optional_limit = f"LIMIT {trading_time_span}"
-    else:
-        optional_limit = ""
+    # optional number of datapoints (NULL limit fetches everything)
+    limit = trading_time_span if trading_time_span else None
 
     if start_date and end_date:
-        q = {
-            "earlier_bracket": f"series.datetime >= TIMESTAMP '{start_date}'",
-            "optional_and": "AND",
-            "later_bracket": f"series.datetime <= TIMESTAMP '{end_date}'",
-            "optional_order": "",
-        }
+        query, params = _prepared_get_data_between_timestamps, (start_date, end_date, limit)
     elif end_date is not None and trading_time_span is not None:
-        q = {
-            "earlier_bracket": "",
-            "optional_and": "",
-            "later_bracket": f"series.datetime <= TIMESTAMP '{end_date}'",
-            "optional_order": "order by series.datetime desc"
-        }
+        query, params = _prepared_get_data_before_timestamp, (end_date, limit)
     elif start_date is not None and trading_time_span is not None:
-        q = {
-            "earlier_bracket": f"series.datetime >= TIMESTAMP '{start_date}'",
-            "optional_and": "",
-            "later_bracket": "",
-            "optional_order": "",
-        }
+        query, params = _prepared_get_data_after_timestamp, (start_date, limit)
     else:
         d = (schema_name, table_name, start_date, end_date, time_span, trading_time_span)
         raise RuntimeError(
             f'something went wrong, couldn\'t formulate a bracket even when data has been passed to function: {d}')
 
-    q["schema_name"] = schema_name
-    q["table_name"] = table_name
-    q["optional_limit"] = optional_limit
     try:
-        with psycopg2.connect(**_connection_dict) as conn:
+        with pooled_connection_(shard_of_(schema_name, table_name)) as conn:
             cur = conn.cursor()
-            cur.execute(_query_get_data_by_timestamps.format(**q))
-            data = cur.fetchall()
+            execute_prepared_(cur, query.format(table=sql.Identifier(schema_name, table_name)), params)
+            data = decode_fixed_point_rows_(
+                cur.fetchall(), fetch_price_scale_(schema_name, table_name, cursor=cur))
     except UndefinedTable:
         raise TimeSeriesNotFoundError_(f'series: {schema_name}.{table_name} does not exist')
     return sorted(data, key=lambda r: r[0])
+
+
+def fetch_time_series_arrays_(
+        symbol: str, time_interval: str, is_equity: bool | None = None, mic_code: str | None = None,
+        start_date: datetime | None = None, end_date: datetime | None = None,
+        raw_prices: bool = False) -> dict[str, np.ndarray]:
+    """
+    Get entire time series (or its part between optional dates, both inclusive) as columns of numpy arrays
+
+    numeric prices are cast to floats by the database already, which is much cheaper than decoding them into
+    python Decimals, fixed-point prices are divided by their scale in numpy.
+    Keys of the result: "ID", "datetime", "open", "close", "high", "low" (and "volume" for equities)
+
+    :param raw_prices: return fixed-point prices as they are stored - int64 numbers of 10 ** -price_scale units
+    """
+    schema_name, table_name, is_equity = resolve_time_series_location_(symbol, time_interval, is_equity, mic_code)
+    price_scale = fetch_price_scale_(schema_name, table_name)
+    if raw_prices and price_scale is None:
+        raise ValueError(f"{schema_name}.{table_name} keeps numeric prices, "
+                         "raw prices are only kept by fixed-point series")
+    brackets = []
+    if start_date is not None:
+        brackets.append(f"series.datetime >= TIMESTAMP '{start_date}'")
+    if end_date is not None:
+        brackets.append(f"series.datetime <= TIMESTAMP '{end_date}'")
+    q = {
+        "schema_name": schema_name,
+        "table_name": table_name,
+        "optional_volume": ", series.volume" if is_equity else "",
+        "optional_filter": "WHERE " + " AND ".join(brackets) if brackets else "",
+        "price_cast": "::float8" if price_scale is None else "",
+    }
+    try:
+        with psycopg2.connect(**shard_connection_dict_(schema_name, table_name)) as conn:
+            cur = conn.cursor()
+            cur.execute(_query_get_columns_by_timestamps.format(**q))
+            data = cur.fetchall()
+    except UndefinedTable:
+        raise TimeSeriesNotFoundError_(f'series: {schema_name}.{table_name} does not exist')
+
+    columns = list(zip(*data)) if data else [()] * (7 if is_equity else 6)
+    arrays = {
+        "ID": np.array(columns[0], dtype=np.int64),
+        "datetime": np.array(columns[1], dtype='datetime64[m]' if time_interval == '1min' else 'datetime64[D]'),
+    }
+    for index, price in enumerate(["open", "close", "high", "low"], start=2):
+        if price_scale is None:
+            arrays[price] = np.array(columns[index], dtype=np.float64)
+        elif raw_prices:
+            arrays[price] = np.array(columns[index], dtype=np.int64)
+        else:
+            arrays[price] = np.array(columns[index], dtype=np.int64) / 10 ** price_scale
+    if is_equity:
+        arrays["volume"] = np.array(columns[6], dtype=np.int64)
+    return arrays
+
+
+def _fetch_panel_columns(
+        schema_name: str, table_name: str, is_equity: bool, fields: tuple, price_scale: int | None,
+        start_date: datetime | None, end_date: datetime | None) -> list[tuple]:
+    """worker of ``fetch_time_series_panel`` - rows of (datetime, *fields) of a single series, prices as floats"""
+    divisor = "" if price_scale is None else f" / {10 ** price_scale}"
+    columns = []
+    for field in fields:
+        if field == "volume":
+            columns.append(sql.SQL("series.volume::float8" if is_equity else "NULL::float8"))
+        else:
+            columns.append(sql.SQL(f"series.{field}::float8{divisor}"))
+    brackets, params = [], []
+    if start_date is not None:
+        brackets.append(sql.SQL("series.datetime >= %s"))
+        params.append(start_date)
+    if end_date is not None:
+        brackets.append(sql.SQL("series.datetime <= %s"))
+        params.append(end_date)
+    query = _query_get_panel_columns.format(
+        fields=sql.SQL(", ").join(columns), table=sql.Identifier(schema_name, table_name),
+        optional_filter=sql.SQL("WHERE ") + sql.SQL(" AND ").join(brackets) if brackets else sql.SQL(""))
+    try:
+        with pooled_connection_(shard_of_(schema_name, table_name)) as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            return cur.fetchall()
+    except UndefinedTable:
+        raise TimeSeriesNotFoundError_(f'series: {schema_name}.{table_name} does not exist')
+
+
+def fetch_time_series_panel_(
+        series: list[tuple[str, str | None]], time_interval: str,
+        start_date: datetime | None = None, end_date: datetime | None = None,
+        fields: tuple[str, ...] = ("close",), missing: str = "nan",
+        max_workers: int = POOL_MAX_CONNECTIONS_) -> dict:
+    """
+    fetch the same period of many series at once, aligned on the union of their timestamps
+
+    series are queried concurrently over the pooled connections of their shards, alignment is done in numpy.
+    Prices (and volume) are floats, fixed-point prices are decoded by the database.
+
+    :param series: (symbol, mic_code) pairs, mic_code is None for forex pairs
+    :param fields: any of "open", "close", "high", "low", "volume" (volume of forex pairs is NaN)
+    :param missing: timestamps at which a series has no bar - "nan" leaves NaN, "ffill" repeats its previous bar
+        (NaN until its first bar), "drop" keeps only the timestamps present in every series
+    :return: {"datetime": (T,) array, "series": list of the pairs, field: (T, N) matrix for each field}
+    """
+    if missing not in PANEL_MISSING_POLICIES_:
+        raise ValueError(f"missing bars policy has to be one of: {PANEL_MISSING_POLICIES_} (got {missing})")
+    unknown_fields = set(fields) - set(PANEL_FIELDS_)
+    if unknown_fields:
+        raise ValueError(f"unknown panel fields: {unknown_fields}. Possible fields: {PANEL_FIELDS_}")
+    locations = [resolve_time_series_location_(symbol, time_interval, mic_code=mic_code) for symbol, mic_code in series]
+    # price scales are kept next to the series, by each of the shards the panel spans
+    price_scales = {}
+    for shard in sorted({shard_of_(*location[:2]) for location in locations}):
+        with pooled_connection_(shard) as conn:
+            cur = conn.cursor()
+            cur.execute(_query_get_all_price_scales)
+            price_scales.update(
+                ((schema_name, table_name), scale) for schema_name, table_name, scale in cur.fetchall())
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(series)))) as executor:
+        results = list(executor.map(
+            lambda location: _fetch_panel_columns(
+                *location, fields, price_scales.get(location[:2]), start_date, end_date),
+            locations))
+
+    date_type = 'datetime64[m]' if time_interval == '1min' else 'datetime64[D]'
+    dates = [np.array([row[0] for row in rows], dtype=date_type) for rows in results]
+    all_dates = np.unique(np.concatenate(dates)) if dates else np.array([], dtype=date_type)
+    present = np.zeros((len(all_dates), len(series)), dtype=bool)
+    panel = {field: np.full((len(all_dates), len(series)), np.nan) for field in fields}
+    for column, (series_dates, rows) in enumerate(zip(dates, results)):
+        if not rows:
+            continue
+        positions = np.searchsorted(all_dates, series_dates)
+        present[positions, column] = True
+        values = np.array([row[1:] for row in rows], dtype=np.float64)
+        for index, field in enumerate(fields):
+            panel[field][positions, column] = values[:, index]
+
+    if missing == "ffill" and len(all_dates):
+        # index of the last row with a bar, for every cell - rows without a bar point to the previous one
+        last_present = np.where(present, np.arange(len(all_dates))[:, None], -1)
+        np.maximum.accumulate(last_present, axis=0, out=last_present)
+        columns = np.arange(len(series))
+        for field in fields:
+            filled = panel[field][np.maximum(last_present, 0), columns]
+            filled[last_present < 0] = np.nan
+            panel[field] = filled
+    elif missing == "drop":
+        complete = present.all(axis=1)
+        all_dates = all_dates[complete]
+        panel = {field: matrix[complete] for field, matrix in panel.items()}
+    return {"datetime": all_dates, "series": list(series), **panel}
+
+
+if __name__ == '__main__':
+    # numeric(10,5) prices compared to fixed-point ones, on a year of random-walk minutes (~2 million rows)
+    from io import StringIO
+    from time import perf_counter
+
+    rows_, scale_ = 2_000_000, 5
+    closes_ = np.round(100 + np.cumsum(np.random.normal(0, 0.01, rows_)), scale_)
+    opens_ = np.concatenate(([100.], closes_[:-1]))
+    highs_ = np.maximum(opens_, closes_) + np.round(np.abs(np.random.normal(0, 0.01, rows_)), scale_)
+    lows_ = np.minimum(opens_, closes_) - np.round(np.abs(np.random.normal(0, 0.01, rows_)), scale_)
+    dates_ = np.datetime64('2022-01-03T00:00') + np.arange(rows_).astype('timedelta64[m]')
+    volumes_ = np.random.randint(100, 10000, rows_)
+
+    with psycopg2.connect(**_connection_dict) as conn_:
+        cur_ = conn_.cursor()
+        for name_, price_type_ in [("BENCHNUMERIC", NUMERIC_PRICE_TYPE_), ("BENCHFIXED", FIXED_POINT_PRICE_TYPE_)]:
+            fixed_ = price_type_ == FIXED_POINT_PRICE_TYPE_
+            cur_.execute(_create_time_table.format(
+                time_interval="1min", symbol=name_, market_identification_code="XBEN",
+                lower_symbol=name_.lower(), price_type=price_type_))
+            prices_ = [np.round(p * 10 ** scale_).astype(np.int64) if fixed_ else p
+                       for p in (opens_, closes_, highs_, lows_)]
+            buffer_ = StringIO()
+            for row_ in zip(range(rows_), dates_.astype(str), *prices_, volumes_):
+                buffer_.write("\t".join(map(str, row_)) + "\n")
+            buffer_.seek(0)
+            start_ = perf_counter()
+            cur_.copy_expert(f'COPY "1min_time_series"."{name_}_XBEN" FROM STDIN', buffer_)
+            load_ = perf_counter() - start_
+            cur_.execute(f"""select pg_total_relation_size('"1min_time_series"."{name_}_XBEN"')""")
+            size_ = cur_.fetchall()[0][0]
+            start_ = perf_counter()
+            cur_.execute(f"""
+                SELECT date_trunc('hour', datetime), max(high), min(low), avg(close), sum(volume)
+                FROM "1min_time_series"."{name_}_XBEN" GROUP BY 1""")
+            cur_.fetchall()
+            aggregate_ = perf_counter() - start_
+            start_ = perf_counter()
+            cur_.execute(_query_get_columns_by_timestamps.format(
+                schema_name="1min_time_series", table_name=f"{name_}_XBEN", optional_volume=", series.volume",
+                optional_filter="", price_cast="" if fixed_ else "::float8"))
+            columns_ = list(zip(*cur_.fetchall()))
+            decoded_ = [np.array(c, dtype=np.int64) / 10 ** scale_ if fixed_ else np.array(c, dtype=np.float64)
+                        for c in columns_[2:6]]
+            fetch_ = perf_counter() - start_
+            print(f"{price_type_:>13}: size {size_ / 2 ** 20:.1f}MB, COPY {load_:.2f}s, "
+                  f"hourly aggregate {aggregate_:.2f}s, fetch into arrays {fetch_:.2f}s")
+            cur_.execute(_drop_time_table.format(
+                time_interval="1min", symbol=name_, market_identification_code="XBEN"))
+
+    # chart fetch of ~100 rows - chained bracket calculation and range fetch against a single statement
+    from db_functions.db_helpers import fetch_generic_range_by_IDs_
+
+    with psycopg2.connect(**_connection_dict) as conn_:
+        cur_ = conn_.cursor()
+        cur_.execute(_create_time_table.format(
+            time_interval="1min", symbol="BENCHBRACKET", market_identification_code="XBEN",
+            lower_symbol="benchbracket", price_type=NUMERIC_PRICE_TYPE_))
+        cur_.execute("""INSERT INTO "1min_time_series"."BENCHBRACKET_XBEN"
+            SELECT i, TIMESTAMP '2022-01-03' + i * INTERVAL '1 minute', 100, 100, 101, 99, 1000
+            FROM generate_series(0, 100000) i;
+            CREATE INDEX ON "1min_time_series"."BENCHBRACKET_XBEN" (datetime);""")
+    try:
+        calls_ = 300
+        starts_ = [datetime(2022, 1, 3) + timedelta(minutes=int(m)) for m in np.random.randint(0, 99000, calls_)]
+        bracket_arguments_ = dict(symbol="BENCHBRACKET", time_interval="1min", is_equity=True, mic_code="XBEN")
+        start_ = perf_counter()
+        for date_ in starts_:
+            bracket_ = calculate_fetch_time_bracket_(
+                **bracket_arguments_, start_date=date_, end_date=date_ + timedelta(minutes=99))
+            fetch_generic_range_by_IDs_("1min_time_series", "BENCHBRACKET_XBEN", *bracket_)
+        chained_ = (perf_counter() - start_) / calls_
+        start_ = perf_counter()
+        for date_ in starts_:
+            fetch_data_by_bracket_(**bracket_arguments_, start_date=date_, end_date=date_ + timedelta(minutes=99))
+        single_ = (perf_counter() - start_) / calls_
+        print(f"chart fetch: chained calls {chained_ * 1e3:.2f}ms, single statement {single_ * 1e3:.2f}ms")
+    finally:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            conn_.cursor().execute(_drop_time_table.format(
+                time_interval="1min", symbol="BENCHBRACKET", market_identification_code="XBEN"))
+
+    # 200 appends of 100 rows - IDs read by the client before every insert (as the drain used to) against
+    # IDs allocated by the database, from a single writer and from 4 of them at once, a series each (appends of
+    # the same series have to come in datetime order). 4.5ms, 3.9ms and 4.6ms per page (8.4ms, 8.5ms and 11.4ms
+    # when every insert connected and prepared its statements anew) - allocation (with the check of the last
+    # datetime) costs no more than the read it replaces. 4 writers on a single CPU don't get faster, the insert
+    # itself is what they wait for
+    from db_functions.db_helpers import fetch_generic_last_ID_
+
+    pages_ = [[
+        {"datetime": str(datetime(2022, 1, 3) + timedelta(minutes=page_ * 100 + i)), "open": 100, "close": 100,
+         "high": 101, "low": 99, "volume": 1000} for i in range(100)] for page_ in range(200)]
+    symbols_ = [f"BENCHAPPEND{writer_}" for writer_ in range(4)]
+    try:
+        for mode_ in ("client", "database", "database, 4 writers"):
+            with psycopg2.connect(**_connection_dict) as conn_:
+                for symbol_ in symbols_:
+                    conn_.cursor().execute(_drop_time_table.format(
+                        time_interval="1min", symbol=symbol_, market_identification_code="XBEN"))
+                    conn_.cursor().execute(_create_time_table.format(
+                        time_interval="1min", symbol=symbol_, market_identification_code="XBEN",
+                        lower_symbol=symbol_.lower(), price_type=NUMERIC_PRICE_TYPE_))
+            start_ = perf_counter()
+            if mode_ == "client":
+                for page_ in pages_:
+                    next_ = 0 if page_ is pages_[0] else \
+                        fetch_generic_last_ID_("1min_time_series", "BENCHAPPEND0_XBEN") + 1
+                    insert_historical_data_(page_, "BENCHAPPEND0", "1min", rownum_start=next_, is_equity=True,
+                                            mic_code="XBEN")
+            elif mode_ == "database":
+                for page_ in pages_:
+                    insert_historical_data_(page_, "BENCHAPPEND0", "1min", is_equity=True, mic_code="XBEN")
+            else:
+                with ThreadPoolExecutor(max_workers=4) as executor_:
+                    list(executor_.map(lambda writer_: [
+                        insert_historical_data_(page_, symbols_[writer_], "1min", is_equity=True, mic_code="XBEN")
+                        for page_ in pages_[writer_::4]], range(4)))
+            print(f"appends, IDs by the {mode_}: {(perf_counter() - start_) / len(pages_) * 1e3:.2f}ms per page")
+    finally:
+        with psycopg2.connect(**_connection_dict) as conn_:
+            for symbol_ in symbols_:
+                conn_.cursor().execute(_drop_time_table.format(
+                    time_interval="1min", symbol=symbol_, market_identification_code="XBEN"))
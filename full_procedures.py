@@ -1,7 +1,13 @@
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from time import sleep
 from typing import Generator
 from warnings import warn
 
+import psycopg2
+
+import analysis_functions
 import api_functions
 import db_functions
 
@@ -11,29 +17,57 @@ def exotic_markets_warning():
          "I.e. I do not know how the function will perform for symbols from exotic markets (like Indonesia)")
 
 
+def shared_key_switcher(permitted_keys: list[str] | None = None) -> Generator:
+    """
+    key switcher that rations credits through the ledger stored in the database
+
+    use it instead of a plain ``api_key_switcher`` whenever more than one process (or machine) downloads
+    with the same keys - reservations are atomic, so together they will never exceed the per-key limits
+    """
+    return api_functions.api_key_switcher(permitted_keys, credit_reserver=db_functions.api_credit_reserver())
+
+
+def apply_downloaded_pages(verbose: bool = False) -> dict[tuple[str, str], int]:
+    """
+    insert the downloads kept by the local ingest log into the database
+
+    when the database is down, the pages stay in the log (credits spent on them are not lost)
+    and the next drain inserts them
+    """
+    try:
+        return db_functions.drain_ingest_log(verbose)
+    except psycopg2.OperationalError as e:
+        warn(f"database is not available, downloaded pages are kept in the ingest log: {e}")
+        return {}
+
+
 def time_series_save(
         symbol: str, market_identification_code: str | None,
-        time_interval: str, key_switcher: Generator, verbose=False):
+        time_interval: str, key_switcher: Generator, verbose=False, backfill: bool = False):
     """
     automates entire process of downloading the data and then saving it directly into database from source
+
+    :param backfill: load entire history into a staging table, swapped for the series once it is complete
+        (see ``db_functions.backfill_time_series``) - much faster for big 1min series, and stored rows
+        (if there are any) get replaced instead of refusing the save
     """
     exotic_markets_warning()
     is_equity = db_functions.is_equity(symbol)
     if db_functions.time_series_table_exists(
             symbol, time_interval=time_interval, mic_code=market_identification_code, is_equity=is_equity):
-        if db_functions.time_series_latest_timestamp(
+        if not backfill and db_functions.time_series_latest_timestamp(
                 symbol, is_equity=is_equity, time_interval=time_interval, mic_code=market_identification_code):
             raise db_functions.TimeSeriesExistsError(
                 "this time series already has data, use another method to update it")
 
-        data = api_functions.download_market_ticker_history(
-            symbol=symbol, mic_code=market_identification_code, verbose=verbose,
-            time_interval=time_interval, key_switcher=key_switcher,
-        )
-        db_functions.insert_historical_data(
-            data, symbol=symbol, mic_code=market_identification_code, time_interval=time_interval,
-            is_equity=is_equity
-        )
+        # pages are logged as they come, the drain inserts them together with the rollups
+        with db_functions.logged_download(
+                symbol, time_interval, is_equity, market_identification_code, backfill=backfill) as log_page:
+            api_functions.download_market_ticker_history(
+                symbol=symbol, mic_code=market_identification_code, verbose=verbose,
+                time_interval=time_interval, key_switcher=key_switcher, page_callback=log_page,
+            )
+        apply_downloaded_pages(verbose)
 
     else:
         if verbose:
@@ -42,7 +76,7 @@ def time_series_save(
             symbol, time_interval=time_interval, mic_code=market_identification_code, is_equity=is_equity
         )
         time_series_save(
-            symbol, market_identification_code, time_interval, key_switcher, verbose
+            symbol, market_identification_code, time_interval, key_switcher, verbose, backfill
         )
 
 
@@ -62,28 +96,181 @@ def time_series_update(
             if latest_database_timestamp > end_date:
                 raise db_functions.TimeSeriesExistsError("this time series already covers this timestamp history")
 
-        data = api_functions.download_market_ticker_history(
-            symbol=symbol, key_switcher=key_switcher, mic_code=market_identification_code,
-            start_date=latest_database_timestamp, end_date=end_date, verbose=verbose, time_interval=time_interval
-        )
-        if is_equity:
-            schema_name = f"{time_interval}_time_series"
-            table_name = f"{symbol}_{market_identification_code}"
-        else:
-            schema_name = "forex_time_series"
-            symbol_ = "_".join(symbol.split("/")).upper()
-            table_name = f"{symbol_}_{time_interval}"
-        last_datapoint_id = db_functions.fetch_generic_last_ID(schema_name, table_name)
-        db_functions.insert_historical_data(
-            data, symbol=symbol, mic_code=market_identification_code, time_interval=time_interval,
-            is_equity=is_equity, rownum_start=last_datapoint_id+1
-        )
+        # rows newer than the latest stored one are appended by the drain, only the buckets they reach
+        # are recalculated in the rollups
+        with db_functions.logged_download(symbol, time_interval, is_equity, market_identification_code) as log_page:
+            api_functions.download_market_ticker_history(
+                symbol=symbol, key_switcher=key_switcher, mic_code=market_identification_code,
+                start_date=latest_database_timestamp, end_date=end_date, verbose=verbose,
+                time_interval=time_interval, page_callback=log_page,
+            )
+        apply_downloaded_pages(verbose)
         return
 
     raise db_functions.TimeSeriesNotFoundError(
         "this time series does not exist, use another function to create and populate it")
 
 
+def time_series_download_window(
+        symbol: str, market_identification_code: str | None, time_interval: str, key_switcher: Generator,
+        start_date: datetime | None = None, end_date: datetime | None = None, verbose: bool = False):
+    """
+    download a single queue work item - date window of a time series - and append it to the database
+
+    empty (or missing) series are saved from "start_date" (or from the earliest timestamp), series that already
+    have data are updated from their latest point up to "end_date", so the rows are always appended in order
+    """
+    is_equity = db_functions.is_equity(symbol)
+    table_exists = db_functions.time_series_table_exists(
+        symbol, time_interval=time_interval, mic_code=market_identification_code, is_equity=is_equity)
+    if table_exists and db_functions.time_series_latest_timestamp(
+            symbol, time_interval, is_equity, market_identification_code):
+        try:
+            time_series_update(
+                symbol, market_identification_code, time_interval, key_switcher, verbose=verbose, end_date=end_date)
+        except db_functions.TimeSeriesExistsError:
+            if verbose:
+                print(f"{symbol} {market_identification_code} {time_interval} already covers {end_date}")
+        return
+    if start_date is None and end_date is None:
+        time_series_save(symbol, market_identification_code, time_interval, key_switcher, verbose)
+        return
+
+    if not table_exists:
+        db_functions.create_time_series(
+            symbol, time_interval=time_interval, mic_code=market_identification_code, is_equity=is_equity)
+    with db_functions.logged_download(symbol, time_interval, is_equity, market_identification_code) as log_page:
+        api_functions.download_market_ticker_history(
+            symbol=symbol, key_switcher=key_switcher, mic_code=market_identification_code,
+            start_date=start_date, end_date=end_date, verbose=verbose, time_interval=time_interval,
+            page_callback=log_page,
+        )
+    apply_downloaded_pages(verbose)
+
+
+@contextmanager
+def _download_job_lease_kept(job_id: int, worker_name: str, lease: timedelta, verbose: bool = False):
+    """renew the lease of a claimed job every third of its length, for as long as the job runs"""
+    finished = threading.Event()
+
+    def renew():
+        while not finished.wait(lease.total_seconds() / 3):
+            try:
+                if not db_functions.extend_download_job_lease(job_id, worker_name, lease):
+                    if verbose:
+                        print(f"{worker_name}: lease of job {job_id} is lost")
+                    return
+            except psycopg2.OperationalError as e:  # database unreachable for a moment - next renewal may succeed
+                if verbose:
+                    print(f"{worker_name}: lease of job {job_id} not renewed: {e!r}")
+
+    heartbeat = threading.Thread(target=renew, name=f"{worker_name}-lease-{job_id}", daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        finished.set()
+        heartbeat.join()
+
+
+def download_worker(
+        worker_name: str, key_switcher: Generator, lease: timedelta = timedelta(minutes=30),
+        stop_when_empty: bool = True, poll_interval: float = 5., verbose: bool = False) -> int:
+    """
+    process jobs from the download queue, until it is empty (or forever, when "stop_when_empty" is False)
+
+    any number of workers can run at the same time, on many machines pointed at the same database.
+    Worker name tags the ownership of claimed jobs, the same way "time_tracking_info" assigns series to workers.
+    Failed jobs go back to the queue until they run out of attempts. Lease of the running job is renewed
+    in the background, so only a worker that stopped working loses its job.
+
+    :return: number of jobs completed by this worker
+    """
+    # downloads a crashed worker left in the log are inserted before anything new is downloaded
+    apply_downloaded_pages(verbose)
+    completed = 0
+    while True:
+        job = db_functions.claim_download_job(worker_name, lease)
+        if job is None:
+            if stop_when_empty:
+                return completed
+            sleep(poll_interval)
+            continue
+        job_id, symbol, mic_code, time_interval, start_date, end_date, attempts = job
+        if verbose:
+            print(f"{worker_name}: job {job_id} ({symbol} {mic_code} {time_interval}), attempt {attempts}")
+        try:
+            with _download_job_lease_kept(job_id, worker_name, lease, verbose):
+                time_series_download_window(
+                    symbol, mic_code, time_interval, key_switcher, start_date, end_date, verbose=verbose)
+        except Exception as e:  # noqa - any failure gives the job back to the queue
+            status = db_functions.fail_download_job(job_id, worker_name, repr(e))
+            if verbose:
+                print(f"{worker_name}: job {job_id} failed ({status}): {e!r}")
+            continue
+        if db_functions.complete_download_job(job_id, worker_name):
+            completed += 1
+
+
+def resample_time_series(
+        symbol: str, target_interval: str, market_identification_code: str | None = None,
+        start_date: datetime | None = None, end_date: datetime | None = None) -> dict:
+    """
+    derive candles of a higher timeframe ("5min", "15min", "1h", "4h", "1day") from the stored 1 minute series
+
+    saves API credits - any number of timeframes can be obtained out of a single 1 minute download.
+    Equity candles are anchored to trading sessions, forex ones to the clock (see ``analysis_functions``)
+    """
+    is_equity = db_functions.is_equity(symbol)
+    minutes = db_functions.fetch_time_series_arrays(
+        symbol, "1min", is_equity=is_equity, mic_code=market_identification_code,
+        start_date=start_date, end_date=end_date)
+    minutes.pop("ID")
+    return analysis_functions.resample_ohlcv(minutes, target_interval, is_forex=not is_equity)
+
+
+def time_series_indicator(
+        symbol: str, time_interval: str, indicator: str, market_identification_code: str | None = None,
+        start_date: datetime | None = None, end_date: datetime | None = None, **params):
+    """
+    calculate technical indicator ("sma", "ema", "rsi", "atr", "bollinger_bands", "macd", "vwap") over stored series
+
+    replaces the "/rsi", "/atr"... endpoints of the API, which would cost a credit per indicator and symbol.
+    Results are aligned with the rows of the series between the dates, params are passed to the indicator function
+    """
+    data = db_functions.fetch_time_series_arrays(
+        symbol, time_interval, mic_code=market_identification_code, start_date=start_date, end_date=end_date)
+    return analysis_functions.calculate_indicator(data, indicator, **params)
+
+
+def track_indicator(
+        symbol: str, time_interval: str, state_name: str, indicator_state,
+        market_identification_code: str | None = None):
+    """
+    start keeping an indicator state (``analysis_functions.EMAState``, ``RSIState``...) for the series
+
+    the state folds entire stored history once, afterwards it is advanced only by the rows appended
+    with ``insert_historical_data`` - current indicator value is then a single read from the state table
+    """
+    schema_name, table_name, _ = db_functions.resolve_time_series_location(
+        symbol, time_interval, mic_code=market_identification_code)
+    data = db_functions.fetch_time_series_arrays(symbol, time_interval, mic_code=market_identification_code)
+    columns = [column for column in data if column != "ID"]
+    for row in zip(*(data[column] for column in columns)):
+        indicator_state.update(dict(zip(columns, row)))
+    last_ID = int(data["ID"][-1]) if len(data["ID"]) else -1
+    db_functions.save_indicator_state(schema_name, table_name, state_name, indicator_state, last_ID)
+
+
+def current_indicator_values(
+        symbol: str, time_interval: str, market_identification_code: str | None = None) -> dict[str, float]:
+    """latest values of every indicator tracked for the series, by the state name"""
+    schema_name, table_name, _ = db_functions.resolve_time_series_location(
+        symbol, time_interval, mic_code=market_identification_code)
+    states = db_functions.fetch_indicator_states(schema_name, table_name)
+    return {state_name: state.value for state_name, (_, state) in states.items()}
+
+
 def perpare_database():
     """Set up the entire structure of database in correct order"""
     db_functions.import_db_structure()
@@ -129,7 +316,7 @@ def fill_database(key_switcher: Generator):
 
     db_functions.insert_forex_currency_groups(currency_groups)
     db_functions.insert_currencies(currencies)
-    db_functions.insert_forex_pairs_available(forex_data)
+    db_functions.insert_forex_pairs_available(forex_data, refresh_views=False)
 
     # process stock markets data
     plans = set()
@@ -148,7 +335,7 @@ def fill_database(key_switcher: Generator):
     db_functions.insert_timezones(timezones)
     db_functions.insert_countries(countries)
     db_functions.insert_plans(plans)
-    db_functions.insert_markets(stock_markets_data)
+    db_functions.insert_markets(stock_markets_data, refresh_views=False)
 
     equity_types = set()
 
@@ -156,16 +343,36 @@ def fill_database(key_switcher: Generator):
         equity_types.update((str(e['type']),))
 
     db_functions.insert_investment_types(equity_types)
-    db_functions.insert_stocks(stocks_data)
+    db_functions.insert_stocks(stocks_data, refresh_views=False)
+
+    # explained references are materialized - refreshed once, with everything in place
+    db_functions.refresh_reference_views()
+
+
+def sync_reference_data(key_switcher: Generator) -> dict[str, dict]:
+    """
+    bring filled database up to date with instruments listed by the API - new ones are added, changed ones updated
+    and the ones no longer listed are marked delisted. IDs of the instruments stay, together with their time series
+
+    :return: kind ("forex_pairs", "markets", "stocks") -> numbers of inserted, updated, delisted... rows
+    """
+    forex_data: list[dict] = api_functions.get_all_currency_pairs(next(key_switcher), 'json')
+    stock_markets_data: list[dict] = api_functions.get_all_exchanges(next(key_switcher), 'json')
+    stocks_data: list[dict] = api_functions.get_all_equities(next(key_switcher), 'json')
+    return db_functions.sync_reference_data(forex_data, stock_markets_data, stocks_data)
 
 
-def rebuild_database_destructively():
+def rebuild_database_destructively(backup_directory: str | None = None):
     """
     prepare database as though it was a clean slate
 
     THIS PURGES ENTIRE DATABASE!!! if you have something worth keeping there, better do a db backup first before
     invoking this function
+    :param backup_directory: export the series into an archive there first - once reference data is filled again,
+        ``db_functions.restore_archive`` brings them back
     """
+    if backup_directory is not None:
+        db_functions.export_archive(backup_directory)
     db_functions.purge_db_structure()
     db_functions.import_db_structure()
 
@@ -15,3 +15,14 @@ RAPIDAPI_HOST = "twelve-data1.p.rapidapi.com"
 DB_PASSWORD = "YOUR_DB_PASSWORD"
 DB_USER = "YOUR_DB_USER"
 DB_NAME = "YOUR_DB_NAME"
+
+# optional - databases the time series are spread over (by a hash of the series), as DSNs or keywords
+# of psycopg2.connect. Reference data stays in DB_NAME, which may be one of the shards as well
+# DB_SHARDS = [
+#     {"database": "YOUR_DB_NAME", "user": "YOUR_DB_USER", "password": "YOUR_DB_PASSWORD"},
+#     "host=10.0.0.2 dbname=market_data user=YOUR_DB_USER password=YOUR_DB_PASSWORD",
+# ]
+
+# optional - directory of the local log keeping downloaded pages until they are in the database (one per process),
+# "ingest_log" next to the project by default
+# INGEST_LOG_DIR = "/var/lib/market_trend_visualiser/ingest_log"
@@ -0,0 +1,217 @@
+import json
+import unittest
+from datetime import datetime, timedelta
+from random import randint
+
+import numpy as np
+
+import analysis_functions
+
+
+def generate_minute_sessions(days: int, session_minutes: int = 390, first_day: datetime | None = None) -> dict:
+    """
+    prepare a couple of "trading sessions" of random 1 minute candles, that open at 13:30 UTC
+
+    some minutes are dropped in the middle of the sessions, to resemble the gaps in real data
+    """
+    if first_day is None:
+        first_day = datetime(year=randint(2010, 2022), month=randint(1, 12), day=randint(1, 28))
+    timestamps = []
+    for day in range(days):
+        session_open = first_day + timedelta(days=day, hours=13, minutes=30)
+        timestamps.extend(session_open + timedelta(minutes=m) for m in range(session_minutes) if m % 37 != 5)
+    closes = 100 + np.cumsum(np.random.normal(0, 0.1, len(timestamps)))
+    opens = np.concatenate(([100.], closes[:-1]))
+    spreads = np.abs(np.random.normal(0, 0.05, (2, len(timestamps))))
+    return {
+        "datetime": np.array(timestamps, dtype='datetime64[m]'),
+        "open": opens,
+        "high": np.maximum(opens, closes) + spreads[0],
+        "low": np.minimum(opens, closes) - spreads[1],
+        "close": closes,
+        "volume": np.random.randint(100, 10000, len(timestamps)),
+    }
+
+
+def naive_resample(data: dict, bucket_of: callable) -> list[tuple]:
+    """reference implementation - plain python loop over minutes, grouping them with given bucket function"""
+    bars = []
+    for i, minute in enumerate(data["datetime"].astype(datetime)):
+        bucket = bucket_of(minute)
+        o, h, l, c, v = (data[f][i] for f in ("open", "high", "low", "close", "volume"))
+        if bars and bars[-1][0] == bucket:
+            _, bo, bh, bl, _, bv = bars[-1]
+            bars[-1] = (bucket, bo, max(bh, h), min(bl, l), c, bv + v)
+        else:
+            bars.append((bucket, o, h, l, c, v))
+    return bars
+
+
+class ResamplingTests(unittest.TestCase):
+
+    def assertBarsEqual(self, expected: list[tuple], bars: dict):
+        self.assertEqual(len(expected), len(bars["datetime"]))
+        self.assertEqual([b[0] for b in expected], list(bars["datetime"].astype(datetime)))
+        for index, field in enumerate(("open", "high", "low", "close", "volume"), start=1):
+            np.testing.assert_allclose([b[index] for b in expected], bars[field], err_msg=field)
+
+    def test_resample_equity_sessions(self):
+        """buckets of equities are anchored to the session open and never cross sessions"""
+        data = generate_minute_sessions(days=4)
+        for interval, width in [("5min", 5), ("15min", 15), ("1h", 60), ("4h", 240)]:
+            def bucket_of(minute: datetime, width_=width):
+                session_open = minute.replace(hour=13, minute=30)
+                return session_open + timedelta(minutes=(minute - session_open).seconds // 60 // width_ * width_)
+            bars = analysis_functions.resample_ohlcv(data, interval)
+            self.assertBarsEqual(naive_resample(data, bucket_of), bars)
+        self.assertEqual(datetime(2000, 1, 3, 13, 30), analysis_functions.resample_ohlcv(
+            generate_minute_sessions(1, first_day=datetime(2000, 1, 3)), "1h")["datetime"][0].astype(datetime))
+
+        daily = analysis_functions.resample_ohlcv(data, "1day")
+        self.assertBarsEqual(naive_resample(data, lambda m: m.replace(hour=0, minute=0)), daily)
+        with self.assertRaises(ValueError):
+            analysis_functions.resample_ohlcv(data, "1min")
+
+    def test_resample_forex(self):
+        """forex is traded around the clock - buckets are aligned to the clock and to UTC midnight"""
+        data = generate_minute_sessions(days=1, session_minutes=3000)  # runs through 3 calendar days
+        bars = analysis_functions.resample_ohlcv(data, "4h", is_forex=True)
+        self.assertBarsEqual(naive_resample(data, lambda m: m.replace(hour=m.hour // 4 * 4, minute=0)), bars)
+        bars = analysis_functions.resample_ohlcv(data, "1day", is_forex=True)
+        self.assertBarsEqual(naive_resample(data, lambda m: m.replace(hour=0, minute=0)), bars)
+
+    def test_incremental_resampling(self):
+        """folding the data chunk after chunk has to give exactly the same candles as a single pass"""
+        for is_forex in (False, True):
+            data = generate_minute_sessions(days=3)
+            for interval in analysis_functions.RESAMPLE_INTERVALS:
+                expected = analysis_functions.resample_ohlcv(data, interval, is_forex=is_forex)
+                resampler = analysis_functions.Resampler(interval, is_forex=is_forex)
+                cuts = sorted({0, len(data["datetime"]), *(randint(1, len(data["datetime"]) - 1) for _ in range(30))})
+                parts = []
+                for start, end in zip(cuts[:-1], cuts[1:]):
+                    # state survives the trip through plain python values
+                    resampler = analysis_functions.Resampler.from_state(resampler.get_state())
+                    parts.append(resampler.update({k: v[start:end] for k, v in data.items()}))
+                parts.append(resampler.flush())
+                for field in expected:
+                    np.testing.assert_array_equal(
+                        expected[field], np.concatenate([p[field] for p in parts]), err_msg=f"{interval} {field}")
+
+                with self.assertRaises(ValueError):  # minutes that have already been folded
+                    resampler.update({k: v[:5] for k, v in data.items()})
+
+
+def naive_ema(values, alpha: float, period: int) -> list[float]:
+    """element after element recursion, seeded with the average of first "period" values"""
+    result = [float('nan')] * (period - 1) + [sum(values[:period]) / period]
+    for value in values[period:]:
+        result.append(alpha * value + (1 - alpha) * result[-1])
+    return result
+
+
+class IndicatorTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        data = generate_minute_sessions(days=3)
+        self.close, self.high, self.low = data["close"], data["high"], data["low"]
+        self.volume, self.datetime = data["volume"], data["datetime"]
+
+    def test_moving_averages(self):
+        for period in (1, 5, 20, 200):
+            naive_sma = [float('nan')] * (period - 1) + [
+                sum(self.close[i - period + 1:i + 1]) / period for i in range(period - 1, len(self.close))]
+            np.testing.assert_allclose(analysis_functions.sma(self.close, period), naive_sma, rtol=1e-10)
+            np.testing.assert_allclose(
+                analysis_functions.ema(self.close, period), naive_ema(self.close, 2 / (period + 1), period),
+                rtol=1e-10)
+            np.testing.assert_allclose(
+                analysis_functions.wilder_smoothing(self.close, period), naive_ema(self.close, 1 / period, period),
+                rtol=1e-10)
+        # too short data gives only NaN
+        self.assertTrue(np.isnan(analysis_functions.ema(self.close[:10], 20)).all())
+        # long, slowly decaying averages are calculated in many blocks - results still have to match
+        long_close = np.tile(self.close, 10)
+        np.testing.assert_allclose(
+            analysis_functions.ema(long_close, 3), naive_ema(long_close, 2 / 4, 3), rtol=1e-10)
+
+    def test_rsi_atr(self):
+        period = 14
+        changes = np.diff(self.close)
+        gains = naive_ema(np.maximum(changes, 0), 1 / period, period)
+        losses = naive_ema(np.maximum(-changes, 0), 1 / period, period)
+        naive_rsi = [float('nan')] + [100 - 100 / (1 + g / l) for g, l in zip(gains, losses)]
+        np.testing.assert_allclose(analysis_functions.rsi(self.close, period), naive_rsi, rtol=1e-10)
+        self.assertEqual(analysis_functions.rsi(np.arange(30.), period)[-1], 100.)
+        self.assertEqual(analysis_functions.rsi(np.ones(30), period)[-1], 50.)
+
+        true_range = [self.high[0] - self.low[0]] + [
+            max(h - l, abs(h - c), abs(l - c)) for h, l, c in zip(self.high[1:], self.low[1:], self.close[:-1])]
+        np.testing.assert_allclose(analysis_functions.true_range(self.high, self.low, self.close), true_range)
+        np.testing.assert_allclose(
+            analysis_functions.atr(self.high, self.low, self.close, period),
+            naive_ema(true_range, 1 / period, period), rtol=1e-10)
+
+    def test_bands_macd_vwap(self):
+        middle, upper, lower = analysis_functions.bollinger_bands(self.close, 20, 2.)
+        for i in range(19, len(self.close)):
+            window = self.close[i - 19:i + 1]
+            self.assertAlmostEqual(middle[i], window.mean(), places=8)
+            self.assertAlmostEqual(upper[i] - middle[i], 2 * window.std(), places=6)
+            self.assertAlmostEqual(middle[i] - lower[i], 2 * window.std(), places=6)
+
+        macd, signal, histogram = analysis_functions.macd(self.close)
+        naive_macd = np.array(naive_ema(self.close, 2 / 13, 12)) - np.array(naive_ema(self.close, 2 / 27, 26))
+        np.testing.assert_allclose(macd, naive_macd, atol=1e-10)
+        np.testing.assert_allclose(signal[25:], naive_ema(naive_macd[25:], 2 / 10, 9), atol=1e-10)
+        np.testing.assert_allclose(histogram, macd - signal)
+
+        vwap = analysis_functions.vwap(self.high, self.low, self.close, self.volume, self.datetime)
+        traded, volume, day = 0., 0, None
+        for i, minute in enumerate(self.datetime.astype(datetime)):
+            if minute.date() != day:
+                traded, volume, day = 0., 0, minute.date()
+            traded += (self.high[i] + self.low[i] + self.close[i]) / 3 * self.volume[i]
+            volume += self.volume[i]
+            self.assertAlmostEqual(vwap[i], traded / volume, places=8)
+
+        with self.assertRaises(ValueError):
+            analysis_functions.calculate_indicator({"close": self.close}, "atr")
+        np.testing.assert_array_equal(
+            analysis_functions.calculate_indicator({"close": self.close}, "sma", period=5),
+            analysis_functions.sma(self.close, 5))
+
+
+class StreamingIndicatorTests(unittest.TestCase):
+
+    def test_states_follow_vectorized_indicators(self):
+        """bar after bar, with state serialized to JSON in between, states give the same values as full recalculation"""
+        data = generate_minute_sessions(days=2)
+        bars = [dict(zip(data, values)) for values in zip(*data.values())]
+        cases = [
+            (analysis_functions.EMAState(20), analysis_functions.ema(data["close"], 20)),
+            (analysis_functions.WilderState(14, field="high"), analysis_functions.wilder_smoothing(data["high"], 14)),
+            (analysis_functions.RSIState(14), analysis_functions.rsi(data["close"], 14)),
+            (analysis_functions.ATRState(14), analysis_functions.atr(data["high"], data["low"], data["close"], 14)),
+            (analysis_functions.RollingWindowState(5), analysis_functions.sma(data["close"], 5)),
+        ]
+        for state, expected in cases:
+            values = []
+            for i, bar in enumerate(bars):
+                if i % 50 == 0:
+                    state = analysis_functions.indicator_state_from_dict(json.loads(json.dumps(state.get_state())))
+                values.append(state.update(bar))
+            np.testing.assert_allclose(values, expected, rtol=1e-9, err_msg=state.indicator)
+
+        window = analysis_functions.RollingWindowState(20)
+        middle, upper, lower = analysis_functions.bollinger_bands(data["close"], 20)
+        for i, bar in enumerate(bars):
+            window.update(bar)
+            if i >= 19:
+                np.testing.assert_allclose(window.bollinger_bands(), (middle[i], upper[i], lower[i]), rtol=1e-9)
+        with self.assertRaises(ValueError):
+            analysis_functions.indicator_state_from_dict({"indicator": "unknown", "params": {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,18 @@
+import gzip
+import json
+import os
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from random import choices, randint, random
+from unittest.mock import patch
 
+import numpy as np
 import psycopg2
 
+import analysis_functions
 import db_functions.db_helpers as helpers
 from db_functions.time_series_db import _drop_time_table, _drop_forex_table
 import db_functions
@@ -443,6 +452,1060 @@ class DBTests(unittest.TestCase):
             self.assertEqual(schema_name, schema_name_prediction, msg=f"{schema_name}")
             self.assertEqual(table_name, table_name_prediction, msg=f"{table_name}")
 
+    def test_reserve_api_credits(self):
+        """check if credits are rationed per key and window, also when reservations come from many threads"""
+        minute_limit, daily_limit = 8, 20
+        for _ in range(minute_limit):
+            self.assertTrue(db_functions.reserve_api_credits(
+                "regular0", minute_limit=minute_limit, daily_limit=daily_limit))
+        self.assertFalse(db_functions.reserve_api_credits(
+            "regular0", minute_limit=minute_limit, daily_limit=daily_limit))
+        # request bigger than any of the windows can never be reserved
+        self.assertFalse(db_functions.reserve_api_credits(
+            "regular1", credits=minute_limit + 1, minute_limit=minute_limit, daily_limit=daily_limit))
+
+        # other key is independent of the exhausted one, and failed reservation did not leave any trace
+        usage = db_functions.fetch_api_credit_usage()
+        self.assertEqual({(r[0], r[1]): r[3] for r in usage}, {
+            ("regular0", "day"): minute_limit, ("regular0", "minute"): minute_limit,
+        })
+
+        # ledger shared between many workers hands out exactly as many credits as the window allows
+        reserver = db_functions.api_credit_reserver(minute_limit=minute_limit, daily_limit=daily_limit)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(
+                lambda _: db_functions.reserve_api_credits(
+                    "rapid0", minute_limit=minute_limit, daily_limit=daily_limit), range(20)))
+        self.assertEqual(results.count(True), minute_limit)
+        self.assertFalse(reserver("rapid0", 1))
+        self.assertTrue(reserver("rapid1", 1))
+
+        db_functions.purge_api_credit_ledger(older_than=-timedelta(minutes=1), key_name="rapid0")
+        self.assertNotIn("rapid0", [r[0] for r in db_functions.fetch_api_credit_usage()])
+
+    def test_download_job_queue(self):
+        """claiming, retrying and completing jobs from the distributed download queue"""
+        self.save_samples_for_tests()
+        first = db_functions.enqueue_download_job(
+            "AAPL", "1min", "XNGS", start_date=datetime(2022, 3, 1), end_date=datetime(2022, 3, 31))
+        second = db_functions.enqueue_download_job(
+            "AAPL", "1min", "XNGS", start_date=datetime(2022, 4, 1), end_date=datetime(2022, 4, 30))
+        third = db_functions.enqueue_download_job("USD/EUR", "1day", max_attempts=1)
+        with self.assertRaises(ValueError):
+            db_functions.enqueue_download_job("AAPL", "1h", "XNGS")
+
+        # concurrent workers never get the same job, and later window of a series waits for the earlier one
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            claimed = list(executor.map(
+                lambda worker: db_functions.claim_download_job(worker), ["w0", "w1", "w2"]))
+        claimed_ids = sorted(job[0] for job in claimed if job is not None)
+        self.assertEqual(claimed_ids, [first, third])
+        owners = {job[0]: worker for job, worker in zip(claimed, ["w0", "w1", "w2"]) if job is not None}
+
+        # only the owner can finish the job
+        self.assertFalse(db_functions.complete_download_job(first, "someone_else"))
+        self.assertTrue(db_functions.complete_download_job(first, owners[first]))
+        self.assertEqual(db_functions.fail_download_job(third, owners[third], "error 'quoted'"), "failed")
+
+        job = db_functions.claim_download_job("w3", lease=timedelta(seconds=0))
+        self.assertEqual(job[0], second)
+        # expired lease lets another worker take the job over, previous owner can't complete it anymore
+        job = db_functions.claim_download_job("w4")
+        self.assertEqual((job[0], job[-1]), (second, 2))
+        self.assertFalse(db_functions.extend_download_job_lease(second, "w3"))
+        self.assertEqual(db_functions.fail_download_job(second, "w4", "retry me"), "pending")
+        self.assertTrue(db_functions.extend_download_job_lease(
+            db_functions.claim_download_job("w4")[0], "w4"))
+        self.assertIsNone(db_functions.claim_download_job("w5"))
+
+        statuses = {job[0]: (job[6], job[9]) for job in db_functions.fetch_download_jobs()}
+        self.assertEqual(statuses, {first: ("done", owners[first]), second: ("running", "w4"),
+                                    third: ("failed", owners[third])})
+        self.assertEqual(len(db_functions.fetch_download_jobs("failed")), 1)
+
+        # series marked as tracked are enqueued only once, as long as their jobs are not finished
+        with psycopg2.connect(**helpers._connection_dict) as conn:
+            cur = conn.cursor()
+            cur.execute("""INSERT INTO "public".time_tracking_info VALUES (0, true, true, 1, 'w0'),
+                (1, false, true, 4, 'w1');""")
+        self.assertEqual(len(db_functions.enqueue_tracked_download_jobs()), 2)  # AAPL 1min is still running
+        self.assertEqual(db_functions.enqueue_tracked_download_jobs(), [])
+        self.assertEqual(
+            {job[1:4] for job in db_functions.fetch_download_jobs("pending")},
+            {("AAPL", "XNGS", "1day"), ("NVDA", "XNGS", "1day")})
+
+    def test_time_series_rollups(self):
+        """rollups of every series hold correct candles and follow the appended rows"""
+        self.save_samples_for_tests()
+        bucket_of = {
+            "hour": lambda d: d.replace(minute=0, second=0),
+            "day": lambda d: d.replace(hour=0, minute=0, second=0),
+            "week": lambda d: (d - timedelta(days=d.weekday())).replace(hour=0, minute=0, second=0),
+            "month": lambda d: d.replace(day=1, hour=0, minute=0, second=0),
+        }
+
+        def expected_rollup(rows: list[dict], bucket: str, is_equity: bool) -> list[tuple]:
+            buckets = {}
+            for row in rows:
+                buckets.setdefault(bucket_of[bucket](row["datetime_object"]), []).append(row)
+            return [(
+                start, candles[0]["open"], candles[-1]["close"], max(c["high"] for c in candles),
+                min(c["low"] for c in candles), sum(c["volume"] for c in candles) if is_equity else None,
+                len(candles)) for start, candles in sorted(buckets.items())]
+
+        for symbol, time_interval, mic, is_equity in self.time_series_table_cases:
+            with self.assertRaises(db_functions.TimeSeriesNotFoundError):
+                db_functions.create_time_series_rollups(symbol, time_interval, mic_code=mic)
+            db_functions.create_time_series(symbol, time_interval, mic_code=mic)
+            dummy_data = t_helpers.generate_random_time_sample(time_interval, is_equity, span=randint(150, 250))
+            first_part, second_part = dummy_data[:len(dummy_data) // 2], dummy_data[len(dummy_data) // 2:]
+            db_functions.insert_historical_data(first_part, symbol, time_interval, is_equity=is_equity, mic_code=mic)
+            db_functions.create_time_series_rollups(symbol, time_interval, mic_code=mic)
+
+            db_functions.insert_historical_data(
+                second_part, symbol, time_interval, is_equity=is_equity, mic_code=mic, rownum_start=len(first_part))
+            refreshed = db_functions.refresh_time_series_rollups(
+                symbol, time_interval, since=second_part[0]["datetime_object"], mic_code=mic)
+            # only the buckets touched by the second part got recalculated
+            self.assertEqual(refreshed, sum(len(expected_rollup(second_part, bucket, is_equity))
+                                            for bucket in db_functions.ROLLUP_BUCKETS[time_interval]))
+            for bucket in db_functions.ROLLUP_BUCKETS[time_interval]:
+                expected = expected_rollup(dummy_data, bucket, is_equity)
+                self.assertEqual(
+                    expected, db_functions.fetch_time_series_rollup(symbol, time_interval, bucket, mic_code=mic))
+                self.assertEqual(expected[-1:], db_functions.fetch_time_series_rollup(
+                    symbol, time_interval, bucket, mic_code=mic, start_date=expected[-1][0]))
+            with self.assertRaises(ValueError):
+                db_functions.fetch_time_series_rollup(symbol, time_interval, "year", mic_code=mic)
+
+    def test_indicator_states(self):
+        """states kept in the database follow the rows appended to the series"""
+        self.save_samples_for_tests()
+        for symbol, time_interval, mic, is_equity in self.time_series_table_cases:
+            schema_name, table_name, _ = t_helpers.form_test_essentials(symbol, time_interval, mic, is_equity)
+            db_functions.create_time_series(symbol, time_interval, mic_code=mic)
+            dummy_data = t_helpers.generate_random_time_sample(time_interval, is_equity, span=60)
+            first, second, third = dummy_data[:20], dummy_data[20:40], dummy_data[40:]
+            db_functions.insert_historical_data(first, symbol, time_interval, is_equity=is_equity, mic_code=mic)
+
+            ema, rsi = analysis_functions.EMAState(10), analysis_functions.RSIState(5)
+            for candle in first:
+                ema.update(candle)
+            db_functions.save_indicator_state(schema_name, table_name, "ema_10", ema, len(first) - 1)
+            # state that has not seen any row yet - it has to catch up with the stored ones first
+            db_functions.save_indicator_state(schema_name, table_name, "rsi_5", rsi, -1)
+
+            db_functions.insert_historical_data(
+                second, symbol, time_interval, is_equity=is_equity, mic_code=mic, rownum_start=len(first))
+            db_functions.insert_historical_data(
+                third, symbol, time_interval, is_equity=is_equity, mic_code=mic, rownum_start=len(first + second))
+            close = np.array([candle["close"] for candle in dummy_data], dtype=float)
+            states = db_functions.fetch_indicator_states(schema_name, table_name)
+            self.assertEqual({name: last_ID for name, (last_ID, _) in states.items()},
+                             {"ema_10": len(dummy_data) - 1, "rsi_5": len(dummy_data) - 1})
+            self.assertAlmostEqual(states["ema_10"][1].value, analysis_functions.ema(close, 10)[-1])
+            self.assertAlmostEqual(states["rsi_5"][1].value, analysis_functions.rsi(close, 5)[-1])
+
+            db_functions.drop_indicator_states(schema_name, table_name, "ema_10")
+            self.assertEqual(list(db_functions.fetch_indicator_states(schema_name, table_name)), ["rsi_5"])
+
+    def test_partitioned_storage(self):
+        """migration of per-symbol tables into partitioned storage, and appending the rows later on"""
+        self.save_samples_for_tests()
+        samples = {}
+        for symbol, time_interval, mic, is_equity in self.time_series_table_cases:
+            dummy_data = self.prepare_table_for_case(symbol, time_interval, is_equity, mic, inserted_rows=30)
+            samples[(symbol, time_interval, mic)] = dummy_data
+            self.assertIsNone(db_functions.partitioned_series_ID(symbol, time_interval, mic))
+
+        migrated = db_functions.migrate_all_time_series_to_partitioned()
+        self.assertEqual(sorted(migrated.values()), [30] * len(self.time_series_table_cases))
+        # repeated migration does not duplicate the rows
+        self.assertEqual(db_functions.migrate_time_series_to_partitioned("AAPL", "1min", mic_code="XNGS"), 0)
+
+        for (symbol, time_interval, mic), dummy_data in samples.items():
+            schema_name, table_name, _ = t_helpers.form_test_essentials(symbol, time_interval, mic, mic is not None)
+            self.assertEqual(
+                db_functions.fetch_partitioned_data(symbol, time_interval, mic),
+                helpers.fetch_generic_range_by_IDs_(schema_name, table_name))
+            more_data = t_helpers.generate_random_time_sample(time_interval, mic is not None, span=5)
+            # shift new rows past the migrated ones
+            shift = dummy_data[-1]["datetime_object"] - more_data[0]["datetime_object"] + timedelta(days=1)
+            for candle in more_data:
+                candle["datetime_object"] += shift
+                candle["datetime"] = str(candle["datetime_object"])[:None if time_interval == "1min" else 10]
+            # IDs continue from the migrated rows, and from the previous append
+            db_functions.insert_partitioned_data(more_data[:2], symbol, time_interval, mic_code=mic)
+            db_functions.insert_partitioned_data(more_data[2:], symbol, time_interval, mic_code=mic)
+            rows = db_functions.fetch_partitioned_data(
+                symbol, time_interval, mic, start_date=more_data[0]["datetime_object"])
+            self.assertEqual([r[0] for r in rows], list(range(30, 35)))
+            # rows that don't follow the stored ones are refused - their IDs would break the datetime order
+            for refused in (more_data[:2], more_data[-1:]):
+                with self.assertRaises(psycopg2.DataError):
+                    db_functions.insert_partitioned_data(refused, symbol, time_interval, mic_code=mic)
+            self.assertEqual(len(db_functions.fetch_partitioned_data(symbol, time_interval, mic)), 35)
+
+        snapshot = db_functions.fetch_partitioned_snapshot("1day", datetime(2100, 1, 1))
+        self.assertEqual([r[:2] for r in snapshot], [("AAPL", "XNGS"), ("USD/EUR", None)])
+        db_functions.migrate_time_series_to_partitioned("USD/EUR", "1min", drop_source=True)
+        self.assertFalse(db_functions.time_series_table_exists("USD/EUR", "1min"))
+        self.assertEqual(len(db_functions.fetch_partitioned_data("USD/EUR", "1min")), 35)
+
+    def test_fixed_point_prices(self):
+        """series created with price scale keep integer prices and decode them on the way out"""
+        self.save_samples_for_tests()
+        for symbol, time_interval, mic, is_equity in self.time_series_table_cases:
+            schema_name, table_name, _ = t_helpers.form_test_essentials(symbol, time_interval, mic, is_equity)
+            db_functions.create_time_series(symbol, time_interval, mic_code=mic, price_scale=5)
+            self.assertEqual(db_functions.fetch_price_scale(schema_name, table_name), 5)
+            dummy_data = t_helpers.generate_random_time_sample(time_interval, is_equity, span=30)
+            for candle in dummy_data:
+                # prices above 99,999 do not fit in numeric(10,5) columns
+                for price in ["open", "close", "high", "low"]:
+                    candle[price] = f"{candle[price] * 10000 + random():.5f}"
+            db_functions.insert_historical_data(dummy_data, symbol, time_interval, is_equity=is_equity, mic_code=mic)
+            db_functions.create_time_series_rollups(symbol, time_interval, mic_code=mic)
+
+            arrays = db_functions.fetch_time_series_arrays(symbol, time_interval, mic_code=mic)
+            raw_arrays = db_functions.fetch_time_series_arrays(symbol, time_interval, mic_code=mic, raw_prices=True)
+            for price in ["open", "close", "high", "low"]:
+                expected = [db_functions.encode_fixed_point_price(candle[price], 5) for candle in dummy_data]
+                self.assertEqual(raw_arrays[price].dtype, np.int64)
+                self.assertEqual(raw_arrays[price].tolist(), expected)
+                np.testing.assert_allclose(arrays[price], [float(candle[price]) for candle in dummy_data])
+            weekly = db_functions.fetch_time_series_rollup(symbol, time_interval, "week", mic_code=mic)
+            self.assertEqual(db_functions.encode_fixed_point_price(max(r[3] for r in weekly), 5),
+                             raw_arrays["high"].max())
+            # partitioned storage keeps numeric(10,5) prices, these are too large for it
+            with self.assertRaises(psycopg2.DataError):
+                db_functions.migrate_time_series_to_partitioned(symbol, time_interval, mic_code=mic)
+            self.assertIsNone(db_functions.partitioned_series_ID(symbol, time_interval, mic))
+
+            # creating existing series again does not change the storage, recreating it with numeric prices does
+            db_functions.create_time_series(symbol, time_interval, mic_code=mic)
+            self.assertEqual(db_functions.fetch_price_scale(schema_name, table_name), 5)
+            with psycopg2.connect(**helpers._connection_dict) as conn:
+                cur = conn.cursor()
+                if is_equity:
+                    cur.execute(_drop_time_table.format(
+                        time_interval=time_interval, symbol=symbol, market_identification_code=mic))
+                else:
+                    cur.execute(_drop_forex_table.format(
+                        symbol="_".join(symbol.split("/")), time_interval=time_interval))
+            db_functions.create_time_series(symbol, time_interval, mic_code=mic)
+            self.assertIsNone(db_functions.fetch_price_scale(schema_name, table_name))
+            with self.assertRaises(ValueError):
+                db_functions.fetch_time_series_arrays(symbol, time_interval, mic_code=mic, raw_prices=True)
+        with self.assertRaises(ValueError):
+            db_functions.create_time_series("AAPL", "1min", mic_code="XNGS", price_scale=20)
+
+        # prices that fit are decoded on the way into partitioned storage
+        db_functions.create_time_series("NVDA", "1day", mic_code="XNGS", price_scale=5)
+        dummy_data = t_helpers.generate_random_time_sample("1day", True, span=10)
+        db_functions.insert_historical_data(dummy_data, "NVDA", "1day", is_equity=True, mic_code="XNGS")
+        self.assertEqual(db_functions.migrate_time_series_to_partitioned("NVDA", "1day", mic_code="XNGS"), 10)
+        rows = db_functions.fetch_partitioned_data("NVDA", "1day", "XNGS")
+        self.assertEqual([[float(price) for price in row[2:6]] for row in rows], [
+            [float(candle[price]) for price in ["open", "close", "high", "low"]] for candle in dummy_data])
+
+    def test_prepared_statements(self):
+        """hot paths prepare their statements once per pooled connection and reuse them on later calls"""
+        self.save_samples_for_tests()
+        symbol, time_interval, mic, is_equity = self.time_series_table_cases[0]
+        dummy_data = self.prepare_table_for_case(symbol, time_interval, is_equity, mic, inserted_rows=20)
+        last_date = max(datetime.strptime(candle['datetime'], '%Y-%m-%d') for candle in dummy_data)
+
+        def prepared_statements() -> list:
+            with db_functions.pooled_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("select name, statement from pg_prepared_statements order by name;")
+                return cur.fetchall()
+
+        db_functions.close_connection_pool()
+        for _ in range(3):
+            self.assertEqual(db_functions.time_series_latest_timestamp(symbol, time_interval, mic_code=mic), last_date)
+            self.assertEqual(db_functions.fetch_ID_closest_to_date_(
+                last_date + timedelta(days=5), "<=", symbol, time_interval, mic_code=mic), 19)
+            self.assertEqual(len(db_functions.fetch_data_by_dates(
+                symbol, time_interval, mic_code=mic, end_date=last_date, trading_time_span=5)), 5)
+        statements = prepared_statements()
+        # latest timestamp, closest ID and range fetch (symbols are resolved by the registry)
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(all("$1" in statement or "LIMIT 1" in statement for _, statement in statements))
+        # statements prepared again by new connections keep their names - templates of the names don't pile up
+        templates = dict(db_functions.db_instrumentation._prepared_templates)
+        db_functions.close_connection_pool()
+        self.assertEqual(db_functions.time_series_latest_timestamp(symbol, time_interval, mic_code=mic), last_date)
+        self.assertLessEqual({name for name, _ in prepared_statements()}, {name for name, _ in statements})
+        self.assertEqual(db_functions.db_instrumentation._prepared_templates, templates)
+
+        # values are never part of the statement text, quotes can't break out of it
+        self.assertFalse(db_functions.is_equity("AAPL'); DROP TABLE public.stocks; --", use_registry=False))
+        self.assertTrue(db_functions.is_equity(symbol, use_registry=False))
+
+        # recreated table with a different row type is prepared again, instead of failing on the cached plan
+        with psycopg2.connect(**helpers._connection_dict) as conn:
+            cur = conn.cursor()
+            cur.execute(_drop_time_table.format(
+                time_interval=time_interval, symbol=symbol, market_identification_code=mic))
+        db_functions.create_time_series(symbol, time_interval, is_equity, mic_code=mic, price_scale=2)
+        fixed_data = t_helpers.generate_random_time_sample(time_interval, is_equity, span=3)
+        db_functions.insert_historical_data(fixed_data, symbol, time_interval, is_equity=is_equity, mic_code=mic)
+        fetched = db_functions.fetch_data_by_dates(
+            symbol, time_interval, mic_code=mic, end_date=datetime(2100, 1, 1), trading_time_span=3)
+        # rows of the new (integer) type are read, and decoded by the scale of the series
+        self.assertEqual([row[2] for row in fetched], [candle["open"] for candle in fixed_data])
+
+        # inserts borrow pooled connections too - the next insert reuses the statements prepared by the first one
+        db_functions.close_connection_pool()
+        last = max(candle["datetime_object"] for candle in fixed_data)
+        for day in (1, 2):
+            row = dict(fixed_data[0], datetime=str((last + timedelta(days=day)).date()))
+            db_functions.insert_historical_data([row], symbol, time_interval, is_equity=is_equity, mic_code=mic)
+        self.assertEqual(len([statement for _, statement in prepared_statements() if "INSERT" in statement]), 1)
+
+    def test_symbol_registry(self):
+        """symbols and series tables are resolved in memory, and the registry follows inserts and table creation"""
+        self.save_samples_for_tests()
+        db_functions.reset_symbol_registry_statistics()
+        for _ in range(5):
+            for symbol, time_interval, mic, is_equity in self.time_series_table_cases:
+                self.assertEqual(db_functions.resolve_time_series_location(symbol, time_interval, mic_code=mic)[2],
+                                 is_equity)
+        statistics = db_functions.symbol_registry_statistics()
+        self.assertEqual(statistics["loads"], 1)
+        self.assertEqual(statistics["misses"], 1)
+        self.assertGreater(statistics["hit_ratio"], 0.95)
+        self.assertEqual(statistics["series_tables"], 0)
+
+        # creation of the table is seen straight away, its later checks are answered by the registry
+        symbol, time_interval, mic, is_equity = self.time_series_table_cases[0]
+        self.assertFalse(db_functions.time_series_table_exists(symbol, time_interval, mic_code=mic))
+        db_functions.create_time_series(symbol, time_interval, mic_code=mic)
+        misses = db_functions.symbol_registry_statistics()["misses"]
+        self.assertTrue(db_functions.time_series_table_exists(symbol, time_interval, mic_code=mic))
+        self.assertEqual(db_functions.symbol_registry_statistics()["misses"], misses)
+
+        # symbol inserted in the meantime by another process reloads the registry instead of failing
+        with psycopg2.connect(**helpers._connection_dict) as conn:
+            cur = conn.cursor()
+            cur.execute("""INSERT INTO "public".stocks SELECT 1000, 'NEWCO', s.name, s.currency, s.exchange,
+                s.country, s.type, s.plan FROM "public".stocks s LIMIT 1;""")
+        self.assertFalse(db_functions.is_equity("NEWCO"))  # registry was loaded just a moment ago
+        with patch.object(helpers, "REGISTRY_RELOAD_INTERVAL_", 0.):
+            self.assertTrue(db_functions.is_equity("NEWCO"))
+            with self.assertRaises(helpers.DataUncertainError_):
+                db_functions.resolve_time_series_location("NOTHING", "1day", mic_code="XNGS")
+
+        # purge empties the database and the registry with it
+        db_functions.purge_db_structure()
+        db_functions.import_db_structure()
+        self.assertFalse(db_functions.is_equity(symbol))
+
+    def test_series_catalog(self):
+        """catalog entry follows inserts, corrections and truncation of the series, without scanning it on reads"""
+        self.save_samples_for_tests()
+        for symbol, time_interval, mic, is_equity in self.time_series_table_cases:
+            schema_name, table_name, _ = t_helpers.form_test_essentials(symbol, time_interval, mic, is_equity)
+            db_functions.create_time_series(symbol, time_interval, mic_code=mic)
+            self.assertEqual(db_functions.fetch_series_catalog(schema_name, table_name)[0][6], 0)
+            self.assertIsNone(db_functions.time_series_latest_timestamp(symbol, time_interval, mic_code=mic))
+            dummy_data = t_helpers.generate_random_time_sample(time_interval, is_equity, span=40)
+            db_functions.insert_historical_data(dummy_data[20:], symbol, time_interval, mic_code=mic)
+            db_functions.insert_historical_data(
+                dummy_data[:20], symbol, time_interval, rownum_start=20, mic_code=mic)
+
+            entry = db_functions.fetch_series_catalog(schema_name, table_name)[0]
+            with psycopg2.connect(**helpers._connection_dict) as conn:
+                cur = conn.cursor()
+                cur.execute(f"""SELECT min(datetime), max(datetime), min("ID"), max("ID"), count(*), min(low), max(high)
+                    FROM "{schema_name}"."{table_name}";""")
+                self.assertEqual(entry[2:9], cur.fetchall()[0])
+            self.assertEqual(db_functions.time_series_latest_timestamp(symbol, time_interval, mic_code=mic), entry[3])
+            self.assertEqual(db_functions.fetch_generic_last_ID(schema_name, table_name), 39)
+
+            # deletes recalculate the entry
+            with psycopg2.connect(**helpers._connection_dict) as conn:
+                cur = conn.cursor()
+                cur.execute(f'DELETE FROM "{schema_name}"."{table_name}" WHERE "ID" >= 30;')
+            entry = db_functions.fetch_series_catalog(schema_name, table_name)[0]
+            self.assertEqual((entry[5], entry[6]), (29, 30))
+            with psycopg2.connect(**helpers._connection_dict) as conn:
+                cur = conn.cursor()
+                cur.execute(f'TRUNCATE "{schema_name}"."{table_name}";')
+            self.assertEqual(db_functions.fetch_series_catalog(schema_name, table_name)[0][6], 0)
+        self.assertEqual(len(db_functions.fetch_series_catalog()), 4)
+
+        # tables created before the catalog are attached afterwards, dropped ones disappear from it
+        with psycopg2.connect(**helpers._connection_dict) as conn:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM "public".series_catalog;')
+            cur.execute(_drop_forex_table.format(symbol="USD_EUR", time_interval="1min"))
+        self.assertEqual(db_functions.attach_all_series_catalog(), 3)
+        self.assertEqual(len(db_functions.fetch_series_catalog()), 3)
+        fixed_data = t_helpers.generate_random_time_sample("1min", False, span=5)
+        db_functions.create_time_series("USD/EUR", "1min", price_scale=3)
+        db_functions.insert_historical_data(fixed_data, "USD/EUR", "1min")
+        entry = db_functions.fetch_series_catalog("forex_time_series", "USD_EUR_1min")[0]
+        self.assertAlmostEqual(float(entry[8]), max(float(candle["high"]) for candle in fixed_data), places=3)
+
+    def test_time_series_panel(self):
+        """series with gaps are aligned on their common timeline, missing bars follow the chosen policy"""
+        self.save_samples_for_tests()
+        data = t_helpers.generate_random_time_sample("1day", True, span=30)
+        series = [("AAPL", "XNGS"), ("NVDA", "XNGS"), ("USD/EUR", None)]
+        gaps = [set(), {0, 1, 7, 8, 9}, {3, 29}]
+        inserted = {}
+        for (symbol, mic), gap in zip(series, gaps):
+            rows = [dict(candle) for index, candle in enumerate(data) if index not in gap]
+            if mic is None:
+                rows = [{key: value for key, value in candle.items() if key != "volume"} for candle in rows]
+            db_functions.create_time_series(symbol, "1day", mic_code=mic, price_scale=2 if symbol == "NVDA" else None)
+            db_functions.insert_historical_data(rows, symbol, "1day", mic_code=mic)
+            inserted[symbol] = {candle["datetime_object"]: candle for candle in rows}
+
+        dates = [candle["datetime_object"] for candle in data]
+        panel = db_functions.fetch_time_series_panel(series, "1day", fields=("close", "volume"))
+        self.assertEqual(list(panel["datetime"].astype(datetime)), [d.date() for d in dates])
+        self.assertEqual(panel["close"].shape, (30, 3))
+        for column, (symbol, _) in enumerate(series):
+            expected = [float(inserted[symbol][d]["close"]) if d in inserted[symbol] else np.nan for d in dates]
+            np.testing.assert_array_equal(panel["close"][:, column], expected)
+        self.assertTrue(np.isnan(panel["volume"][:, 2]).all())
+
+        filled = db_functions.fetch_time_series_panel(series, "1day", missing="ffill")["close"]
+        self.assertTrue(np.isnan(filled[:2, 1]).all())
+        self.assertEqual(filled[7, 1], filled[6, 1])
+        self.assertEqual(filled[9, 1], filled[6, 1])
+        self.assertEqual(filled[3, 2], filled[2, 2])
+        self.assertFalse(np.isnan(filled[2:]).any())
+
+        dropped = db_functions.fetch_time_series_panel(
+            series, "1day", start_date=dates[1], end_date=dates[20], missing="drop")
+        self.assertEqual(len(dropped["datetime"]), 20 - 1 - 4)
+        self.assertFalse(np.isnan(dropped["close"]).any())
+        with self.assertRaises(ValueError):
+            db_functions.fetch_time_series_panel(series, "1day", missing="zero")
+
+    def test_query_statistics(self):
+        """executions are grouped by template, slow ones get their plan captured without changing any data"""
+        self.save_samples_for_tests()
+        symbol, time_interval, mic, is_equity = self.time_series_table_cases[0]
+        dummy_data = self.prepare_table_for_case(symbol, time_interval, is_equity, mic, inserted_rows=20)
+        last_date = max(datetime.strptime(candle['datetime'], '%Y-%m-%d') for candle in dummy_data)
+        db_functions.reset_query_statistics()
+        for span in (3, 5, 7):
+            db_functions.fetch_data_by_dates(
+                symbol, time_interval, mic_code=mic, end_date=last_date, trading_time_span=span)
+        templates = db_functions.query_statistics()["templates"]
+        range_fetches = [entry for template, entry in templates.items()
+                         if template.startswith('SELECT * FROM "1day_time_series".<series>') and "LIMIT $" in template]
+        self.assertEqual(len(range_fetches), 1)
+        self.assertEqual(range_fetches[0]["calls"], 3)
+        self.assertEqual(range_fetches[0]["rows"], 15)
+        self.assertEqual(sum(range_fetches[0]["histogram"]), 3)
+        self.assertGreater(range_fetches[0]["bytes_received"], 0)
+        self.assertEqual(db_functions.query_template("select * from x where a = 'b' and c = 12;"),
+                         "select * from x where a = ? and c = ?")
+
+        table = f'"1day_time_series"."{symbol}_{mic}"'
+        with patch("db_functions.db_instrumentation.SLOW_QUERY_THRESHOLD_", 0.):
+            with psycopg2.connect(**helpers._connection_dict) as conn:
+                cur = conn.cursor()
+                cur.execute(f"DELETE FROM {table} WHERE \"ID\" < 5;")
+                cur.execute(f"SELECT count(*) FROM {table};")
+                self.assertEqual(cur.fetchone()[0], 15)  # result of the statement survives the plan capture
+            with db_functions.pooled_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("CREATE TEMPORARY TABLE explained (a int);")
+                cur.execute("INSERT INTO explained VALUES (1);")
+        slow_queries = {entry["query"].split()[0]: entry for entry in db_functions.query_statistics()["slow_queries"]}
+        self.assertIn("Plan", slow_queries["DELETE"]["plan"])
+        self.assertIn("Shared Hit Blocks", slow_queries["SELECT"]["plan"]["Plan"])
+        self.assertEqual(slow_queries["CREATE"]["plan"], "statement can't be explained")
+        self.assertIn("Plan", slow_queries["INSERT"]["plan"])
+        # writes are planned, not run once more
+        self.assertIn("Actual Rows", slow_queries["SELECT"]["plan"]["Plan"])
+        self.assertNotIn("Actual Rows", slow_queries["DELETE"]["plan"]["Plan"])
+        self.assertNotIn("Actual Rows", slow_queries["INSERT"]["plan"]["Plan"])
+        self.assertDatabaseHasRows("1day_time_series", f"{symbol}_{mic}", 15)  # explained delete was rolled back
+        with db_functions.pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT count(*) FROM explained;")
+            self.assertEqual(cur.fetchone()[0], 1)
+            cur.execute("DROP TABLE explained;")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "statistics.json")
+            db_functions.dump_query_statistics(path, top=2)
+            with open(path) as file:
+                dumped = json.load(file)
+        self.assertEqual(len(dumped["templates"]), 2)
+        self.assertEqual(len(dumped["slow_queries"]), 4)
+
+    @patch("db_functions.maintenance_db.MAINTENANCE_QUIET_PERIOD_", 0.05)
+    @patch("db_functions.maintenance_db.ANALYZE_MIN_ROWS_", 100)
+    def test_maintenance_after_load(self):
+        """big loads get their table analyzed (and vacuumed) in the background, once no load is running"""
+        self.save_samples_for_tests()
+        key = ("1day_time_series", "AAPL_XNGS")
+
+        def estimated_rows() -> int:
+            with psycopg2.connect(**helpers._connection_dict) as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT reltuples FROM pg_class WHERE oid = \'"1day_time_series"."AAPL_XNGS"\'::regclass;')
+                return cur.fetchone()[0]
+
+        db_functions.create_time_series("AAPL", "1day", True, mic_code="XNGS")
+        data = t_helpers.generate_random_time_sample("1day", True, span=250)
+        db_functions.insert_historical_data(data[:50], "AAPL", "1day", is_equity=True, mic_code="XNGS")
+        self.assertFalse(db_functions.maintenance_statistics()[key]["scheduled"])  # below the threshold
+
+        with db_functions.track_ingestion("1day_time_series", "OTHER_XNGS", 0):  # backfill running meanwhile
+            db_functions.insert_historical_data(
+                data[50:200], "AAPL", "1day", rownum_start=50, is_equity=True, mic_code="XNGS")
+            time.sleep(0.2)
+            self.assertTrue(db_functions.maintenance_statistics()[key]["scheduled"])
+            self.assertEqual(db_functions.maintenance_statistics()[key]["analyzes"], 0)
+        self.assertTrue(db_functions.wait_for_maintenance(timeout=10))
+        statistics = db_functions.maintenance_statistics()[key]
+        self.assertEqual((statistics["analyzes"], statistics["vacuums"], statistics["written"]), (1, 1, 0))
+        self.assertEqual(statistics["analyzed_rows"], 200)
+        self.assertEqual(estimated_rows(), 200)
+
+        # 50 rows are below the threshold - nothing to do, an explicit call only analyzes
+        db_functions.insert_historical_data(
+            data[200:], "AAPL", "1day", rownum_start=200, is_equity=True, mic_code="XNGS")
+        self.assertTrue(db_functions.wait_for_maintenance(timeout=10))
+        self.assertEqual(db_functions.maintenance_statistics()[key]["analyzes"], 1)
+        self.assertFalse(db_functions.maintain_table("1day_time_series", "AAPL_XNGS"))
+        self.assertEqual(estimated_rows(), 250)
+
+    def test_reference_sync(self):
+        """synced references keep IDs of the instruments - only differences are written, nothing is deleted"""
+        pairs = self.save_forex_sample()
+        markets = self.save_markets_sample()
+        stocks = self.save_equities_sample()
+        aapl_ID = db_functions.fetch_stocks(symbol_like="AAPL")[0][0]
+        otex_ID = db_functions.fetch_stocks(symbol_like="OTEX")[0][0]
+
+        result = db_functions.sync_reference_data(pairs, markets, stocks)
+        self.assertEqual(result["stocks"], {"inserted": 0, "updated": 0, "delisted": 0, "unchanged": 6, "skipped": 0})
+        self.assertEqual(result["markets"]["unchanged"], 6)
+        self.assertEqual(result["forex_pairs"]["unchanged"], 7)
+
+        new_market = {'name': 'WSE', 'code': 'XWAR', 'country': 'Poland', 'timezone': 'Europe/Warsaw',
+                      'access': {'global': 'Level A', 'plan': 'Grow'}}
+        new_stocks = [
+            {'symbol': 'CDR', 'name': 'CD Projekt SA', 'currency': 'PLN', 'exchange': 'WSE', 'mic_code': 'XWAR',
+             'country': 'Poland', 'type': 'Common Stock', 'access': {'global': 'Level A', 'plan': 'Grow'}},
+            {'symbol': 'ZZZ', 'name': 'Unknown Market Inc', 'currency': 'USD', 'exchange': 'ZZZ',
+             'mic_code': 'XZZZ', 'country': 'United States', 'type': 'Common Stock',
+             'access': {'global': 'Basic', 'plan': 'Basic'}},
+        ]
+        changed_stocks = [dict(stock, name="NVIDIA Corporation") if stock['symbol'] == "NVDA" else stock
+                          for stock in stocks if stock['symbol'] != "OTEX"] + new_stocks
+        changed_pairs = [pair for pair in pairs if pair['symbol'] != "KGS/RUB"] + [
+            {'symbol': 'EUR/PLN', 'currency_group': 'Minor', 'currency_base': 'Euro', 'currency_quote': 'Polish Zloty'}]
+        result = db_functions.sync_reference_data(changed_pairs, markets + [new_market], changed_stocks)
+        self.assertEqual(result["stocks"], {"inserted": 1, "updated": 1, "delisted": 1, "unchanged": 4, "skipped": 1})
+        self.assertEqual(result["markets"], {"inserted": 1, "updated": 0, "delisted": 0, "unchanged": 6})
+        self.assertEqual(result["forex_pairs"], {"inserted": 1, "updated": 0, "delisted": 1, "unchanged": 6})
+
+        self.assertEqual(db_functions.fetch_stocks(symbol_like="AAPL")[0][0], aapl_ID)
+        self.assertEqual(db_functions.fetch_stocks(symbol_like="NVDA")[0][2], "NVIDIA Corporation")
+        self.assertEqual(db_functions.fetch_stocks(symbol_like="CDR")[0][3:6], ("PLN", "XWAR", "Poland"))
+        self.assertFalse(db_functions.fetch_stocks(symbol_like="OTEX"))
+        self.assertFalse(db_functions.fetch_forex_pairs(symbol_like="KGS/RUB"))
+        self.assertTrue(db_functions.search_instruments("stocks", prefix="CD"))
+        with psycopg2.connect(**helpers._connection_dict) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT "ID", delisted_at IS NOT NULL FROM public.stocks WHERE symbol = \'OTEX\';')
+            self.assertEqual(cur.fetchall(), [(otex_ID, True)])
+
+        # nothing changed since - nothing is written
+        result = db_functions.sync_reference_data(changed_pairs, markets + [new_market], changed_stocks)
+        self.assertEqual(result["stocks"], {"inserted": 0, "updated": 0, "delisted": 0, "unchanged": 6, "skipped": 1})
+
+        # listed again - under the same ID; lists that are not given stay as they are
+        result = db_functions.sync_reference_data(stocks=changed_stocks + [stocks[3]])
+        self.assertEqual(set(result), {"stocks"})
+        self.assertEqual((result["stocks"]["updated"], result["stocks"]["inserted"]), (1, 0))
+        self.assertEqual(db_functions.fetch_stocks(symbol_like="OTEX")[0][0], otex_ID)
+        self.assertEqual(len(db_functions.fetch_markets()), 7)
+
+    def test_downsampled_time_series(self):
+        """every bucket folds its candles like a rollup does, and the ranges are split into equal spans"""
+        self.save_samples_for_tests()
+        for symbol, time_interval, mic, is_equity in self.time_series_table_cases:
+            db_functions.create_time_series(symbol, time_interval, mic_code=mic, price_scale=None if mic else 4)
+            data = t_helpers.generate_random_time_sample(time_interval, is_equity, span=200)
+            db_functions.insert_historical_data(data, symbol, time_interval, is_equity=is_equity, mic_code=mic)
+
+            rows = db_functions.fetch_downsampled_time_series(symbol, time_interval, 16, mic_code=mic)
+            self.assertLessEqual(len(rows), 16)
+            self.assertEqual(len(rows[0]), 7 if is_equity else 6)
+            self.assertEqual([row[0] for row in rows], sorted({row[0] for row in rows}))
+            self.assertTrue(1 <= rows[0][0] and rows[-1][0] == 16)
+            self.assertEqual((rows[0][1], rows[0][2]), (data[0]["datetime_object"], data[0]["open"]))
+            self.assertEqual(rows[-1][3], data[-1]["close"])
+            self.assertEqual(max(row[4] for row in rows), max(row["high"] for row in data))
+            self.assertEqual(min(row[5] for row in rows), min(row["low"] for row in data))
+            if is_equity:
+                self.assertEqual(sum(row[6] for row in rows), sum(row["volume"] for row in data))
+
+            # a bucket per candle gives back the candles, a range of a single instant gives its candle
+            rows = db_functions.fetch_downsampled_time_series(symbol, time_interval, 20_000, mic_code=mic)
+            self.assertEqual([row[1:] for row in rows], [
+                (row["datetime_object"], row["open"], row["close"], row["high"], row["low"],
+                 *([row["volume"]] if is_equity else [])) for row in data])
+            middle = data[100]["datetime_object"]
+            rows = db_functions.fetch_downsampled_time_series(
+                symbol, time_interval, 10, mic_code=mic, start_date=middle, end_date=middle)
+            self.assertEqual([row[:3] for row in rows], [(1, middle, data[100]["open"])])
+        with self.assertRaises(ValueError):
+            db_functions.fetch_downsampled_time_series("AAPL", "1day", 0, mic_code="XNGS")
+        with self.assertRaises(db_functions.TimeSeriesNotFoundError):
+            db_functions.fetch_downsampled_time_series("NVDA", "1day", 10, mic_code="XNGS")
+
+    def test_series_quality(self):
+        """scanner counts every kind of defect of the stored series and keeps the reports in a table"""
+        self.save_samples_for_tests()
+        days = [day for day in (datetime(2021, 1, 4) + timedelta(days=i) for i in range(120)) if day.isoweekday() < 6]
+        closes = 100 + np.cumsum(np.random.default_rng(7).normal(0, 0.5, len(days)))
+        data = [
+            {"datetime": str(day.date()), "open": round(close, 2), "close": round(close, 2),
+             "high": round(close + 2, 2), "low": round(close - 2, 2), "volume": 1000}
+            for day, close in zip(days, closes)
+        ]
+        del data[20:25]  # a week of sessions is missing
+        data[30]["close"] = 1000.  # outlier - and a candle closing above its high
+        data[40]["low"] = 0  # invalid price
+        data[50]["high"] = data[50]["low"] - 1  # high below low
+        data[60]["datetime"] = data[59]["datetime"]  # duplicate timestamp, going back against the previous ID
+        db_functions.create_time_series("AAPL", "1day", True, mic_code="XNGS")
+        db_functions.insert_historical_data(data, "AAPL", "1day", is_equity=True, mic_code="XNGS")
+        self.prepare_table_for_case("USD/EUR", "1min", False, None, inserted_rows=30)
+
+        reports = db_functions.scan_archive_quality(max_workers=2)
+        self.assertEqual(set(reports), {("1day_time_series", "AAPL_XNGS"), ("forex_time_series", "USD_EUR_1min")})
+        report = reports[("1day_time_series", "AAPL_XNGS")]
+        self.assertEqual(report["row_count"], len(data))
+        self.assertEqual({check: report[check] for check in db_functions.QUALITY_CHECKS}, {
+            "duplicate_timestamps": 1, "invalid_prices": 1, "inconsistent_candles": 2, "outlier_returns": 2,
+            "session_gaps": 1, "missing_sessions": 5, "non_monotonic_IDs": 0,
+        })
+        self.assertEqual(report["issues"], 7)
+        self.assertEqual(reports[("forex_time_series", "USD_EUR_1min")]["issues"], 0)
+
+        saved = db_functions.fetch_quality_report(with_issues_only=True)
+        self.assertEqual([row[:3] for row in saved], [("1day_time_series", "AAPL_XNGS", len(data))])
+        self.assertEqual(saved[0][12], 7)
+
+        # timestamps going back against IDs, and a minute series with a hole in the middle of a day
+        minutes = np.array([0, 1, 2, 20, 3, 4], dtype=np.int64) + 1440 * 18000
+        prices = np.full(6, 10.)
+        checked = db_functions.check_series_quality(np.arange(6), minutes, prices, prices, prices, prices, "1min")
+        self.assertEqual((checked["non_monotonic_IDs"], checked["session_gaps"]), (1, 1))
+        with self.assertRaises(db_functions.TimeSeriesNotFoundError):
+            db_functions.scan_series_quality("1day_time_series", "NONE_XNGS")
+
+    def test_sharded_time_series(self):
+        """series stored before the second shard is added are moved to it, fetches route to the shard of a series"""
+        self.save_samples_for_tests()
+        series = [("AAPL", "XNGS"), ("NVDA", "XNGS"), ("USD/EUR", None)]
+        data = t_helpers.generate_random_time_sample("1day", True, span=30)
+        for symbol, mic in series:
+            rows = data if mic else [
+                {key: value for key, value in candle.items() if key != "volume"} for candle in data]
+            db_functions.create_time_series(symbol, "1day", mic_code=mic, price_scale=2 if symbol == "NVDA" else None)
+            db_functions.insert_historical_data(rows, symbol, "1day", mic_code=mic)
+        db_functions.create_time_series_rollups("NVDA", "1day", mic_code="XNGS", buckets=("week",))
+        ema = analysis_functions.EMAState(10)
+        for candle in data:
+            ema.update(candle)
+        db_functions.save_indicator_state("1day_time_series", "NVDA_XNGS", "ema_10", ema, len(data) - 1)
+        before = {symbol: db_functions.fetch_time_series_arrays(symbol, "1day", mic_code=mic) for symbol, mic in series}
+        panel = db_functions.fetch_time_series_panel(series, "1day", fields=("close",))
+
+        shard = {key: value for key, value in helpers._connection_dict.items() if key != "cursor_factory"}
+        shard["database"] = f"{helpers._connection_dict['database']}_shard1"
+        # databases are created outside of a transaction block
+        conn = psycopg2.connect(**helpers._connection_dict)
+        conn.autocommit = True
+        conn.cursor().execute(f'DROP DATABASE IF EXISTS "{shard["database"]}" WITH (FORCE);')
+        conn.cursor().execute(f'CREATE DATABASE "{shard["database"]}";')
+        conn.close()
+        try:
+            with psycopg2.connect(**shard) as conn, \
+                    open(db_functions.sql_loader.build_schema_instructions_file_path) as schema:
+                conn.cursor().execute(schema.read())
+            conn.close()
+            helpers._shard_connection_dicts.append(helpers._shard_connection_dict(shard))
+            db_functions.close_connection_pool()
+            db_functions.invalidate_symbol_registry()
+
+            # hash of the table names places these on the new shard, the rest stays where it is
+            moved = {("1day_time_series", "NVDA_XNGS", 0, 1), ("forex_time_series", "USD_EUR_1day", 0, 1)}
+            self.assertEqual(set(db_functions.misplaced_series()), moved)
+            self.assertFalse(db_functions.time_series_table_exists("NVDA", "1day", mic_code="XNGS"))
+            self.assertEqual(set(db_functions.rebalance_shards(dry_run=True)), moved)
+            self.assertEqual(set(db_functions.rebalance_shards()), moved)
+            self.assertEqual(db_functions.misplaced_series(), [])
+            self.assertEqual(
+                [shard_ for shard_, schema_name, table_name in db_functions.list_series_tables()], [0, 1, 1])
+
+            for symbol, mic in series:
+                self.assertTrue(db_functions.time_series_table_exists(symbol, "1day", mic_code=mic))
+                after = db_functions.fetch_time_series_arrays(symbol, "1day", mic_code=mic)
+                for column, values in before[symbol].items():
+                    np.testing.assert_array_equal(after[column], values)
+            np.testing.assert_array_equal(
+                db_functions.fetch_time_series_panel(series, "1day", fields=("close",))["close"], panel["close"])
+            self.assertEqual([row[:2] for row in db_functions.fetch_series_catalog("1day_time_series")],
+                             [("1day_time_series", "AAPL_XNGS"), ("1day_time_series", "NVDA_XNGS")])
+            self.assertEqual(len(db_functions.fetch_time_series_rollup("NVDA", "1day", "week", mic_code="XNGS")),
+                             len({candle["datetime_object"].isocalendar()[:2] for candle in data}))
+            states = db_functions.fetch_indicator_states("1day_time_series", "NVDA_XNGS")
+            self.assertAlmostEqual(states["ema_10"][1].value, ema.value)
+
+            # appended rows go to the new shard, the old one no longer keeps the series
+            last = max(candle["datetime_object"] for candle in data)
+            newer = [dict(candle, datetime=str((last + timedelta(days=i + 1)).date()),
+                          datetime_object=last + timedelta(days=i + 1)) for i, candle in enumerate(data[:5])]
+            db_functions.insert_historical_data(newer, "NVDA", "1day", mic_code="XNGS", rownum_start=len(data))
+            self.assertEqual(len(db_functions.fetch_time_series_arrays("NVDA", "1day", mic_code="XNGS")["ID"]), 35)
+            with psycopg2.connect(**helpers._connection_dict) as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT to_regclass('\"1day_time_series\".\"NVDA_XNGS\"'), "
+                            "(SELECT count(*) FROM public.price_scales);")
+                self.assertEqual(cur.fetchone(), (None, 0))
+
+            # series of every shard are migrated into partitioned storage
+            self.assertEqual(db_functions.migrate_all_time_series_to_partitioned(), {
+                "1day_time_series.AAPL_XNGS": 30, "1day_time_series.NVDA_XNGS": 35,
+                "forex_time_series.USD_EUR_1day": 30})
+            closes = [float(row[3]) for row in db_functions.fetch_partitioned_data("NVDA", "1day", "XNGS")]
+            np.testing.assert_array_equal(
+                closes, db_functions.fetch_time_series_arrays("NVDA", "1day", mic_code="XNGS")["close"])
+        finally:
+            helpers._shard_connection_dicts[:] = [helpers._connection_dict]
+            db_functions.close_connection_pool()
+            db_functions.invalidate_symbol_registry()
+            conn = psycopg2.connect(**helpers._connection_dict)
+            conn.autocommit = True
+            conn.cursor().execute(f'DROP DATABASE IF EXISTS "{shard["database"]}" WITH (FORCE);')
+            conn.close()
+
+    def test_ingest_log(self):
+        """downloaded pages survive a database failure and a torn write, replaying the log inserts them once"""
+        self.save_samples_for_tests()
+        data = t_helpers.generate_random_time_sample("1day", True, span=40)
+        newest_first = list(reversed(data))
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(db_functions.ingest_log_db, "INGEST_LOG_DIRECTORY_", directory):
+            # pages come newest first, the second one repeats the last row of the first
+            with db_functions.logged_download("AAPL", "1day", mic_code="XNGS") as log_page:
+                log_page(newest_first[10:20])
+                log_page(newest_first[19:30])
+            with self.assertRaises(ValueError):
+                with db_functions.logged_download("AAPL", "1day", mic_code="XNGS") as log_page:
+                    log_page(newest_first[:10])
+                    raise ValueError("download failed half way")
+            self.assertEqual(db_functions.pending_ingest_log(), {
+                "segments": 1, "pages": 3, "committed": 1, "in_progress": 0})
+
+            with patch.object(db_functions.ingest_log_db, "insert_historical_data_",
+                              side_effect=psycopg2.OperationalError("database is down")):
+                with self.assertRaises(psycopg2.OperationalError):
+                    db_functions.drain_ingest_log()
+            self.assertEqual(db_functions.pending_ingest_log()["committed"], 1)
+            self.assertEqual(db_functions.drain_ingest_log(), {("1day_time_series", "AAPL_XNGS"): 20})
+            self.assertEqual(db_functions.pending_ingest_log()["segments"], 0)
+            stored = db_functions.fetch_time_series_arrays("AAPL", "1day", mic_code="XNGS")
+            self.assertEqual(list(stored["ID"]), list(range(20)))
+            self.assertEqual(list(stored["datetime"].astype(datetime)),
+                             [candle["datetime_object"].date() for candle in data[10:30]])
+
+            # the update is logged, its segment torn by a crash at the next write - and kept after being applied
+            with db_functions.logged_download("AAPL", "1day", mic_code="XNGS") as log_page:
+                log_page(newest_first[:11])
+            # segments are kept in a directory of the process
+            (process_directory,) = os.listdir(directory)
+            (segment,) = [os.path.join(directory, process_directory, name)
+                          for name in os.listdir(os.path.join(directory, process_directory)) if name.endswith(".log")]
+            with open(segment, "ab") as file:
+                file.write(b"\x00\x00\x01\x00torn")
+            self.assertEqual(len(db_functions.read_ingest_segment(segment)), 2)
+            with open(segment, "rb") as file:
+                content = file.read()
+            self.assertEqual(db_functions.drain_ingest_log(), {("1day_time_series", "AAPL_XNGS"): 10})
+            with open(segment, "wb") as file:
+                file.write(content)
+            self.assertEqual(db_functions.drain_ingest_log(), {("1day_time_series", "AAPL_XNGS"): 0})
+            self.assertDatabaseHasRows("1day_time_series", "AAPL_XNGS", 30)
+
+            # pages of a download in progress are not applied, and their segment stays
+            with db_functions.logged_download("AAPL", "1day", mic_code="XNGS") as log_page:
+                log_page(newest_first[:1])
+                self.assertEqual(db_functions.drain_ingest_log(), {})
+                self.assertEqual(db_functions.pending_ingest_log()["segments"], 1)
+            self.assertEqual(db_functions.drain_ingest_log(), {("1day_time_series", "AAPL_XNGS"): 0})
+
+    @unittest.skipUnless(hasattr(os, "fork"), "processes are forked")
+    def test_ingest_log_processes(self):
+        """every process writes its own directory of the log, directories of the processes that ended are recovered"""
+        self.save_samples_for_tests()
+        data = [{key: value for key, value in candle.items() if key != "volume"}
+                for candle in t_helpers.generate_random_time_sample("1day", False, span=15)]
+        newest_first = list(reversed(data))
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(db_functions.ingest_log_db, "INGEST_LOG_DIRECTORY_", directory):
+            with db_functions.logged_download("USD/EUR", "1day", False) as log_page:
+                log_page(newest_first[10:])
+            logged, finish = os.pipe(), os.pipe()
+            child = os.fork()
+            if child == 0:
+                try:
+                    with db_functions.logged_download("USD/EUR", "1day", False) as log_page:
+                        log_page(newest_first[5:11])
+                    # download in progress when the process ends - it is never finished
+                    with db_functions.logged_download("USD/EUR", "1day", False) as log_page:
+                        log_page(newest_first[:6])
+                        os.write(logged[1], b"1")
+                        os.read(finish[0], 1)
+                        os._exit(0)
+                finally:
+                    os._exit(0)
+            os.read(logged[0], 1)
+            self.assertEqual(len(os.listdir(directory)), 2)
+            # segments of a process that still runs are left to it
+            self.assertEqual(db_functions.pending_ingest_log(), {
+                "segments": 1, "pages": 1, "committed": 1, "in_progress": 0})
+            self.assertEqual(db_functions.drain_ingest_log(), {("forex_time_series", "USD_EUR_1day"): 5})
+            os.write(finish[1], b"1")
+            os.waitpid(child, 0)
+            self.assertEqual(db_functions.pending_ingest_log(), {
+                "segments": 1, "pages": 2, "committed": 1, "in_progress": 0})
+            self.assertEqual(db_functions.drain_ingest_log(), {("forex_time_series", "USD_EUR_1day"): 5})
+            self.assertEqual(len(os.listdir(directory)), 1)
+            stored = db_functions.fetch_time_series_arrays("USD/EUR", "1day")
+            self.assertEqual(list(stored["ID"]), list(range(10)))
+            self.assertEqual(list(stored["datetime"].astype(datetime)),
+                             [candle["datetime_object"].date() for candle in data[:10]])
+
+    def test_ingest_log_concurrent_append(self):
+        """rows appended by someone else after the drain read the latest row don't cost the drain its pages"""
+        self.save_samples_for_tests()
+        data = t_helpers.generate_random_time_sample("1day", True, span=20)
+        latest_timestamp = db_functions.ingest_log_db.time_series_latest_timestamp_
+
+        def appended_meanwhile(*args):
+            latest = latest_timestamp(*args)
+            if latest is None:
+                db_functions.insert_historical_data(data[:10], "AAPL", "1day", mic_code="XNGS")
+            return latest
+
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(db_functions.ingest_log_db, "INGEST_LOG_DIRECTORY_", directory):
+            with db_functions.logged_download("AAPL", "1day", mic_code="XNGS") as log_page:
+                log_page(list(reversed(data)))
+            with patch.object(db_functions.ingest_log_db, "time_series_latest_timestamp_",
+                              side_effect=appended_meanwhile):
+                self.assertEqual(db_functions.drain_ingest_log(), {("1day_time_series", "AAPL_XNGS"): 10})
+            self.assertEqual(db_functions.pending_ingest_log()["segments"], 0)
+        stored = db_functions.fetch_time_series_arrays("AAPL", "1day", mic_code="XNGS")
+        self.assertEqual(list(stored["ID"]), list(range(20)))
+        self.assertEqual(list(stored["datetime"].astype(datetime)),
+                         [candle["datetime_object"].date() for candle in data])
+
+    def test_series_archive(self):
+        """series exported into an archive come back after a rebuild, damaged archives are caught by their manifest"""
+        self.save_samples_for_tests()
+        series = [("AAPL", "XNGS"), ("NVDA", "XNGS"), ("USD/EUR", None)]
+        data = t_helpers.generate_random_time_sample("1day", True, span=30)
+        for symbol, mic in series:
+            rows = data if mic else [
+                {key: value for key, value in candle.items() if key != "volume"} for candle in data]
+            db_functions.create_time_series(symbol, "1day", mic_code=mic, price_scale=2 if symbol == "NVDA" else None)
+            db_functions.insert_historical_data(rows, symbol, "1day", mic_code=mic)
+        db_functions.create_time_series_rollups("NVDA", "1day", mic_code="XNGS", buckets=("week",))
+        ema = analysis_functions.EMAState(10)
+        for candle in data:
+            ema.update(candle)
+        db_functions.save_indicator_state("1day_time_series", "NVDA_XNGS", "ema_10", ema, len(data) - 1)
+        before = {symbol: db_functions.fetch_time_series_arrays(symbol, "1day", mic_code=mic) for symbol, mic in series}
+
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = db_functions.export_archive(directory, max_workers=2)
+            self.assertEqual([
+                (entry["schema_name"], entry["table_name"], entry["rows"]) for entry in manifest["series"]], [
+                ("1day_time_series", "AAPL_XNGS", 30), ("1day_time_series", "NVDA_XNGS", 30),
+                ("forex_time_series", "USD_EUR_1day", 30)])
+            self.assertEqual(db_functions.verify_archive(directory), [])
+            with self.assertRaises(db_functions.TimeSeriesExistsError):
+                db_functions.restore_archive(directory)
+
+            db_functions.purge_db_structure()
+            db_functions.import_db_structure()
+            db_functions.invalidate_symbol_registry()
+            self.save_samples_for_tests()
+            self.assertEqual(db_functions.restore_archive(directory, max_workers=2), {
+                ("1day_time_series", "AAPL_XNGS"): 30, ("1day_time_series", "NVDA_XNGS"): 30,
+                ("forex_time_series", "USD_EUR_1day"): 30})
+            for symbol, mic in series:
+                after = db_functions.fetch_time_series_arrays(symbol, "1day", mic_code=mic)
+                for column, values in before[symbol].items():
+                    np.testing.assert_array_equal(after[column], values)
+            self.assertEqual(db_functions.fetch_price_scale("1day_time_series", "NVDA_XNGS"), 2)
+            self.assertEqual(len(db_functions.fetch_time_series_rollup("NVDA", "1day", "week", mic_code="XNGS")),
+                             len({candle["datetime_object"].isocalendar()[:2] for candle in data}))
+            states = db_functions.fetch_indicator_states("1day_time_series", "NVDA_XNGS")
+            self.assertAlmostEqual(states["ema_10"][1].value, ema.value)
+            self.assertEqual([row[:2] for row in db_functions.fetch_series_catalog("1day_time_series")],
+                             [("1day_time_series", "AAPL_XNGS"), ("1day_time_series", "NVDA_XNGS")])
+            # restored table takes new rows after the archived ones
+            last = max(candle["datetime_object"] for candle in data)
+            newer = [dict(candle, datetime=str((last + timedelta(days=i + 1)).date()),
+                          datetime_object=last + timedelta(days=i + 1)) for i, candle in enumerate(data[:5])]
+            db_functions.insert_historical_data(newer, "AAPL", "1day", mic_code="XNGS", rownum_start=len(data))
+            self.assertDatabaseHasRows("1day_time_series", "AAPL_XNGS", 35)
+            self.assertEqual(db_functions.restore_archive(directory, schema_name="1day_time_series", replace=True),
+                             {("1day_time_series", "AAPL_XNGS"): 30, ("1day_time_series", "NVDA_XNGS"): 30})
+            self.assertDatabaseHasRows("1day_time_series", "AAPL_XNGS", 30)
+
+            # a row changed within a (still valid) compressed file - neither the check nor the restore let it through
+            path = os.path.join(directory, manifest["series"][0]["file"])
+            with gzip.open(path, "rb") as file:
+                content = file.read()
+            with gzip.open(path, "wb") as file:
+                file.write(content.replace(b"\t", b"\t1", 1))
+            self.assertEqual(db_functions.verify_archive(directory),
+                             [("1day_time_series", "AAPL_XNGS", "checksum does not match")])
+            with self.assertRaises(psycopg2.DataError):
+                db_functions.restore_archive(directory, schema_name="1day_time_series", replace=True, max_workers=1)
+            self.assertDatabaseHasRows("1day_time_series", "AAPL_XNGS", 30)
+            os.remove(path)
+            self.assertEqual(db_functions.verify_archive(directory),
+                             [("1day_time_series", "AAPL_XNGS", "file is missing")])
+
+    def test_backfill_time_series(self):
+        """backfill replaces the series at once - with its indexes, rollups and views, or not at all"""
+        self.save_samples_for_tests()
+        old = t_helpers.generate_random_time_sample("1day", True, span=20)
+        db_functions.create_time_series("NVDA", "1day", mic_code="XNGS", price_scale=2)
+        db_functions.insert_historical_data(old, "NVDA", "1day", mic_code="XNGS")
+        db_functions.create_time_series_rollups("NVDA", "1day", mic_code="XNGS", buckets=("week",))
+        db_functions.create_time_series_view("NVDA", "1day", mic_code="XNGS")
+        db_functions.save_indicator_state(
+            "1day_time_series", "NVDA_XNGS", "ema_10", analysis_functions.EMAState(10), len(old) - 1)
+
+        data = t_helpers.generate_random_time_sample("1day", True, span=60)
+        self.assertEqual(db_functions.backfill_time_series(data, "NVDA", "1day", mic_code="XNGS"), len(data))
+        stored = db_functions.fetch_time_series_arrays("NVDA", "1day", mic_code="XNGS")
+        oldest_first = sorted(data, key=lambda candle: candle["datetime_object"])
+        self.assertEqual(list(stored["ID"]), list(range(len(data))))
+        self.assertEqual(list(stored["datetime"].astype(datetime)),
+                         [candle["datetime_object"].date() for candle in oldest_first])
+        self.assertEqual(db_functions.fetch_price_scale("1day_time_series", "NVDA_XNGS"), 2)
+        self.assertEqual(len(db_functions.fetch_time_series_rollup("NVDA", "1day", "week", mic_code="XNGS")),
+                         len({candle["datetime_object"].isocalendar()[:2] for candle in data}))
+        self.assertEqual(db_functions.fetch_indicator_states("1day_time_series", "NVDA_XNGS"), {})
+        self.assertEqual(db_functions.fetch_series_catalog("1day_time_series", "NVDA_XNGS")[0][4:7],
+                         (0, len(data) - 1, len(data)))
+        with psycopg2.connect(**helpers._connection_dict) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT count(*) FROM "1day_time_series"."NVDA_XNGS_view";')
+            self.assertEqual(cur.fetchone()[0], len(data))
+            cur.execute("""SELECT cls.relname, cls.relpersistence FROM pg_class cls
+                JOIN pg_namespace nsp ON nsp.oid = cls.relnamespace
+                WHERE nsp.nspname = '1day_time_series' ORDER BY cls.relname;""")
+            self.assertEqual(cur.fetchall(), [
+                ("NVDA_XNGS", "p"), ("NVDA_XNGS_datetime_idx", "p"), ("NVDA_XNGS_rollup_week", "p"),
+                ("NVDA_XNGS_rollup_week_pkey", "p"), ("NVDA_XNGS_view", "p"), ("nvda_time_series_pkey", "p")])
+
+        # rows that don't match the download (a repeated timestamp) leave the series as it was
+        with self.assertRaises(psycopg2.DataError):
+            db_functions.backfill_time_series(old + old[:1], "NVDA", "1day", mic_code="XNGS")
+        self.assertDatabaseHasRows("1day_time_series", "NVDA_XNGS", len(data))
+        self.assertEqual([table[2] for table in db_functions.list_series_tables()], ["NVDA_XNGS"])
+
+        # full download kept by the ingest log replaces the series, with the pages committed after it
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(db_functions.ingest_log_db, "INGEST_LOG_DIRECTORY_", directory):
+            newest_first = sorted(old, key=lambda candle: candle["datetime_object"], reverse=True)
+            with db_functions.logged_download("NVDA", "1day", mic_code="XNGS") as log_page:
+                log_page(newest_first[:5])
+            with db_functions.logged_download("NVDA", "1day", mic_code="XNGS", backfill=True) as log_page:
+                log_page(newest_first[5:15])
+                log_page(newest_first[14:])
+            self.assertEqual(db_functions.drain_ingest_log(), {("1day_time_series", "NVDA_XNGS"): len(old) - 5})
+            with db_functions.logged_download("NVDA", "1day", mic_code="XNGS") as log_page:
+                log_page(newest_first[:6])
+            self.assertEqual(db_functions.drain_ingest_log(), {("1day_time_series", "NVDA_XNGS"): 5})
+        stored = db_functions.fetch_time_series_arrays("NVDA", "1day", mic_code="XNGS")
+        self.assertEqual(list(stored["ID"]), list(range(len(old))))
+        self.assertEqual(list(stored["datetime"].astype(datetime)),
+                         [candle["datetime_object"].date() for candle in reversed(newest_first)])
+
+        # series that does not exist yet is created by its backfill
+        forex = [{key: value for key, value in candle.items() if key != "volume"} for candle in data]
+        self.assertEqual(db_functions.backfill_time_series(forex, "USD/EUR", "1day"), len(data))
+        self.assertDatabaseHasRows("forex_time_series", "USD_EUR_1day", len(data))
+
+    def test_concurrent_appends(self):
+        """
+        appenders of a series get consecutive ID ranges from the database - no collisions, no gaps, and ID order
+        is the datetime order: a chunk older than the rows stored before it is refused
+        """
+        self.save_samples_for_tests()
+        data = t_helpers.generate_random_time_sample("1min", True, span=400)
+        data.sort(key=lambda candle: candle["datetime_object"])
+        chunks = [data[i:i + 50] for i in range(0, len(data), 50)]
+        db_functions.create_time_series("AAPL", "1min", mic_code="XNGS")
+
+        def append(chunk):
+            try:
+                db_functions.insert_historical_data(chunk, "AAPL", "1min", mic_code="XNGS")
+                return True
+            except psycopg2.DataError:
+                return False
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            appended = list(executor.map(append, chunks))
+        stored = db_functions.fetch_time_series_arrays("AAPL", "1min", mic_code="XNGS")
+        moments = list(stored["datetime"].astype(datetime))
+        self.assertEqual(list(stored["ID"]), list(range(sum(appended) * 50)))
+        self.assertEqual(moments, sorted(moments))
+        self.assertEqual(len(set(moments)), len(moments))
+        # every chunk got a range of its own, its rows in their order - or was refused as a whole
+        position = {moment: ID for ID, moment in zip(stored["ID"], moments)}
+        for chunk, was_appended in zip(chunks, appended):
+            IDs = [position.get(candle["datetime_object"]) for candle in chunk]
+            if was_appended:
+                self.assertEqual(IDs, list(range(IDs[0], IDs[0] + len(chunk))))
+            else:
+                self.assertEqual(IDs, [None] * len(chunk))
+                self.assertLess(chunk[0]["datetime_object"], moments[-1])
+
+        # rows that don't follow the last stored one are refused, even though their IDs would be free
+        with self.assertRaises(psycopg2.DataError):
+            db_functions.insert_historical_data(data[:5], "AAPL", "1min", mic_code="XNGS")
+        # insert that fails leaves no gap behind, rows placed explicitly still go where they are told
+        newer = [
+            dict(candle, datetime=str(moments[-1] + timedelta(minutes=i + 1)),
+                 datetime_object=moments[-1] + timedelta(minutes=i + 1))
+            for i, candle in enumerate(data[:10])]
+        broken = [dict(candle, close="1000000") for candle in newer[:5]]
+        with self.assertRaises(psycopg2.Error):
+            db_functions.insert_historical_data(broken, "AAPL", "1min", mic_code="XNGS")
+        db_functions.insert_historical_data(newer[:5], "AAPL", "1min", mic_code="XNGS")
+        db_functions.insert_historical_data(newer[5:], "AAPL", "1min", mic_code="XNGS", rownum_start=len(moments) + 100)
+        stored = db_functions.fetch_time_series_arrays("AAPL", "1min", mic_code="XNGS")
+        self.assertEqual(list(stored["ID"][len(moments):]), list(range(len(moments), len(moments) + 5)) + list(
+            range(len(moments) + 100, len(moments) + 95 + len(newer))))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 from datetime import datetime, timedelta
+from decimal import Decimal
 from random import choices, randint
 from typing import Callable
 
@@ -287,6 +288,108 @@ class DBFetchTests(unittest.TestCase):
                     end_date=end_date, time_span=time_span, trading_time_span=trading_time_span)
                 self.assertEqual(predicted_answer, id_bracket_, msg=message)
 
+    def test_fetch_data_by_bracket(self):
+        """single statement fetch returns exactly the rows of the bracket calculated by chained calls"""
+        with self.assertRaises(LookupError):
+            db_functions.fetch_data_by_bracket("", "", start_date=datetime.now())
+        for case in self.time_table_cases:
+            symbol, time_interval, mic, is_equity = case
+            schema_name, table_name, _ = t_helpers.form_test_essentials(symbol, time_interval, mic, is_equity)
+            inserted_data = self.prepare_table_for_case(
+                symbol=symbol, time_interval=time_interval, mic=mic, is_equity=is_equity, inserted_rows=25)
+            first, last = inserted_data[0]['datetime_object'], inserted_data[-1]['datetime_object']
+            sub_cases = t_helpers.time_bracket_case_generator(inserted_data, first, last)
+            sub_cases.extend(t_helpers.time_bracket_case_generator(
+                inserted_data, inserted_data[randint(3, 10)]['datetime_object'],
+                inserted_data[randint(20, 24)]['datetime_object']))
+            sub_cases.extend(t_helpers.time_bracket_case_generator(
+                inserted_data, first - timedelta(days=90), first - timedelta(days=10),
+                raised_exception=db_functions.DataNotPresentError)[:3])
+            sub_cases.append((first, None, None, 75, None, None))
+            for sub_case in sub_cases:
+                start_date, end_date, time_span, trading_time_span, _, raised_exception = sub_case
+                arguments = dict(start_date=start_date, end_date=end_date, time_span=time_span,
+                                 trading_time_span=trading_time_span)
+                if raised_exception:
+                    with self.assertRaises(raised_exception, msg=f"{case} {sub_case}"):
+                        db_functions.fetch_data_by_bracket(symbol, time_interval, is_equity, mic, **arguments)
+                    continue
+                bracket = db_functions.calculate_fetch_time_bracket(
+                    symbol, time_interval, is_equity, mic, **arguments)
+                expected = sorted(db_functions.fetch_generic_range_by_IDs(schema_name, table_name, *bracket))
+                self.assertEqual(
+                    expected, db_functions.fetch_data_by_bracket(symbol, time_interval, is_equity, mic, **arguments),
+                    msg=f"{case} {sub_case}")
+
+    def prepare_fixed_point_case(self, symbol: str, time_interval: str, is_equity: bool, mic: str, inserted_rows=20):
+        """
+        series with fixed-point prices (5 decimal places) - returns its rows the way fetchers should give them,
+        prices as Decimals
+        """
+        db_functions.create_time_series(symbol, time_interval, is_equity, mic_code=mic, price_scale=5)
+        dummy_data = t_helpers.generate_random_time_sample(time_interval, is_equity, span=inserted_rows)
+        for candle in dummy_data:
+            for price in ["open", "close", "high", "low"]:
+                candle[price] = f"{candle[price]}.{randint(0, 99999):05d}"
+        db_functions.insert_historical_data(dummy_data, symbol, time_interval, is_equity=is_equity, mic_code=mic)
+        return [
+            (ID, candle["datetime_object"], *[Decimal(candle[price]) for price in ["open", "close", "high", "low"]],
+             *([candle["volume"]] if is_equity else []))
+            for ID, candle in enumerate(dummy_data)
+        ]
+
+    def test_fixed_point_datapoint_by_date(self):
+        for symbol, time_interval, mic, is_equity in self.time_table_cases:
+            rows = self.prepare_fixed_point_case(symbol, time_interval, is_equity, mic)
+            self.assertEqual(rows[7], db_functions.fetch_datapoint_by_date(
+                rows[7][1], symbol, time_interval, is_equity, mic_code=mic))
+
+    def test_fixed_point_data_by_dates(self):
+        for symbol, time_interval, mic, is_equity in self.time_table_cases:
+            rows = self.prepare_fixed_point_case(symbol, time_interval, is_equity, mic)
+            self.assertEqual(rows, db_functions.fetch_data_by_dates(
+                symbol, time_interval, is_equity, mic, start_date=rows[0][1], end_date=rows[-1][1]))
+            self.assertEqual(rows[-5:], db_functions.fetch_data_by_dates(
+                symbol, time_interval, is_equity, mic, end_date=rows[-1][1], trading_time_span=5))
+
+    def test_fixed_point_data_by_bracket(self):
+        for symbol, time_interval, mic, is_equity in self.time_table_cases:
+            rows = self.prepare_fixed_point_case(symbol, time_interval, is_equity, mic)
+            self.assertEqual(rows[3:], db_functions.fetch_data_by_bracket(
+                symbol, time_interval, is_equity, mic, start_date=rows[3][1], end_date=rows[-1][1]))
+
+    def test_fixed_point_generic_by_ID(self):
+        for symbol, time_interval, mic, is_equity in self.time_table_cases:
+            schema_name, table_name, _ = t_helpers.form_test_essentials(symbol, time_interval, mic, is_equity)
+            rows = self.prepare_fixed_point_case(symbol, time_interval, is_equity, mic)
+            self.assertEqual(rows[11], db_functions.fetch_generic_by_ID_(11, table_name, schema_name))
+
+    def test_fixed_point_generic_range_by_IDs(self):
+        for symbol, time_interval, mic, is_equity in self.time_table_cases:
+            schema_name, table_name, _ = t_helpers.form_test_essentials(symbol, time_interval, mic, is_equity)
+            rows = self.prepare_fixed_point_case(symbol, time_interval, is_equity, mic)
+            self.assertEqual(rows, sorted(db_functions.fetch_generic_range_by_IDs(schema_name, table_name)))
+            self.assertEqual(rows[2:6], sorted(db_functions.fetch_generic_range_by_IDs(schema_name, table_name, 2, 5)))
+
+    def test_fixed_point_rollup(self):
+        for symbol, time_interval, mic, is_equity in self.time_table_cases:
+            rows = self.prepare_fixed_point_case(symbol, time_interval, is_equity, mic)
+            db_functions.create_time_series_rollups(symbol, time_interval, mic_code=mic)
+            bucket = db_functions.ROLLUP_BUCKETS[time_interval][-1]
+            rollup = db_functions.fetch_time_series_rollup(symbol, time_interval, bucket, mic_code=mic)
+            self.assertEqual(rollup[0][1], rows[0][2])
+            self.assertEqual(rollup[-1][2], rows[-1][3])
+            self.assertEqual(max(bucket_row[3] for bucket_row in rollup), max(row[4] for row in rows))
+            self.assertEqual(min(bucket_row[4] for bucket_row in rollup), min(row[5] for row in rows))
+
+    def test_fixed_point_downsampled(self):
+        for symbol, time_interval, mic, is_equity in self.time_table_cases:
+            rows = self.prepare_fixed_point_case(symbol, time_interval, is_equity, mic)
+            # downsampled prices are floats, decoded by the database
+            (candle,) = db_functions.fetch_downsampled_time_series(symbol, time_interval, 1, mic_code=mic)
+            self.assertEqual(candle[1:6], (rows[0][1], *map(float, (
+                rows[0][2], rows[-1][3], max(row[4] for row in rows), min(row[5] for row in rows)))))
+
     def test_fetch_currencies(self):
         currency_list = [
             (0, "Argentinian Peso", "ARS"), (1, "Brazil Real", "BRL"),
@@ -505,6 +608,72 @@ class DBFetchTests(unittest.TestCase):
         for case in cases:
             self.assertFetchCaseCompliant(case[:-1], db_functions.fetch_stocks, case[-1], stocks)
 
+    def test_instrument_search(self):
+        """in-process index gives the same rows as LIKE filters of the views, and completes prefixes"""
+        pattern_cases = [
+            ("stocks", db_functions.fetch_stocks, [
+                {"symbol": "A%"}, {"name": "%Inc%"}, {"country_name": "%U%S%", "access_plan": "Basic"},
+                {"symbol": "A_PL"}, {"name": "%Corp", "exchange_mic_code": "X%"}, {"investment_type": "%Stock"},
+                {"symbol": "%a%"}, {"name": "%Tex%"},
+            ], ["symbol", "name", "currency_symbol", "exchange_mic_code", "country_name", "investment_type",
+                "access_plan"]),
+            ("markets", db_functions.fetch_markets, [{"name": "NAS%"}, {"country_name": "%United%"}],
+             ["name", "mic_code", "timezone_name", "access_plan", "country_name"]),
+            ("forex_pairs", db_functions.fetch_forex_pairs, [{"symbol": "%/USD"}, {"base_currency_name": "%ollar%"}],
+             ["currency_group_name", "symbol", "base_currency_symbol", "quote_currency_symbol",
+              "base_currency_name", "quote_currency_name"]),
+        ]
+        for kind, fetch_function, patterns, arguments in pattern_cases:
+            index = db_functions.instrument_index(kind)
+            self.assertEqual(len(index), len(fetch_function()))
+            for column_patterns in patterns:
+                expected = fetch_function(*[column_patterns.get(argument) for argument in arguments])
+                self.assertEqual(sorted(expected), sorted(index.match(**column_patterns)), msg=column_patterns)
+        self.assertEqual([row[1] for row in db_functions.search_instruments("stocks", prefix="a")],
+                         ["AADV", "AAPL", "ABLLL"])  # shortest matches first
+        self.assertEqual([row[1] for row in db_functions.search_instruments("stocks", prefix="nvidia")], ["NVDA"])
+        self.assertEqual(len(db_functions.search_instruments("stocks", name="%inc%", case_sensitive=False)), 2)
+        with self.assertRaises(ValueError):
+            db_functions.search_instruments("stocks", sector="%")
+
+        # symbols show up in the index kept for the process, once they are in the materialized view
+        index = db_functions.instrument_index("stocks")
+        with psycopg2.connect(**helpers._connection_dict) as conn:
+            cur = conn.cursor()
+            cur.execute("""INSERT INTO public.stocks ("ID", symbol, name, currency, exchange, country, type, plan)
+                SELECT 100, 'MSFT', 'Microsoft Corp', currency, exchange, country, type, plan
+                FROM public.stocks WHERE symbol = 'AAPL';""")
+        self.assertIs(db_functions.instrument_index("stocks"), index)
+        db_functions.refresh_reference_views()
+        self.assertEqual([row[1] for row in db_functions.search_instruments("stocks", prefix="micro")], ["MSFT"])
+
+        # trigram indexes need pg_trgm, which may not be installed on the server
+        if db_functions.create_trigram_indexes():
+            with psycopg2.connect(**helpers._connection_dict) as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT count(*) FROM pg_indexes WHERE indexname LIKE '%\\_trgm\\_idx';")
+                self.assertEqual(cur.fetchone()[0], 6)
+            self.assertEqual(len(db_functions.fetch_stocks(None, "%Corp")), 3)
+            db_functions.drop_trigram_indexes()
+
+    def test_reference_views(self):
+        """fetches read materialized references, which follow the tables once they are refreshed"""
+        with psycopg2.connect(**helpers._connection_dict) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT matviewname FROM pg_matviews WHERE schemaname = 'public' ORDER BY matviewname;")
+            self.assertEqual(tuple(row[0] for row in cur.fetchall()), db_functions.REFERENCE_VIEWS)
+            cur.execute("""UPDATE public.countries SET name = 'United States of America'
+                WHERE name = 'United States';""")
+        self.assertEqual(len(db_functions.fetch_stocks(None, None, None, None, "United States")), 5)
+        self.assertEqual(len(db_functions.fetch_markets(None, None, None, None, "United States")), 3)
+        db_functions.refresh_reference_views()
+        self.assertEqual(len(db_functions.fetch_stocks(None, None, None, None, "United States")), 0)
+        self.assertEqual(len(db_functions.fetch_stocks(None, None, None, None, "United States of America")), 5)
+        db_functions.refresh_reference_views(("markets_explained",), concurrently=False)
+        self.assertEqual(len(db_functions.fetch_markets(None, None, None, None, "%America")), 3)
+        with self.assertRaises(ValueError):
+            db_functions.refresh_reference_views(("stocks",))
+
     def test_fetch_datapoint_by_date(self):
         """
         test fetching a single point of time from database by date
@@ -1,6 +1,9 @@
 from datetime import datetime, timedelta
+import tempfile
+from time import sleep
 import unittest
 from random import randint
+from unittest.mock import patch
 
 import psycopg2
 import db_functions, api_functions
@@ -21,6 +24,12 @@ class ProcedureTests(unittest.TestCase):
 
     def setUp(self) -> None:
         db_functions.purge_db_structure()
+        # downloads are logged into a directory of the test, never into the one of the repository
+        ingest_log_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(ingest_log_directory.cleanup)
+        ingest_log_patch = patch.object(db_functions.ingest_log_db, "INGEST_LOG_DIRECTORY_", ingest_log_directory.name)
+        ingest_log_patch.start()
+        self.addCleanup(ingest_log_patch.stop)
         self.t_db = test_db.DBTests()
         self.test_cases = [
             ("AAPL", "XNGS", "1day", True),  # v
@@ -129,18 +138,35 @@ class ProcedureTests(unittest.TestCase):
             ('forex_pairs', 'public'),
             ('plans', 'public'),
             ('countries', 'public'),
+            ('api_credit_ledger', 'public'),
+            ('download_jobs', 'public'),
+            ('indicator_states', 'public'),
+            ('price_scales', 'public'),
+            ('series_catalog', 'public'),
+            ('partitioned_series', 'public'),
+            ('series_quality', 'public'),
+            ('candles_1min', 'partitioned_time_series'),
+            ('candles_1day', 'partitioned_time_series'),
         ]
         functions_in_database = [
             ('generate_financial_view_1min', 'public'),
             ('generate_financial_view_1day', 'public'),
             ('generate_forex_view', 'public'),
             ('check_is_stock', 'public'),
+            ('reserve_api_credits', 'public'),
+            ('generate_time_series_rollup', 'public'),
+            ('refresh_time_series_rollups', 'public'),
+            ('downsample_time_series', 'public'),
+            ('create_series_partitions', 'public'),
+            ('refresh_series_catalog', 'public'),
+            ('attach_series_catalog', 'public'),
+            ('allocate_time_series_ids', 'public'),
         ]
         views_in_database = [
             ('public', 'markets_explained'), ('public', 'stocks_explained'), ('public', 'forex_pairs_explained'),
             ('public', 'tracked_indexes'), ('public', 'non_standard_functions'), ('public', 'non_standard_views'),
         ]
-        additional_schemas = ["1min_time_series", "1day_time_series", "forex_time_series"]
+        additional_schemas = ["1min_time_series", "1day_time_series", "forex_time_series", "partitioned_time_series"]
         for table, schema in tables_in_database_with_schemas:
             self.assertTableExist(table, schema)
         for schema in additional_schemas:
@@ -249,6 +275,28 @@ class ProcedureTests(unittest.TestCase):
             full_procedures.time_series_update(**update_params)
             self.assertTimeSeriesLatestDate(**query_params)
 
+    def test_download_worker_lease(self):
+        """worker keeps the lease of a job as long as the download takes, jobs abandoned on the last attempt fail"""
+        full_procedures.rebuild_database_destructively()
+        abandoned = db_functions.enqueue_download_job("USD/EUR", "1day", max_attempts=1)
+        self.assertEqual(db_functions.claim_download_job("crashed", lease=timedelta(seconds=0))[0], abandoned)
+        job = db_functions.enqueue_download_job("AAPL", "1day", "XNGS")
+        intruder_claims = []
+
+        def slow_download(*args, **kwargs):
+            sleep(3)  # a lease of a second would expire 3 times over
+            intruder_claims.append(db_functions.claim_download_job("intruder"))
+
+        with patch.object(full_procedures, "time_series_download_window", slow_download):
+            completed = full_procedures.download_worker(
+                "worker", ProcedureTests.key_switcher, lease=timedelta(seconds=1))
+        self.assertEqual(completed, 1)
+        self.assertEqual(intruder_claims, [None])
+        statuses = {row[0]: (row[6], row[9], row[11]) for row in db_functions.fetch_download_jobs()}
+        self.assertEqual(statuses[job], ("done", "worker", None))
+        self.assertEqual(statuses[abandoned][:2], ("failed", "crashed"))
+        self.assertIn("expired", statuses[abandoned][2])
+
 
 if __name__ == '__main__':
     unittest.main()